@@ -0,0 +1,245 @@
+from collections import OrderedDict
+from typing import Dict, Optional, Tuple
+from metrics import Counter, registry
+from database import DB_POOL_MAX_SIZE
+from config import setting
+import asyncio
+import json
+import math
+import sqlite3
+import threading
+import time
+
+# Admission control of the expensive endpoints: every client gets a token bucket per route group, and each group
+# has a cap on the requests served at the same time by this worker, with a short queue in front of it. Requests over
+# the limits are answered before any database or bcrypt work starts: 429 when the client is over its rate, 503 when
+# the worker is saturated, both with a Retry-After.
+ADMISSION_ENABLED = setting("ADMISSION_ENABLED", "true").lower() == "true"
+# Where the token buckets live: "memory" (per worker) or "sqlite:///path/to/file.db", a file shared by the workers
+# of the host
+RATE_LIMIT_STORE = setting("RATE_LIMIT_STORE", "memory")
+# Requests waiting for a free slot of their group, beyond it they are shed right away
+ADMISSION_QUEUE_SIZE = int(setting("ADMISSION_QUEUE_SIZE", 32))
+# Seconds a queued request waits for a slot before it is shed
+ADMISSION_QUEUE_TIMEOUT = float(setting("ADMISSION_QUEUE_TIMEOUT", 0.5))
+# Take the client address from X-Forwarded-For, only behind a proxy that sets it
+TRUST_FORWARDED_FOR = setting("TRUST_FORWARDED_FOR", "false").lower() == "true"
+
+
+# Limits of a group of routes: `rate` requests per second per client with bursts of `burst` requests, and at most
+# `concurrency` requests of the group in progress in this worker
+class RouteGroup:
+    def __init__(self, name: str, prefixes: Tuple[str, ...], rate: float, burst: int, concurrency: int):
+        self.name = name
+        self.prefixes = prefixes
+        self.rate = rate
+        self.burst = burst
+        self.limiter = ConcurrencyLimiter(name, concurrency)
+
+    def matches(self, path: str) -> bool:
+        return any(path == prefix or path.startswith(prefix + "/") for prefix in self.prefixes)
+
+
+def _group(name: str, prefixes: Tuple[str, ...], rate: float, burst: int, concurrency: int) -> RouteGroup:
+    prefix = name.upper()
+    return RouteGroup(name, prefixes, rate=float(setting(f"{prefix}_RATE", rate)),
+                      burst=int(setting(f"{prefix}_BURST", burst)),
+                      concurrency=int(setting(f"{prefix}_CONCURRENCY", concurrency)))
+
+
+# Token buckets kept in the memory of the worker, the least recently used ones are dropped past `max_keys` (a bucket
+# that was idle long enough is full, the same as a missing one)
+class MemoryStore:
+    def __init__(self, max_keys: int = 100000):
+        self.max_keys = max_keys
+        # key -> (tokens, time of the last update)
+        self._buckets = OrderedDict()
+
+    async def take(self, key: str, rate: float, burst: int) -> float:
+        now = time.monotonic()
+        tokens, updated = self._buckets.get(key, (burst, now))
+        tokens, wait = _refill(tokens, updated, now, rate, burst)
+        self._buckets[key] = (tokens, now)
+        self._buckets.move_to_end(key)
+        while len(self._buckets) > self.max_keys:
+            self._buckets.popitem(last=False)
+        return wait
+
+
+# Token buckets in a SQLite file, so the workers of a host share the limits. A stand-in for a shared store such as
+# Redis: each take is one short write transaction, run in a thread.
+class SQLiteStore:
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(path, timeout=5, isolation_level=None, check_same_thread=False)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute("CREATE TABLE IF NOT EXISTS buckets (key TEXT PRIMARY KEY, tokens REAL, updated REAL)")
+
+    async def take(self, key: str, rate: float, burst: int) -> float:
+        return await asyncio.to_thread(self._take, key, rate, burst)
+
+    def _take(self, key: str, rate: float, burst: int) -> float:
+        with self._lock:
+            # wall clock time, the monotonic clocks of the workers are not comparable
+            now = time.time()
+            self._connection.execute("BEGIN IMMEDIATE")
+            try:
+                row = self._connection.execute("SELECT tokens, updated FROM buckets WHERE key = ?", (key,)).fetchone()
+                tokens, wait = _refill(*(row or (burst, now)), now, rate, burst)
+                self._connection.execute("INSERT OR REPLACE INTO buckets (key, tokens, updated) VALUES (?, ?, ?)",
+                                         (key, tokens, now))
+                self._connection.execute("COMMIT")
+            except BaseException:
+                self._connection.execute("ROLLBACK")
+                raise
+        return wait
+
+
+# Refill a bucket for the time elapsed since `updated` and take one token. Returns the tokens left and 0, or the
+# tokens unchanged and the seconds until a token is available when the bucket is empty.
+def _refill(tokens: float, updated: float, now: float, rate: float, burst: int) -> Tuple[float, float]:
+    tokens = min(burst, tokens + max(0.0, now - updated) * rate)
+    if tokens >= 1:
+        return tokens - 1, 0.0
+    return tokens, (1 - tokens) / rate if rate > 0 else math.inf
+
+
+def create_store(url: str = RATE_LIMIT_STORE):
+    if url == "memory":
+        return MemoryStore()
+    if url.startswith("sqlite:///"):
+        return SQLiteStore(url[len("sqlite:///"):])
+    raise ValueError(f"Unsupported RATE_LIMIT_STORE {url}")
+
+
+admitted = Counter("admission_admitted_total", "Requests admitted", ("group",))
+shed = Counter("admission_shed_total", "Requests rejected by the admission control", ("group", "reason"))
+in_flight = Counter("admission_in_flight", "Requests in progress", ("group",), kind="gauge")
+queue_depth = Counter("admission_queue_depth", "Requests waiting for a slot", ("group",), kind="gauge")
+registry.extend([admitted, shed, in_flight, queue_depth])
+
+
+# At most `limit` requests in progress, the next ones wait in a bounded queue for up to `timeout` seconds
+class ConcurrencyLimiter:
+    def __init__(self, name: str, limit: int, queue_size: int = ADMISSION_QUEUE_SIZE,
+                 timeout: float = ADMISSION_QUEUE_TIMEOUT):
+        self.name = name
+        self.limit = limit
+        self.queue_size = queue_size
+        self.timeout = timeout
+        self.in_flight = 0
+        self._waiters = OrderedDict()
+        self._report()
+
+    @property
+    def queued(self) -> int:
+        return len(self._waiters)
+
+    # True when the request got a slot, which has to be given back with release()
+    async def acquire(self) -> bool:
+        if self.in_flight < self.limit and not self._waiters:
+            self.in_flight += 1
+            self._report()
+            return True
+        if self.queued >= self.queue_size or self.timeout <= 0:
+            return False
+        waiter = asyncio.get_running_loop().create_future()
+        self._waiters[waiter] = None
+        self._report()
+        try:
+            await asyncio.wait_for(asyncio.shield(waiter), self.timeout)
+            return True
+        except asyncio.TimeoutError:
+            # the slot may have been handed over while the timeout fired
+            if waiter.done() and not waiter.cancelled():
+                return True
+            return False
+        except asyncio.CancelledError:
+            if waiter.done() and not waiter.cancelled():
+                self.release()
+            raise
+        finally:
+            self._waiters.pop(waiter, None)
+            self._report()
+
+    # Hand the slot over to the oldest queued request, or free it
+    def release(self):
+        while self._waiters:
+            waiter, _ = self._waiters.popitem(last=False)
+            if not waiter.done():
+                waiter.set_result(None)
+                return
+        self.in_flight -= 1
+        self._report()
+
+    def _report(self):
+        in_flight.set((self.name,), self.in_flight)
+        queue_depth.set((self.name,), self.queued)
+
+
+# ASGI middleware applying the limits of the first group matching the request path. The other paths go through.
+class AdmissionMiddleware:
+    def __init__(self, app, groups: Optional[Tuple[RouteGroup, ...]] = None, store=None):
+        self.app = app
+        self.groups = route_groups if groups is None else groups
+        self.store = store
+        self.enabled = ADMISSION_ENABLED
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not self.enabled:
+            return await self.app(scope, receive, send)
+        group = next((group for group in self.groups if group.matches(scope["path"])), None)
+        if group is None:
+            return await self.app(scope, receive, send)
+        if self.store is None:
+            self.store = create_store()
+
+        wait = await self.store.take(f"{group.name}:{client_address(scope)}", group.rate, group.burst)
+        if wait > 0:
+            shed.inc((group.name, "rate_limited"))
+            return await reject(send, 429, "Too many requests", wait)
+        if not await group.limiter.acquire():
+            shed.inc((group.name, "overloaded"))
+            return await reject(send, 503, "Server overloaded, retry later", group.limiter.timeout)
+        admitted.inc((group.name,))
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            group.limiter.release()
+
+
+def client_address(scope) -> str:
+    if TRUST_FORWARDED_FOR:
+        for name, value in scope["headers"]:
+            if name == b"x-forwarded-for":
+                return value.decode("latin-1").split(",")[0].strip()
+    client = scope.get("client")
+    return client[0] if client else "unknown"
+
+
+async def reject(send, status: int, detail: str, retry_after: float):
+    body = json.dumps({"detail": detail}).encode()
+    await send({"type": "http.response.start", "status": status, "headers": [
+        (b"content-type", b"application/json"), (b"content-length", str(len(body)).encode()),
+        (b"retry-after", str(max(1, math.ceil(retry_after))).encode())]})
+    await send({"type": "http.response.body", "body": body})
+
+
+# Route groups, in matching order. Logins and registrations hash passwords (bcrypt), so they get a low rate per client
+# and a concurrency of twice the hashing threads; the catalog reads are cheap but share the database pool.
+route_groups: Tuple[RouteGroup, ...] = (
+    _group("auth", ("/token", "/registration"), rate=1, burst=10,
+           concurrency=2 * int(setting("PASSWORD_HASH_WORKERS", 2))),
+    _group("catalog", ("/products", "/categories"), rate=50, burst=100, concurrency=4 * DB_POOL_MAX_SIZE),
+)
+
+
+# Current limits and load of each group, for the health endpoint
+def admission_stats() -> Dict[str, dict]:
+    return {group.name: {"rate": group.rate, "burst": group.burst, "concurrency": group.limiter.limit,
+                         "in_flight": group.limiter.in_flight, "queued": group.limiter.queued,
+                         "admitted": admitted.value((group.name,)),
+                         "rate_limited": shed.value((group.name, "rate_limited")),
+                         "overloaded": shed.value((group.name, "overloaded"))}
+            for group in route_groups}
@@ -1,30 +1,57 @@
+from concurrent.futures import ThreadPoolExecutor
 from fastapi import HTTPException, status
-from passlib.context import CryptContext
-import jwt
+from tortoise.signals import post_save, post_delete
 # from dotenv import dotenv_values
-from models import User
-import os
-
-credentials = {
-    "EMAIL": os.getenv("EMAIL"),
-    "PASSWORD": os.getenv("PASSWORD"),
-    "SECRET": os.getenv("SECRET"),
-    "SERVER_URL": os.getenv("SERVER_URL"),
-}
+from models import User, Principal
+from cache import user_cache
+from config import credentials, setting
+import functools
+import asyncio
+import time
 
 # credentials = dotenv_values(".env")
 
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
 
+# passlib (with bcrypt) and PyJWT (with cryptography) are imported by the first request that needs them, they are a
+# noticeable part of a cold start
+@functools.lru_cache(maxsize=None)
+def password_context():
+    from passlib.context import CryptContext
+    return CryptContext(schemes=["bcrypt"], deprecated="auto")
 
-def get_hashed_password(password):
-    return pwd_context.hash(password)
+# bcrypt takes ~100-300 ms per call and releases the GIL, so hashing runs in a bounded thread pool instead of blocking
+# the event loop. Calls beyond PASSWORD_HASH_WORKERS wait in the pool queue.
+password_executor = ThreadPoolExecutor(max_workers=int(setting("PASSWORD_HASH_WORKERS", 2)),
+                                       thread_name_prefix="password-hash")
 
 
-async def verify_token(token: str):
-    try:
-        payload = jwt.decode(token, credentials["SECRET"], algorithms=["HS256"])
+async def get_hashed_password(password):
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(password_executor, password_context().hash, password)
+
+
+# Decode the token and return its user, only going to the database when the user is not cached.
+# jwt.decode rejects expired tokens on every call, and cached entries never outlive the "exp" claim either.
+# The cached Principal is immutable, the invalidation only reaches this worker: the others see a change (e.g. a
+# verified email) once their entry expires, after USER_CACHE_TTL at most.
+async def get_user_from_token(token: str) -> Principal:
+    import jwt
+
+    payload = jwt.decode(token, credentials["SECRET"], algorithms=["HS256"])
+    principal = user_cache.get(payload["id"])
+    if principal is None:
+        generation = user_cache.generation
         user = await User.get(id=payload["id"])
+        principal = Principal(id=user.id, username=user.username, email=user.email, is_verified=user.is_verified,
+                              join_date=user.join_date)
+        ttl = min(user_cache.ttl, payload["exp"] - time.time()) if "exp" in payload else None
+        user_cache.set(user.id, principal, ttl, generation=generation)
+    return principal
+
+
+async def verify_token(token: str) -> Principal:
+    try:
+        user = await get_user_from_token(token)
     except ValueError:
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
@@ -35,7 +62,8 @@ async def verify_token(token: str):
 
 
 async def verify_password(plain_password: str, hashed_password: str):
-    return pwd_context.verify(plain_password, hashed_password)
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(password_executor, password_context().verify, plain_password, hashed_password)
 
 
 async def authenticate_user(username: str, password: str):
@@ -53,6 +81,19 @@ async def token_generator(username: str, password: str):
             detail="Invalid username or password",
             headers={"WWW-Authenticate": "Bearer"}
         )
+    import jwt
+
     token_data = {"id": user.id, "username": user.username}
     token = jwt.encode(token_data, credentials["SECRET"], algorithm="HS256")
     return token
+
+
+# Signals: drop the cached user every time it is written (e.g. after its email is verified)
+@post_save(User)
+async def invalidate_user_on_save(sender, instance, created, using_db, update_fields):
+    user_cache.delete(instance.id)
+
+
+@post_delete(User)
+async def invalidate_user_on_delete(sender, instance, using_db):
+    user_cache.delete(instance.id)
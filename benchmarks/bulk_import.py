@@ -0,0 +1,69 @@
+# Throughput of the bulk import (POST /products/bulk) against one POST /products per product, on a SQLite file
+# through aiosqlite.
+# Usage: python -m benchmarks.bulk_import [--products 20000] [--single 1000] [--format ndjson]
+import argparse
+import asyncio
+import csv
+import io
+import json
+import os
+import tempfile
+import time
+
+from benchmarks.common import client, close_db, init_db, report
+
+
+def import_body(products: int, format: str) -> str:
+    rows = [{"name": f"product-{i}", "original_price": f"{i % 1000}.99", "category_id": 1} for i in range(products)]
+    if format == "json":
+        return json.dumps(rows)
+    if format == "csv":
+        buffer = io.StringIO()
+        writer = csv.DictWriter(buffer, fieldnames=("name", "original_price", "category_id"))
+        writer.writeheader()
+        writer.writerows(rows)
+        return buffer.getvalue()
+    return "\n".join(json.dumps(row) for row in rows)
+
+
+async def main(args):
+    from main import app
+    from models import Category, Product
+
+    content_types = {"json": "application/json", "ndjson": "application/x-ndjson", "csv": "text/csv"}
+    with tempfile.TemporaryDirectory() as directory:
+        await init_db("sqlite://" + os.path.join(directory, "benchmark.sqlite3"))
+        await Category.create(name="category")
+        async with client(app) as http:
+            start = time.perf_counter()
+            for i in range(args.single):
+                response = await http.post("/products/", params={"category_id": 1},
+                                           json={"name": f"single-{i}", "original_price": "9.99"})
+                response.raise_for_status()
+            single_elapsed = time.perf_counter() - start
+
+            body = import_body(args.products, args.format)
+            start = time.perf_counter()
+            response = await http.post("/products/bulk", content=body,
+                                       headers={"content-type": content_types[args.format]}, timeout=None)
+            summary = json.loads(response.text.splitlines()[-1])
+            bulk_elapsed = time.perf_counter() - start
+        assert await Product.all().count() == args.single + summary["created"]
+        await close_db()
+
+    single_rate = args.single / single_elapsed
+    bulk_rate = summary["created"] / bulk_elapsed
+    report({
+        "single": {"products": args.single, "seconds": round(single_elapsed, 3), "rows_per_second": round(single_rate)},
+        "bulk": {"products": args.products, "format": args.format, "created": summary["created"],
+                 "failed": summary["failed"], "seconds": round(bulk_elapsed, 3), "rows_per_second": round(bulk_rate)},
+        "speedup": round(bulk_rate / single_rate, 1),
+    })
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Bulk import throughput benchmark")
+    parser.add_argument("--products", type=int, default=20000, help="products sent to the bulk import")
+    parser.add_argument("--single", type=int, default=1000, help="products created one request at a time")
+    parser.add_argument("--format", choices=("json", "ndjson", "csv"), default="ndjson")
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,117 @@
+# Cold start benchmark: import time of main, startup (ORM init, schemas, startup hooks) and latency of the first
+# requests, each run in a fresh interpreter like a serverless cold start, with FAST_START off and on. It also lists
+# the heavy modules loaded by then and, with --importtime, the slowest imports of main.
+# The exit status is 1 when the median import time in fast mode is above --max-import-ms.
+# Usage: python -m benchmarks.cold_start [--runs 5] [--products 1000] [--importtime] [--max-import-ms 1500]
+import argparse
+import asyncio
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+# Modules the fast start defers until a request needs them
+DEFERRED_MODULES = ("PIL.Image", "passlib.context", "jwt", "cryptography", "jinja2", "aiosmtplib")
+
+
+# Runs in the child process: one cold start, the timings are printed as a JSON line
+async def cold_start() -> dict:
+    start = time.perf_counter()
+    from main import app
+    imported = time.perf_counter()
+    await app.router.startup()
+    started = time.perf_counter()
+    deferred = [module for module in DEFERRED_MODULES if module in sys.modules]
+
+    from benchmarks.common import client
+    async with client(app) as http:
+        timings = {}
+        for name, path in (("first_request_ms", "/products/"), ("first_product_ms", "/products/1"),
+                           ("second_request_ms", "/products/?limit=10")):
+            request_start = time.perf_counter()
+            response = await http.get(path)
+            timings[name] = round((time.perf_counter() - request_start) * 1000, 2)
+            if response.status_code != 200:
+                raise RuntimeError(f"GET {path} failed with {response.status_code}")
+    await app.router.shutdown()
+    return {"import_ms": round((imported - start) * 1000, 2), "startup_ms": round((started - imported) * 1000, 2),
+            **timings, "loaded_after_startup": deferred}
+
+
+def run_child(db_url: str, fast_start: bool, importtime: bool = False) -> subprocess.CompletedProcess:
+    env = {**os.environ, "POSTGRES_URL": db_url, "FAST_START": str(fast_start).lower(), "IMAGE_GC_INTERVAL": "0",
+           "SECRET": os.environ.get("SECRET", "benchmark-secret"), "ADMISSION_ENABLED": "false"}
+    command = [sys.executable] + (["-X", "importtime"] if importtime else []) + ["-m", "benchmarks.cold_start",
+                                                                                  "--child"]
+    return subprocess.run(command, env=env, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True, check=True)
+
+
+def measure(db_url: str, fast_start: bool, runs: int) -> dict:
+    samples = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        completed = run_child(db_url, fast_start)
+        sample = json.loads(completed.stdout.splitlines()[-1])
+        # interpreter boot included
+        sample["process_ms"] = round((time.perf_counter() - start) * 1000, 2)
+        samples.append(sample)
+    metrics = [name for name, value in samples[0].items() if isinstance(value, float)]
+    return {**{name: round(statistics.median(sample[name] for sample in samples), 2) for name in metrics},
+            "loaded_after_startup": samples[-1]["loaded_after_startup"]}
+
+
+# Slowest modules imported by main itself (the first module importing a package pays for it), from the
+# -X importtime output in cumulative microseconds
+def slowest_imports(db_url: str, top: int = 15) -> list:
+    stderr = run_child(db_url, fast_start=True, importtime=True).stderr
+    modules = []
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = line[len("import time:"):].split("|")
+        # one space after the separator, then two per nesting level: main is at level 0
+        if len(name) - len(name.lstrip()) <= 3:
+            modules.append((int(cumulative), name.strip()))
+    modules.sort(reverse=True)
+    return [{"module": name, "ms": round(cumulative / 1000, 1)} for cumulative, name in modules[:top]]
+
+
+async def seed(db_url: str, products: int):
+    from benchmarks.common import seed_catalog
+    from tortoise import Tortoise
+
+    await Tortoise.init(db_url=db_url, modules={"models": ["models"]})
+    await Tortoise.generate_schemas()
+    await seed_catalog(products)
+    await Tortoise.close_connections()
+
+
+def main(args):
+    with tempfile.TemporaryDirectory() as directory:
+        db_url = f"sqlite://{os.path.join(directory, 'cold_start.db')}"
+        asyncio.run(seed(db_url, args.products))
+        results = {"runs": args.runs, "products": args.products,
+                   "default": measure(db_url, False, args.runs), "fast_start": measure(db_url, True, args.runs)}
+        if args.importtime:
+            results["slowest_imports"] = slowest_imports(db_url)
+    print(json.dumps(results, indent=2))
+    if args.max_import_ms and results["fast_start"]["import_ms"] > args.max_import_ms:
+        print(f"Import time {results['fast_start']['import_ms']} ms is over {args.max_import_ms} ms", file=sys.stderr)
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Cold start benchmark")
+    parser.add_argument("--runs", type=int, default=5, help="cold starts per mode")
+    parser.add_argument("--products", type=int, default=1000)
+    parser.add_argument("--importtime", action="store_true", help="also list the slowest imports of main")
+    parser.add_argument("--max-import-ms", type=float, help="fail when the fast start imports slower than this")
+    parser.add_argument("--child", action="store_true", help=argparse.SUPPRESS)
+    arguments = parser.parse_args()
+    if arguments.child:
+        print(json.dumps(asyncio.run(cold_start())))
+    else:
+        main(arguments)
@@ -0,0 +1,95 @@
+# Shared helpers for the benchmarks: an in-process client for the FastAPI app backed by SQLite, catalog seeding and
+# latency statistics. Run the benchmarks from the repository root, e.g. python -m benchmarks.login_load
+from decimal import Decimal
+from typing import Awaitable, Callable, List
+import asyncio
+import json
+import os
+import resource
+import sys
+import time
+
+os.environ.setdefault("SECRET", "benchmark-secret")
+os.environ.setdefault("POSTGRES_URL", "sqlite://:memory:")
+# every request comes from the same client, the rate limits would shed the load the benchmarks measure
+os.environ.setdefault("ADMISSION_ENABLED", "false")
+
+import httpx
+from tortoise import Tortoise
+
+
+async def init_db(db_url: str = "sqlite://:memory:"):
+    await Tortoise.init(db_url=db_url, modules={"models": ["models"]})
+    await Tortoise.generate_schemas()
+
+
+async def close_db():
+    await Tortoise.close_connections()
+
+
+async def seed_catalog(products: int, categories: int = 10, batch_size: int = 5000):
+    from models import Category, Product
+
+    category_objs = [await Category.create(name=f"category-{i}") for i in range(categories)]
+    for start in range(0, products, batch_size):
+        await Product.bulk_create([
+            Product(name=f"product-{i}", original_price=Decimal(i % 1000) + Decimal("0.99"),
+                    category=category_objs[i % categories])
+            for i in range(start, min(start + batch_size, products))
+        ])
+
+
+async def create_user(username: str, password: str, email: str = None):
+    from authentication import password_context
+    from models import User
+
+    return await User.create(username=username, email=email or f"{username}@example.com",
+                             password=password_context().hash(password), is_verified=True)
+
+
+def client(app) -> httpx.AsyncClient:
+    return httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://benchmark")
+
+
+# Run `requests` calls of `send` with at most `concurrency` in flight and return every latency in seconds
+async def run_load(send: Callable[[int], Awaitable[httpx.Response]], requests: int, concurrency: int) -> List[float]:
+    latencies = []
+    counter = iter(range(requests))
+
+    async def worker():
+        for i in counter:
+            start = time.perf_counter()
+            response = await send(i)
+            latencies.append(time.perf_counter() - start)
+            if response.status_code >= 500:
+                raise RuntimeError(f"{response.request.url} failed with {response.status_code}")
+
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    return latencies
+
+
+def percentile(samples: List[float], pct: float) -> float:
+    ordered = sorted(samples)
+    index = min(len(ordered) - 1, max(0, round(pct / 100 * len(ordered)) - 1))
+    return ordered[index]
+
+
+def summarize(latencies: List[float], elapsed: float) -> dict:
+    return {
+        "requests": len(latencies),
+        "throughput_rps": round(len(latencies) / elapsed, 1) if elapsed else None,
+        "p50_ms": round(percentile(latencies, 50) * 1000, 2),
+        "p95_ms": round(percentile(latencies, 95) * 1000, 2),
+        "p99_ms": round(percentile(latencies, 99) * 1000, 2),
+        "max_ms": round(max(latencies) * 1000, 2),
+    }
+
+
+def peak_rss_mb() -> float:
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and in kilobytes on Linux
+    return round(peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024, 1)
+
+
+def report(results: dict):
+    print(json.dumps(results, indent=2))
@@ -0,0 +1,93 @@
+# CPU cost against bytes saved of each content coding (gzip, brotli, zstd) and level, on the catalog responses:
+# a page of GET /products/, GET /products/{id} and GET /categories/. The bodies are fetched from the app, then each
+# codec compresses and decompresses them --rounds times and the best timing is kept.
+# Usage: python -m benchmarks.compression [--products 1000] [--limit 50] [--rounds 20]
+import argparse
+import asyncio
+import gzip
+import time
+
+from benchmarks.common import client, close_db, init_db, report, seed_catalog
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+# codec -> (levels, compress(body, level), decompress(body))
+def codecs() -> dict:
+    result = {"gzip": ((1, 6, 9), lambda body, level: gzip.compress(body, compresslevel=level, mtime=0),
+                       gzip.decompress)}
+    if brotli is not None:
+        result["br"] = ((1, 4, 5, 9, 11), lambda body, level: brotli.compress(body, quality=level), brotli.decompress)
+    if zstandard is not None:
+        result["zstd"] = ((1, 3, 9, 19), lambda body, level: zstandard.ZstdCompressor(level=level).compress(body),
+                          lambda body: zstandard.ZstdDecompressor().decompress(body))
+    return result
+
+
+async def fetch_bodies(products: int, limit: int) -> dict:
+    from main import app
+
+    await init_db()
+    await seed_catalog(products)
+    headers = {"Accept-Encoding": "identity"}
+    async with client(app) as http:
+        bodies = {
+            "list_products": (await http.get("/products/", params={"limit": limit}, headers=headers)).content,
+            "get_product": (await http.get("/products/1", headers=headers)).content,
+            "list_categories": (await http.get("/categories/", headers=headers)).content,
+        }
+    await close_db()
+    return bodies
+
+
+def best_time(function, rounds: int) -> float:
+    timings = []
+    for _ in range(rounds):
+        start = time.perf_counter()
+        function()
+        timings.append(time.perf_counter() - start)
+    return min(timings)
+
+
+def measure(body: bytes, compress, decompress, level: int, rounds: int) -> dict:
+    compressed = compress(body, level)
+    assert decompress(compressed) == body
+    compress_seconds = best_time(lambda: compress(body, level), rounds)
+    decompress_seconds = best_time(lambda: decompress(compressed), rounds)
+    return {
+        "level": level,
+        "bytes": len(compressed),
+        "ratio": round(len(body) / len(compressed), 2),
+        "bytes_saved": len(body) - len(compressed),
+        "compress_us": round(compress_seconds * 1e6, 1),
+        "decompress_us": round(decompress_seconds * 1e6, 1),
+        "compress_mb_per_s": round(len(body) / compress_seconds / (1024 * 1024), 1),
+        # what a response pays in CPU for every KB it saves on the wire
+        "us_per_kb_saved": round(compress_seconds * 1e6 / max(1, (len(body) - len(compressed)) / 1024), 2),
+    }
+
+
+def main(args):
+    bodies = asyncio.run(fetch_bodies(args.products, args.limit))
+    results = {}
+    for name, body in bodies.items():
+        results[name] = {"bytes": len(body), "codecs": {
+            codec: [measure(body, compress, decompress, level, args.rounds) for level in levels]
+            for codec, (levels, compress, decompress) in codecs().items()
+        }}
+    report({"products": args.products, "limit": args.limit, "rounds": args.rounds, "responses": results})
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compression cost against bytes saved per codec and level")
+    parser.add_argument("--products", type=int, default=1000)
+    parser.add_argument("--limit", type=int, default=50, help="products per listing page")
+    parser.add_argument("--rounds", type=int, default=20)
+    main(parser.parse_args())
@@ -0,0 +1,79 @@
+# Load test: p99 latency of GET /products while /token is being hammered.
+# The catalog load runs alone first and then next to a stream of logins, and the p99 ratio between both runs is
+# reported. Use --inline-bcrypt to compare with hashing on the event loop.
+# Usage: python -m benchmarks.login_load [--products 1000] [--requests 2000] [--concurrency 20] [--logins 4]
+from concurrent.futures import Executor, Future
+import argparse
+import asyncio
+import random
+import time
+
+from benchmarks.common import client, close_db, create_user, init_db, report, run_load, seed_catalog, summarize
+
+
+# Runs the job in the calling thread, i.e. on the event loop, like the hashing did before it was offloaded
+class InlineExecutor(Executor):
+    def submit(self, fn, *args, **kwargs):
+        future = Future()
+        future.set_result(fn(*args, **kwargs))
+        return future
+
+
+async def catalog_load(http, products: int, requests: int, concurrency: int):
+    # random cursors so the requests are not all served by the same cache entry
+    def send(_):
+        return http.get("/products/", params={"cursor": random.randrange(products), "limit": 20})
+
+    start = time.perf_counter()
+    latencies = await run_load(send, requests, concurrency)
+    return summarize(latencies, time.perf_counter() - start)
+
+
+async def main(args):
+    import authentication
+    from main import app
+
+    if args.inline_bcrypt:
+        authentication.password_executor = InlineExecutor()
+    await init_db()
+    await seed_catalog(args.products)
+    await create_user("benchmark", "benchmark-password")
+    async with client(app) as http:
+        baseline = await catalog_load(http, args.products, args.requests, args.concurrency)
+
+        stop = asyncio.Event()
+        logins = []
+
+        async def hammer_token():
+            while not stop.is_set():
+                start = time.perf_counter()
+                response = await http.post("/token", data={"username": "benchmark", "password": "benchmark-password"})
+                response.raise_for_status()
+                logins.append(time.perf_counter() - start)
+
+        hammers = [asyncio.create_task(hammer_token()) for _ in range(args.logins)]
+        start = time.perf_counter()
+        under_login_load = await catalog_load(http, args.products, args.requests, args.concurrency)
+        elapsed = time.perf_counter() - start
+        stop.set()
+        await asyncio.gather(*hammers)
+    await close_db()
+
+    report({
+        "inline_bcrypt": args.inline_bcrypt,
+        "password_hash_workers": getattr(authentication.password_executor, "_max_workers", None),
+        "products_baseline": baseline,
+        "products_under_login_load": under_login_load,
+        "token": summarize(logins, elapsed) if logins else None,
+        "p99_ratio": round(under_login_load["p99_ms"] / baseline["p99_ms"], 2),
+    })
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="GET /products latency while /token is hammered")
+    parser.add_argument("--products", type=int, default=1000)
+    parser.add_argument("--requests", type=int, default=2000)
+    parser.add_argument("--concurrency", type=int, default=20)
+    parser.add_argument("--logins", type=int, default=4, help="concurrent clients calling /token")
+    parser.add_argument("--inline-bcrypt", action="store_true", help="hash on the event loop (previous behaviour)")
+    asyncio.run(main(parser.parse_args()))
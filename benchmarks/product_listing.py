@@ -0,0 +1,72 @@
+# Benchmark of the product listing serialization: model instances + pydantic models (previous path) against plain
+# rows from .values() encoded with orjson (current path). Reports rows/sec and the peak memory allocated by each path.
+# Usage: python -m benchmarks.product_listing [--products 20000] [--rounds 3]
+import argparse
+import asyncio
+import json
+import time
+import tracemalloc
+
+from benchmarks.common import close_db, init_db, report, seed_catalog
+
+
+async def pydantic_path() -> bytes:
+    from images import image_url
+    from models import AllProductsResponse, Product, ProductListItem, product_pydantic
+
+    products = await product_pydantic.from_queryset(Product.all().order_by("id"))
+    items = [ProductListItem(**product.model_dump(), image_url=image_url(product.image)) for product in products]
+    return AllProductsResponse(status="ok", products=items, next_cursor=None).model_dump_json().encode()
+
+
+async def values_path() -> bytes:
+    from images import image_url
+    from models import PRODUCT_FIELDS, Product
+    from serializers import dumps
+
+    rows = await Product.all().order_by("id").values(*PRODUCT_FIELDS)
+    for row in rows:
+        row["image_url"] = image_url(row["image"])
+    return dumps({"status": "ok", "products": rows, "next_cursor": None})
+
+
+async def measure(path, products: int, rounds: int) -> dict:
+    timings = []
+    for _ in range(rounds):
+        start = time.perf_counter()
+        body = await path()
+        timings.append(time.perf_counter() - start)
+    tracemalloc.start()
+    await path()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    best = min(timings)
+    return {
+        "best_seconds": round(best, 4),
+        "rows_per_second": round(products / best),
+        "peak_memory_mb": round(peak / (1024 * 1024), 1),
+        "body_bytes": len(body),
+    }, body
+
+
+async def main(args):
+    await init_db()
+    await seed_catalog(args.products)
+    before, before_body = await measure(pydantic_path, args.products, args.rounds)
+    after, after_body = await measure(values_path, args.products, args.rounds)
+    await close_db()
+    # both paths must produce the same document
+    assert json.loads(before_body) == json.loads(after_body), "the listing paths produce different responses"
+    report({
+        "products": args.products,
+        "pydantic": before,
+        "values_orjson": after,
+        "speedup": round(before["best_seconds"] / after["best_seconds"], 2),
+    })
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Product listing serialization benchmark")
+    parser.add_argument("--products", type=int, default=20000)
+    parser.add_argument("--rounds", type=int, default=3)
+    asyncio.run(main(parser.parse_args()))
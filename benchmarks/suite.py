@@ -0,0 +1,200 @@
+# Load test suite of the hot paths: GET /products/, GET /products/{id}, GET /categories/, POST /token and
+# POST /registration at a fixed concurrency, against catalogs of 1k, 100k and 1M products in SQLite.
+# Each catalog size runs in its own process, so the peak RSS and the in-process caches of one size do not leak into
+# the next one. The results are written as JSON, and --compare checks them against a previous run:
+#     python -m benchmarks.suite --output baseline.json
+#     python -m benchmarks.suite --output current.json --compare baseline.json
+#     python -m benchmarks.suite --compare baseline.json current.json
+# The exit status is 1 when a scenario regressed by more than --tolerance.
+import argparse
+import asyncio
+import json
+import logging
+import os
+import platform
+import random
+import subprocess
+import sys
+import time
+
+# the verification emails of /registration must fail fast instead of reaching a real server
+os.environ.setdefault("MAIL_SERVER", "127.0.0.1")
+os.environ.setdefault("MAIL_PORT", "9")
+os.environ.setdefault("MAIL_SSL_TLS", "false")
+os.environ.setdefault("MAIL_MAX_RETRIES", "0")
+
+from benchmarks.common import client, close_db, create_user, init_db, peak_rss_mb, run_load, seed_catalog, summarize
+
+DEFAULT_SIZES = (1000, 100000, 1000000)
+PASSWORD = "benchmark-password"
+
+# Metrics compared by --compare and whether a higher value is better
+COMPARED_METRICS = {"throughput_rps": True, "p50_ms": False, "p95_ms": False, "p99_ms": False}
+
+
+# Requests of each scenario, built from `rng` so every run sends the same sequence
+def scenarios(products: int, rng: random.Random, run_id: str) -> dict:
+    return {
+        "list_products": lambda http, i: http.get("/products/", params={"cursor": rng.randrange(products),
+                                                                         "limit": 50}),
+        "get_product": lambda http, i: http.get(f"/products/{rng.randrange(1, products + 1)}"),
+        "list_categories": lambda http, i: http.get("/categories/"),
+        "token": lambda http, i: http.post("/token", data={"username": "benchmark", "password": PASSWORD}),
+        "registration": lambda http, i: http.post("/registration", json={
+            "username": f"b{run_id}{i}", "email": f"b{run_id}{i}@example.com", "password": PASSWORD}),
+    }
+
+
+# Scenarios that hash passwords (bcrypt) run fewer requests
+AUTH_SCENARIOS = {"token", "registration"}
+
+
+# Run every scenario against one catalog size, in this process
+async def run_size(args) -> dict:
+    from emails import mail_queue
+    from main import app
+    from metrics import query_budget
+
+    # nothing listens on MAIL_PORT, every verification email fails
+    logging.getLogger("emails").setLevel(logging.CRITICAL)
+    rng = random.Random(args.seed)
+    await init_db()
+    start = time.perf_counter()
+    await seed_catalog(args.size)
+    seed_seconds = time.perf_counter() - start
+    await create_user("benchmark", PASSWORD)
+    results = {}
+    async with client(app) as http:
+        for name, send in scenarios(args.size, rng, str(args.seed)).items():
+            if args.scenarios and name not in args.scenarios:
+                continue
+            requests = args.auth_requests if name in AUTH_SCENARIOS else args.requests
+            await run_load(lambda i: send(http, -1 - i), min(args.warmup, requests), args.concurrency)
+            failures = []
+
+            async def checked(i):
+                response = await send(http, i)
+                if response.status_code >= 400:
+                    failures.append(response.status_code)
+                return response
+
+            # the outer collector sees the queries of every request of the scenario
+            async with query_budget(sys.maxsize) as stats:
+                start = time.perf_counter()
+                latencies = await run_load(checked, requests, args.concurrency)
+                elapsed = time.perf_counter() - start
+            results[name] = {**summarize(latencies, elapsed), "errors": len(failures),
+                             "queries_per_request": round(stats.queries / requests, 2)}
+    await mail_queue.stop(timeout=1)
+    await close_db()
+    return {"products": args.size, "seed_seconds": round(seed_seconds, 2), "peak_rss_mb": peak_rss_mb(),
+            "scenarios": results}
+
+
+# Run each size in a child process and collect their results
+def run_suite(args) -> dict:
+    sizes = {}
+    for size in args.sizes:
+        command = [sys.executable, "-m", "benchmarks.suite", "--size", str(size), "--seed", str(args.seed),
+                   "--concurrency", str(args.concurrency), "--requests", str(args.requests),
+                   "--auth-requests", str(args.auth_requests), "--warmup", str(args.warmup)]
+        if args.scenarios:
+            command += ["--scenarios", *args.scenarios]
+        print(f"Running {size} products...", file=sys.stderr)
+        completed = subprocess.run(command, stdout=subprocess.PIPE, check=True, text=True)
+        sizes[str(size)] = json.loads(completed.stdout.splitlines()[-1])
+    return {
+        "meta": {
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+            "commit": git_commit(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpus": os.cpu_count(),
+            "seed": args.seed,
+            "concurrency": args.concurrency,
+            "requests": args.requests,
+            "auth_requests": args.auth_requests,
+        },
+        "results": sizes,
+    }
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], stdout=subprocess.PIPE,
+                              stderr=subprocess.DEVNULL, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+# Compare two suite results, returning one entry per compared metric with its relative change (positive is worse)
+def compare(baseline: dict, current: dict, tolerance: float) -> list:
+    rows = []
+    for size, result in current["results"].items():
+        previous = baseline["results"].get(size)
+        if previous is None:
+            continue
+        metrics = [(name, scenario, metric, higher_is_better)
+                   for name, scenario in result["scenarios"].items()
+                   for metric, higher_is_better in COMPARED_METRICS.items()]
+        metrics.append(("process", result, "peak_rss_mb", False))
+        for name, values, metric, higher_is_better in metrics:
+            before = previous if name == "process" else previous["scenarios"].get(name)
+            if not before or not before.get(metric) or values.get(metric) is None:
+                continue
+            change = (values[metric] - before[metric]) / before[metric]
+            if higher_is_better:
+                change = -change
+            rows.append({"products": int(size), "scenario": name, "metric": metric, "baseline": before[metric],
+                         "current": values[metric], "change": round(change, 3), "regression": change > tolerance})
+    return rows
+
+
+def print_comparison(rows: list):
+    for row in rows:
+        flag = "REGRESSION" if row["regression"] else ""
+        print(f"{row['products']:>8} {row['scenario']:<16} {row['metric']:<15} {row['baseline']:>10} -> "
+              f"{row['current']:<10} {row['change']:+.1%} {flag}", file=sys.stderr)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load test suite of the hot paths")
+    parser.add_argument("--sizes", type=int, nargs="+", default=list(DEFAULT_SIZES), help="catalog sizes")
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--requests", type=int, default=2000, help="requests per catalog scenario")
+    parser.add_argument("--auth-requests", type=int, default=100, help="requests per /token and /registration")
+    parser.add_argument("--warmup", type=int, default=50, help="requests sent before measuring each scenario")
+    parser.add_argument("--scenarios", nargs="+", help="run only these scenarios")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--output", help="write the results to this file instead of stdout")
+    parser.add_argument("--compare", nargs="+", metavar="RESULTS",
+                        help="baseline results (and current results, instead of running the suite)")
+    parser.add_argument("--tolerance", type=float, default=0.10, help="relative change allowed before failing")
+    parser.add_argument("--size", type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.size is not None:
+        # child process: one catalog size, the result is the last line of stdout
+        print(json.dumps(asyncio.run(run_size(args))))
+        return
+    if args.compare and len(args.compare) == 2:
+        with open(args.compare[1]) as file:
+            results = json.load(file)
+    else:
+        results = run_suite(args)
+        if args.output:
+            with open(args.output, "w") as file:
+                json.dump(results, file, indent=2)
+        else:
+            print(json.dumps(results, indent=2))
+    if args.compare:
+        with open(args.compare[0]) as file:
+            baseline = json.load(file)
+        rows = compare(baseline, results, args.tolerance)
+        print_comparison(rows)
+        if any(row["regression"] for row in rows):
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
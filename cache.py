@@ -0,0 +1,187 @@
+from collections import OrderedDict
+from datetime import datetime, timezone
+from email.utils import format_datetime, parsedate_to_datetime
+from typing import Any, Awaitable, Callable, Hashable, Optional
+from fastapi import Request, status
+from fastapi.responses import Response
+from content_encoding import COMPRESSION_MIN_SIZE, compressors, negotiate
+from config import setting
+import asyncio
+import hashlib
+import time
+
+
+# In-process cache with a bounded size, a TTL per entry and LRU eviction.
+# Each worker keeps its own copy, so entries written by another worker are only seen once the TTL expires.
+# Every invalidation bumps `generation`: a load reads it before querying the database and passes it to set(), which
+# drops the value if an invalidation happened in between (the value may predate the write).
+class TTLCache:
+    def __init__(self, name: str, max_size: int = 1024, ttl: float = 60.0):
+        self.name = name
+        self.max_size = max_size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.stale_sets = 0
+        self.generation = 0
+        # key -> (expiration time, value), ordered from least to most recently used
+        self._entries = OrderedDict()
+
+    def get(self, key: Hashable) -> Optional[Any]:
+        entry = self._entries.get(key)
+        if entry is None or entry[0] <= time.monotonic():
+            if entry is not None:
+                del self._entries[key]
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return entry[1]
+
+    def set(self, key: Hashable, value: Any, ttl: Optional[float] = None, generation: Optional[int] = None):
+        if generation is not None and generation != self.generation:
+            self.stale_sets += 1
+            return
+        ttl = self.ttl if ttl is None else ttl
+        self._entries[key] = (time.monotonic() + ttl, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def delete(self, key: Hashable):
+        self.generation += 1
+        self._entries.pop(key, None)
+
+    def clear(self):
+        self.generation += 1
+        self._entries.clear()
+
+    def stats(self) -> dict:
+        return {
+            "size": len(self._entries),
+            "max_size": self.max_size,
+            "ttl": self.ttl,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "stale_sets": self.stale_sets,
+        }
+
+
+# Catalog caches, they store the already serialized JSON bodies
+product_cache = TTLCache("product", max_size=int(setting("PRODUCT_CACHE_SIZE", 4096)),
+                         ttl=float(setting("CATALOG_CACHE_TTL", 30)))
+product_list_cache = TTLCache("product_list", max_size=int(setting("PRODUCT_LIST_CACHE_SIZE", 512)),
+                              ttl=float(setting("CATALOG_CACHE_TTL", 30)))
+category_list_cache = TTLCache("category_list", max_size=16, ttl=float(setting("CATALOG_CACHE_TTL", 30)))
+
+# Users resolved from verified tokens, keyed by user id. The TTL bounds how long the other workers keep a user that
+# changed.
+user_cache = TTLCache("user", max_size=int(setting("USER_CACHE_SIZE", 4096)),
+                      ttl=float(setting("USER_CACHE_TTL", 30)))
+
+caches = [product_cache, product_list_cache, category_list_cache, user_cache]
+
+
+# Coalesce concurrent calls with the same key: the first caller runs the load and the others wait for its result
+# instead of sending the same query to the database (singleflight)
+class SingleFlight:
+    def __init__(self, name: str):
+        self.name = name
+        self.calls = 0
+        self.coalesced = 0
+        self._in_flight = {}
+
+    async def do(self, key: Hashable, load: Callable[[], Awaitable[Any]]) -> Any:
+        self.calls += 1
+        task = self._in_flight.get(key)
+        if task is None:
+            task = asyncio.ensure_future(load())
+            self._in_flight[key] = task
+            task.add_done_callback(lambda _: self._in_flight.pop(key, None))
+        else:
+            self.coalesced += 1
+        # a cancelled caller must not cancel the load the other callers are waiting for
+        return await asyncio.shield(task)
+
+    def stats(self) -> dict:
+        return {"calls": self.calls, "coalesced": self.coalesced, "in_flight": len(self._in_flight)}
+
+
+# Product lookups that missed the cache
+product_flight = SingleFlight("product")
+
+
+# A serialized JSON body together with its validators (no last_modified for collections) and its compressed variants.
+# The ETag is a hash of the body, so every worker computes the same one for the same content. Each content coding
+# gets its own ETag ("<hash>-gzip"), the compressed bytes are different representations.
+class CachedResponse:
+    def __init__(self, body: bytes, last_modified: Optional[datetime] = None):
+        self.body = body
+        self.digest = hashlib.blake2b(body, digest_size=16).hexdigest()
+        self.etag = '"' + self.digest + '"'
+        self.last_modified = _as_utc(last_modified).replace(microsecond=0) if last_modified else None
+        # content coding -> compressed body, filled on the first request asking for it
+        self._encoded = {}
+
+    # Content coding to send the body with for an Accept-Encoding header, None for the body as it is
+    def negotiate(self, accept_encoding: Optional[str]) -> Optional[str]:
+        if len(self.body) < COMPRESSION_MIN_SIZE:
+            return None
+        return negotiate(accept_encoding)
+
+    # Body compressed with `encoding`, compressed once per cached entry
+    def encoded(self, encoding: Optional[str]) -> bytes:
+        if encoding is None:
+            return self.body
+        body = self._encoded.get(encoding)
+        if body is None:
+            body = self._encoded[encoding] = compressors[encoding](self.body)
+        return body
+
+    def headers(self, encoding: Optional[str] = None) -> dict:
+        headers = {"ETag": self.etag if encoding is None else f'"{self.digest}-{encoding}"',
+                   "Cache-Control": "no-cache", "Vary": "Accept-Encoding"}
+        if encoding is not None:
+            headers["Content-Encoding"] = encoding
+        if self.last_modified:
+            headers["Last-Modified"] = format_datetime(self.last_modified, usegmt=True)
+        return headers
+
+
+def _as_utc(value: datetime) -> datetime:
+    if value.tzinfo is None:
+        return value.replace(tzinfo=timezone.utc)
+    return value.astimezone(timezone.utc)
+
+
+# If-None-Match takes precedence over If-Modified-Since (RFC 9110). Only the single resources have a Last-Modified:
+# deleting a row of a collection does not change the newest updated_at of the others, collections are validated by
+# their ETag only.
+def is_not_modified(request: Request, entry: CachedResponse) -> bool:
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match is not None:
+        # any coding of the same body matches, the client can decode the one it already has
+        tags = [tag.strip().removeprefix("W/").strip('"').split("-")[0] for tag in if_none_match.split(",")]
+        return "*" in tags or entry.digest in tags
+    if_modified_since = request.headers.get("if-modified-since")
+    if if_modified_since and entry.last_modified:
+        try:
+            since = _as_utc(parsedate_to_datetime(if_modified_since))
+        except (TypeError, ValueError):
+            return False
+        return entry.last_modified <= since
+    return False
+
+
+# Build the response for a cached payload, answering conditional requests with an empty 304. The body is sent in the
+# content coding negotiated from Accept-Encoding, already compressed so CompressionMiddleware leaves it as it is.
+def cached_response(request: Request, entry: CachedResponse) -> Response:
+    encoding = entry.negotiate(request.headers.get("accept-encoding"))
+    headers = entry.headers(encoding)
+    if is_not_modified(request, entry):
+        headers.pop("Content-Encoding", None)
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
+    return Response(content=entry.encoded(encoding), media_type="application/json", headers=headers)
@@ -0,0 +1,25 @@
+from typing import Any
+from dotenv import dotenv_values
+import os
+
+# .env is read once per process, every module gets its settings from here
+_dotenv = dotenv_values(".env")
+
+
+# Settings come from the environment first, then from .env, then `default` (returned as it is, not as a string)
+def setting(name: str, default: Any = None) -> Any:
+    return os.getenv(name, _dotenv.get(name, default))
+
+
+credentials = {
+    "EMAIL": setting("EMAIL"),
+    "PASSWORD": setting("PASSWORD"),
+    "SECRET": setting("SECRET"),
+    "SERVER_URL": setting("SERVER_URL"),
+}
+
+ENVIRONMENT = setting("ENVIRONMENT", "development")
+# Fast start for serverless cold starts (on by default on Vercel): no schema generation, search backend detection or
+# background jobs on startup. The heavy modules (Pillow, passlib/bcrypt, PyJWT, Jinja2, aiosmtplib) are imported by
+# the first request that needs them whatever the mode.
+FAST_START = setting("FAST_START", str(bool(os.getenv("VERCEL")))).lower() == "true"
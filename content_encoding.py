@@ -0,0 +1,164 @@
+from typing import Callable, Dict, Optional
+from config import setting
+import gzip
+import zlib
+
+# brotli and zstandard are optional, the encodings whose module is missing are not offered
+try:
+    import brotli
+except ImportError:
+    brotli = None
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# Bodies smaller than this are sent as they are, compressing them saves less than the headers it adds
+COMPRESSION_MIN_SIZE = int(setting("COMPRESSION_MIN_SIZE", 1024))
+GZIP_LEVEL = int(setting("GZIP_LEVEL", 6))
+BROTLI_QUALITY = int(setting("BROTLI_QUALITY", 5))
+ZSTD_LEVEL = int(setting("ZSTD_LEVEL", 3))
+
+# Media types worth compressing, the images are already compressed
+COMPRESSIBLE_TYPES = ("application/json", "application/x-ndjson", "application/javascript", "text/", "image/svg+xml")
+
+
+# One-shot compressors, by content coding
+def _compressors() -> Dict[str, Callable[[bytes], bytes]]:
+    compressors = {}
+    if brotli is not None:
+        compressors["br"] = lambda body: brotli.compress(body, quality=BROTLI_QUALITY)
+    if zstandard is not None:
+        compressors["zstd"] = lambda body: zstandard.ZstdCompressor(level=ZSTD_LEVEL).compress(body)
+    compressors["gzip"] = lambda body: gzip.compress(body, compresslevel=GZIP_LEVEL, mtime=0)
+    return compressors
+
+
+# In order of preference when the client accepts several of them with the same weight
+compressors = _compressors()
+
+
+# Streaming compressor with the same interface for every coding. Each chunk is flushed, so a streamed response (e.g.
+# the progress lines of the bulk import) reaches the client as it is produced instead of waiting for a full block.
+class StreamCompressor:
+    def __init__(self, encoding: str):
+        if encoding == "br":
+            compressor = brotli.Compressor(quality=BROTLI_QUALITY)
+            self._compress, self._flush, self._finish = compressor.process, compressor.flush, compressor.finish
+        elif encoding == "zstd":
+            compressor = zstandard.ZstdCompressor(level=ZSTD_LEVEL).compressobj()
+            self._compress, self._finish = compressor.compress, compressor.flush
+            self._flush = lambda: compressor.flush(zstandard.COMPRESSOBJ_FLUSH_BLOCK)
+        else:
+            compressor = zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, 31)
+            self._compress, self._finish = compressor.compress, compressor.flush
+            self._flush = lambda: compressor.flush(zlib.Z_SYNC_FLUSH)
+
+    def compress(self, chunk: bytes) -> bytes:
+        return self._compress(chunk) + self._flush()
+
+    def finish(self) -> bytes:
+        return self._finish()
+
+
+# Content coding to answer with for an Accept-Encoding header: the one with the highest q-value among the supported
+# ones, ties broken by the order of `compressors`. None when no compression is acceptable.
+def negotiate(accept_encoding: Optional[str]) -> Optional[str]:
+    if not accept_encoding:
+        return None
+    weights = {}
+    for item in accept_encoding.split(","):
+        coding, _, parameters = item.strip().partition(";")
+        weight = 1.0
+        for parameter in parameters.split(";"):
+            name, _, value = parameter.strip().partition("=")
+            if name.strip() == "q":
+                try:
+                    weight = float(value)
+                except ValueError:
+                    weight = 0.0
+        weights[coding.strip().lower()] = weight
+    best, best_weight = None, 0.0
+    for encoding in compressors:
+        weight = weights.get(encoding, weights.get("*", 0.0))
+        if weight > best_weight:
+            best, best_weight = encoding, weight
+    return best
+
+
+def is_compressible(content_type: str) -> bool:
+    return content_type.startswith(COMPRESSIBLE_TYPES)
+
+
+# ASGI middleware compressing the responses with the coding negotiated from Accept-Encoding. Responses that already
+# have a Content-Encoding (e.g. the precompressed catalog payloads), are not compressible or are smaller than
+# COMPRESSION_MIN_SIZE are sent as they are. Streamed bodies are compressed chunk by chunk.
+class CompressionMiddleware:
+    def __init__(self, app, minimum_size: int = COMPRESSION_MIN_SIZE):
+        self.app = app
+        self.minimum_size = minimum_size
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        headers = dict((name.lower(), value) for name, value in scope["headers"])
+        encoding = negotiate(headers.get(b"accept-encoding", b"").decode("latin-1"))
+        if encoding is None:
+            return await self.app(scope, receive, send)
+        await self.app(scope, receive, _CompressingSend(send, encoding, self.minimum_size))
+
+
+class _CompressingSend:
+    def __init__(self, send, encoding: str, minimum_size: int):
+        self.send = send
+        self.encoding = encoding
+        self.minimum_size = minimum_size
+        self.start = None
+        self.compressor: Optional[StreamCompressor] = None
+        # set once the response is known to go out as it is
+        self.passthrough = False
+
+    async def __call__(self, message):
+        if message["type"] == "http.response.start":
+            headers = dict((name.lower(), value) for name, value in message.get("headers", []))
+            content_type = headers.get(b"content-type", b"").decode("latin-1")
+            self.passthrough = b"content-encoding" in headers or not is_compressible(content_type)
+            if self.passthrough:
+                await self.send(message)
+            else:
+                # held until the first body chunk tells whether the body is large enough
+                self.start = message
+            return
+        if self.passthrough:
+            return await self.send(message)
+        if message["type"] != "http.response.body":
+            # a file sent by the server (zerocopysend / pathsend) cannot be compressed here
+            self.passthrough = True
+            if self.start is not None:
+                await self.send(self.start)
+                self.start = None
+            return await self.send(message)
+
+        body = message.get("body", b"")
+        more_body = message.get("more_body", False)
+        if self.start is not None:
+            start, self.start = self.start, None
+            if not more_body and len(body) < self.minimum_size:
+                self.passthrough = True
+                await self.send(start)
+                return await self.send(message)
+            headers = [(name, value) for name, value in start.get("headers", [])
+                       if name.lower() not in (b"content-length", b"vary")]
+            headers += [(b"content-encoding", self.encoding.encode()), (b"vary", b"Accept-Encoding")]
+            if not more_body:
+                # the whole body is here, compress it in one go
+                body = compressors[self.encoding](body)
+                headers.append((b"content-length", str(len(body)).encode()))
+                await self.send({**start, "headers": headers})
+                return await self.send({**message, "body": body})
+            self.compressor = StreamCompressor(self.encoding)
+            await self.send({**start, "headers": headers})
+        body = self.compressor.compress(body) if body else b""
+        if not more_body:
+            body += self.compressor.finish()
+        await self.send({"type": "http.response.body", "body": body, "more_body": more_body})
@@ -0,0 +1,82 @@
+from typing import List, Optional
+from tortoise import Tortoise
+from tortoise.backends.base.config_generator import expand_db_url
+from tortoise.exceptions import ConfigurationError
+from config import setting, ENVIRONMENT, FAST_START
+
+DB_URL = setting("POSTGRES_URL")
+
+# Connection pool of each worker. Every worker opens up to DB_POOL_MAX_SIZE connections, so workers (of every
+# instance) * DB_POOL_MAX_SIZE has to stay below the max_connections of the server.
+DB_POOL_MIN_SIZE = int(setting("DB_POOL_MIN_SIZE", "1"))
+DB_POOL_MAX_SIZE = int(setting("DB_POOL_MAX_SIZE", "10"))
+# Seconds to wait for a new connection to be established
+DB_CONNECT_TIMEOUT = float(setting("DB_CONNECT_TIMEOUT", "10"))
+# Statements running longer than this are cancelled by the server (0 disables it). On MySQL it only applies to SELECT.
+DB_STATEMENT_TIMEOUT_MS = int(setting("DB_STATEMENT_TIMEOUT_MS", "30000"))
+# Prepared statements cached per connection by asyncpg. Set it to 0 behind PgBouncer in transaction mode.
+DB_STATEMENT_CACHE_SIZE = int(setting("DB_STATEMENT_CACHE_SIZE", "100"))
+# Connections are replaced after this many queries (asyncpg), and after DB_MAX_IDLE_SECONDS idle (asyncpg) or since
+# they were opened (MySQL)
+DB_MAX_QUERIES = int(setting("DB_MAX_QUERIES", "50000"))
+DB_MAX_IDLE_SECONDS = float(setting("DB_MAX_IDLE_SECONDS", "300"))
+# Read replicas, comma separated URLs. Each one gets a connection named replica_1, replica_2... with the same pool
+# settings as the primary.
+DB_REPLICA_URLS = [url.strip() for url in setting("DB_REPLICA_URLS", "").split(",") if url.strip()]
+# Replicas lagging more than this (in seconds) behind the primary are left out of the reads until they catch up.
+# It is also how long the reads of a worker stay on the primary after it writes, so they see their own writes.
+DB_REPLICA_MAX_LAG = float(setting("DB_REPLICA_MAX_LAG", "5"))
+# Seconds between two measures of the replication lag
+DB_REPLICA_CHECK_INTERVAL = float(setting("DB_REPLICA_CHECK_INTERVAL", "5"))
+# Creating the tables on startup is for development, production (and serverless) databases are brought up
+# to date with python migrations.py
+GENERATE_SCHEMAS = setting("GENERATE_SCHEMAS", str(ENVIRONMENT != "production" and not FAST_START)).lower() == "true"
+
+
+# Tortoise configuration for `db_url` (the "default" connection, the primary) and the `replica_urls`, with the pool
+# and timeout settings of their backend. Parameters given in the query string of the URLs take precedence.
+def tortoise_config(db_url: Optional[str] = DB_URL, replica_urls: List[str] = DB_REPLICA_URLS) -> dict:
+    if not db_url:
+        raise ConfigurationError("POSTGRES_URL is not set")
+    connections = {"default": connection_config(db_url)}
+    for position, replica_url in enumerate(replica_urls, start=1):
+        connections[f"replica_{position}"] = connection_config(replica_url)
+    return {
+        "connections": connections,
+        # the models live on the primary, generate_schemas only creates tables there
+        "apps": {"models": {"models": ["models"], "default_connection": "default"}},
+    }
+
+
+def connection_config(db_url: str) -> dict:
+    connection = expand_db_url(db_url)
+    options = connection["credentials"]
+    if connection["engine"] == "tortoise.backends.asyncpg":
+        for name, value in (("minsize", DB_POOL_MIN_SIZE), ("maxsize", DB_POOL_MAX_SIZE),
+                            ("timeout", DB_CONNECT_TIMEOUT), ("statement_cache_size", DB_STATEMENT_CACHE_SIZE),
+                            ("max_queries", DB_MAX_QUERIES), ("max_inactive_connection_lifetime", DB_MAX_IDLE_SECONDS)):
+            options.setdefault(name, value)
+        if DB_STATEMENT_TIMEOUT_MS:
+            options.setdefault("server_settings", {"statement_timeout": str(DB_STATEMENT_TIMEOUT_MS)})
+    elif connection["engine"] == "tortoise.backends.mysql":
+        for name, value in (("minsize", DB_POOL_MIN_SIZE), ("maxsize", DB_POOL_MAX_SIZE),
+                            ("connect_timeout", DB_CONNECT_TIMEOUT), ("pool_recycle", int(DB_MAX_IDLE_SECONDS))):
+            options.setdefault(name, value)
+        if DB_STATEMENT_TIMEOUT_MS:
+            options.setdefault("init_command", f"SET SESSION max_execution_time={DB_STATEMENT_TIMEOUT_MS}")
+    return connection
+
+
+# Connections of the pool of `connection_name`, None for the backends without pool (SQLite)
+def pool_stats(connection_name: str = "default") -> Optional[dict]:
+    pool = getattr(Tortoise.get_connection(connection_name), "_pool", None)
+    if pool is None:
+        return None
+    if hasattr(pool, "get_size"):
+        # asyncpg
+        size, idle, max_size = pool.get_size(), pool.get_idle_size(), pool.get_max_size()
+    else:
+        # asyncmy / aiomysql
+        size, idle, max_size = pool.size, pool.freesize, pool.maxsize
+    return {"size": size, "idle": idle, "in_use": size - idle, "max_size": max_size,
+            "saturation": round((size - idle) / max_size, 3) if max_size else 0.0}
@@ -1,11 +1,18 @@
-from fastapi_mail import FastMail, MessageSchema, ConnectionConfig
-from dotenv import dotenv_values
-from typing import List
+from email.message import Message
+from email.mime.text import MIMEText
+from markupsafe import escape
+from typing import TYPE_CHECKING, Iterable, List, Optional
 from models import User
-import jwt
-import os
+from config import credentials, setting
+import functools
+import asyncio
+import logging
 
-credentials = dotenv_values(".env")
+# aiosmtplib, Jinja2 and PyJWT are imported when the first email is sent, not on startup
+if TYPE_CHECKING:
+    import aiosmtplib
+
+logger = logging.getLogger(__name__)
 
 #credentials = {
     #"EMAIL": os.getenv("EMAIL"),
@@ -14,50 +21,226 @@ credentials = dotenv_values(".env")
     #"SERVER_URL": os.getenv("SERVER_URL"),
 #}
 
-config = ConnectionConfig(
-    MAIL_USERNAME=credentials["EMAIL"],
-    MAIL_PASSWORD=credentials["PASSWORD"],
-    MAIL_FROM=credentials["EMAIL"],
-    MAIL_PORT=465,
-    MAIL_SERVER="smtp.gmail.com",
-    MAIL_STARTTLS=False,
-    MAIL_SSL_TLS=True,
-    USE_CREDENTIALS=True,
-    VALIDATE_CERTS=True
+config = {
+    "MAIL_USERNAME": credentials["EMAIL"],
+    "MAIL_PASSWORD": credentials["PASSWORD"],
+    "MAIL_FROM": credentials["EMAIL"],
+    "MAIL_SERVER": setting("MAIL_SERVER", "smtp.gmail.com"),
+    "MAIL_PORT": int(setting("MAIL_PORT", 465)),
+    "MAIL_SSL_TLS": setting("MAIL_SSL_TLS", "true").lower() == "true",
+    "VALIDATE_CERTS": setting("MAIL_VALIDATE_CERTS", "true").lower() == "true",
+    "MAIL_WORKERS": int(setting("MAIL_WORKERS", 2)),
+    "MAIL_MAX_BACKLOG": int(setting("MAIL_MAX_BACKLOG", 1000)),
+    "MAIL_MAX_RETRIES": int(setting("MAIL_MAX_RETRIES", 3)),
+}
+
+
+# Outbound mail queue.
+# Messages are queued in memory (up to max_backlog) and delivered by a pool of workers. Each worker keeps its SMTP
+# session open and reuses it for the following messages until it has been idle for idle_timeout seconds. Transient
+# failures (network errors, 4xx replies) are retried with exponential backoff on a fresh connection; permanent ones
+# (5xx replies, invalid messages) are counted as failed right away and the worker moves on to the next message.
+class MailQueue:
+    def __init__(self, hostname: str, port: int, username: Optional[str] = None, password: Optional[str] = None,
+                 sender: Optional[str] = None, use_tls: bool = True, validate_certs: bool = True, workers: int = 2,
+                 max_backlog: int = 1000, max_retries: int = 3, retry_delay: float = 1.0, idle_timeout: float = 30.0):
+        self.hostname = hostname
+        self.port = port
+        self.username = username
+        self.password = password
+        self.sender = sender or username
+        self.use_tls = use_tls
+        self.validate_certs = validate_certs
+        self.workers = workers
+        self.max_backlog = max_backlog
+        self.max_retries = max_retries
+        self.retry_delay = retry_delay
+        self.idle_timeout = idle_timeout
+        self.sent = 0
+        self.failed = 0
+        self.dropped = 0
+        self._queue: Optional[asyncio.Queue] = None
+        self._tasks: List[asyncio.Task] = []
+
+    async def start(self):
+        if self._queue is None:
+            self._queue = asyncio.Queue(maxsize=self.max_backlog)
+            self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+
+    # Wait up to `timeout` seconds for the backlog to be delivered, then stop the workers
+    async def stop(self, timeout: float = 10.0):
+        if self._queue is None:
+            return
+        try:
+            await asyncio.wait_for(self._queue.join(), timeout)
+        except asyncio.TimeoutError:
+            logger.warning("Mail queue stopped with %d undelivered messages", self._queue.qsize())
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        self._queue = None
+
+    # Queue a message without waiting for its delivery, returns False when the backlog is full
+    async def enqueue(self, message: Message) -> bool:
+        await self.start()
+        if not message["From"]:
+            message["From"] = self.sender
+        try:
+            self._queue.put_nowait(message)
+            return True
+        except asyncio.QueueFull:
+            self.dropped += 1
+            logger.error("Mail queue is full, dropping message to %s", message["To"])
+            return False
+
+    def stats(self) -> dict:
+        return {
+            "backlog": self._queue.qsize() if self._queue else 0,
+            "sent": self.sent,
+            "failed": self.failed,
+            "dropped": self.dropped,
+        }
+
+    async def _connect(self) -> "aiosmtplib.SMTP":
+        import aiosmtplib
+
+        smtp = aiosmtplib.SMTP(hostname=self.hostname, port=self.port, use_tls=self.use_tls,
+                               validate_certs=self.validate_certs)
+        await smtp.connect()
+        if self.username and self.password:
+            try:
+                await smtp.login(self.username, self.password)
+            except BaseException:
+                smtp.close()
+                raise
+        return smtp
+
+    async def _worker(self):
+        smtp = None
+        try:
+            while True:
+                try:
+                    message = await asyncio.wait_for(self._queue.get(), None if smtp is None else self.idle_timeout)
+                except asyncio.TimeoutError:
+                    # close idle sessions before the server drops them
+                    smtp = await self._close(smtp)
+                    continue
+                try:
+                    smtp = await self._deliver(smtp, message)
+                finally:
+                    self._queue.task_done()
+        finally:
+            await self._close(smtp)
+
+    async def _deliver(self, smtp: Optional["aiosmtplib.SMTP"], message: Message) -> Optional["aiosmtplib.SMTP"]:
+        import aiosmtplib
+
+        for attempt in range(self.max_retries + 1):
+            try:
+                if smtp is None:
+                    smtp = await self._connect()
+                await smtp.send_message(message)
+                self.sent += 1
+                return smtp
+            except Exception as e:
+                retry = isinstance(e, (aiosmtplib.SMTPException, OSError)) and not self._permanent(e)
+                # after a 5xx reply the envelope was reset and the session can be reused
+                if not self._permanent(e):
+                    smtp = await self._close(smtp)
+                if not retry or attempt == self.max_retries:
+                    self.failed += 1
+                    if isinstance(e, (aiosmtplib.SMTPException, OSError)):
+                        logger.error("Could not send email to %s: %s", message["To"], e)
+                    else:
+                        logger.exception("Could not send email to %s", message["To"])
+                    return smtp
+                await asyncio.sleep(self.retry_delay * 2 ** attempt)
+
+    # SMTP errors with a 5xx reply (unknown recipient, rejected message...) fail the same way on every attempt
+    @staticmethod
+    def _permanent(error: Exception) -> bool:
+        import aiosmtplib
+
+        if isinstance(error, aiosmtplib.SMTPRecipientsRefused):
+            return all(500 <= recipient.code < 600 for recipient in error.recipients)
+        return isinstance(error, aiosmtplib.SMTPResponseException) and 500 <= error.code < 600
+
+    @staticmethod
+    async def _close(smtp: Optional["aiosmtplib.SMTP"]) -> None:
+        if smtp is not None and smtp.is_connected:
+            try:
+                await smtp.quit()
+            except Exception:
+                smtp.close()
+        return None
+
 
+mail_queue = MailQueue(
+    hostname=config["MAIL_SERVER"],
+    port=config["MAIL_PORT"],
+    username=config["MAIL_USERNAME"],
+    password=config["MAIL_PASSWORD"],
+    sender=config["MAIL_FROM"],
+    use_tls=config["MAIL_SSL_TLS"],
+    validate_certs=config["VALIDATE_CERTS"],
+    workers=config["MAIL_WORKERS"],
+    max_backlog=config["MAIL_MAX_BACKLOG"],
+    max_retries=config["MAIL_MAX_RETRIES"],
 )
 
 
-async def send_email(email: List, instance: User):
+# Verification email template, compiled once by the first email. The bytecode cache lets later starts skip the
+# compilation.
+@functools.lru_cache(maxsize=None)
+def verification_template():
+    from jinja2 import Environment, FileSystemBytecodeCache, FileSystemLoader, select_autoescape
+
+    email_templates = Environment(loader=FileSystemLoader("templates"), bytecode_cache=FileSystemBytecodeCache(),
+                                  autoescape=select_autoescape(["html"]))
+    return email_templates.get_template("verification_email.html")
+
+# Placeholder used to render the verification email once per batch, see render_verification_emails
+_URL_PLACEHOLDER = "\x00verification_url\x00"
+
+
+def verification_token(instance: User) -> str:
+    import jwt
+
     token_data = {"id": instance.id, "username": instance.username}
-    token = jwt.encode(token_data, credentials["SECRET"], algorithm="HS256")
-    template = f"""
-                <!DOCTYPE html>                
-                <html>
-                    <head>
-                        
-                    </head> 
-                    <body> 
-                     <div style="display: flex; align-items: center; justify-content: center; flex-direction: column"> 
-                      <h3>Account Verification</h3> 
-                      </br> 
-                      <p>Thanks for choosing our shop. 
-                        Please click the link below to verify your account</p> 
-                      <a style="margin-top: 1rem; padding: 1rem; border-radius: 0.5rem; font-size: 1rem; 
-                      text-decoration: none; background: #0275d8; color: white;"
-                      href="{credentials["SERVER_URL"]}/verification/?token={token}">
-                        Verify your account
-                      </a> 
-                      <p>Please ignore this email if you did not register in our Shop. Thanks</p>
-                     </div> 
-                    </body> 
-                </html>
-                """
-    message = MessageSchema(
-        subject="Shop Account Verification Email",
-        recipients=email,  # List of recipients
-        body=template,
-        subtype="html"
-    )
-    fm = FastMail(config)
-    await fm.send_message(message=message)
+    return jwt.encode(token_data, credentials["SECRET"], algorithm="HS256")
+
+
+# Build the verification emails for many users.
+# The template is rendered a single time around a placeholder, and each message only splices in its own link.
+def render_verification_emails(users: Iterable[User]) -> List[Message]:
+    head, tail = verification_template().render(verification_url=_URL_PLACEHOLDER).split(_URL_PLACEHOLDER)
+    server_url = credentials["SERVER_URL"]
+    messages = []
+    for user in users:
+        url = f"{server_url}/verification/?token={verification_token(user)}"
+        messages.append(_verification_message([user.email], head + str(escape(url)) + tail))
+    return messages
+
+
+# MIMEText (compat32 policy) is much cheaper to build than EmailMessage, which parses every header it sets
+def _verification_message(email: List, body: str) -> Message:
+    message = MIMEText(body, "html", "utf-8")
+    message["Subject"] = "Shop Account Verification Email"
+    message["To"] = ", ".join(email)  # List of recipients
+    return message
+
+
+# Queue the verification email, it is delivered in the background by the mail queue
+async def send_email(email: List, instance: User):
+    url = f"{credentials['SERVER_URL']}/verification/?token={verification_token(instance)}"
+    message = _verification_message(email, verification_template().render(verification_url=url))
+    return await mail_queue.enqueue(message)
+
+
+# Queue the verification emails for many users (e.g. a re-verification campaign), returns how many were queued
+async def send_verification_emails(users: Iterable[User]) -> int:
+    queued = 0
+    for message in render_verification_emails(users):
+        queued += await mail_queue.enqueue(message)
+    return queued
@@ -0,0 +1,267 @@
+from concurrent.futures import ProcessPoolExecutor
+from typing import TYPE_CHECKING, Dict, Optional, Tuple
+from fastapi import HTTPException, UploadFile, status
+from tortoise.functions import Count
+from models import Product
+from config import setting
+import aiofiles
+import aiofiles.os
+import asyncio
+import hashlib
+import logging
+import tempfile
+import time
+import re
+import os
+
+# Pillow is imported by the image processing (in the worker processes) and the uploads, not on startup
+if TYPE_CHECKING:
+    from PIL import Image
+
+logger = logging.getLogger(__name__)
+
+IMAGES_DIR = "./static/images/"
+DERIVED_DIR = "./static/images/derived/"
+# Uploads are stored as the master copy of the image (fitted in this box), the variants are derived from it
+IMAGE_SIZE = (1600, 1600)
+MAX_UPLOAD_SIZE = int(setting("MAX_UPLOAD_SIZE", 5 * 1024 * 1024))
+CHUNK_SIZE = 64 * 1024
+
+# Accepted image formats (as detected by Pillow) and the extension used to store them
+ALLOWED_FORMATS = {"PNG": "png", "JPEG": "jpg"}
+
+# Image variants: name -> bounding box, ordered from the smallest to the largest
+VARIANTS = {"thumb": (64, 64), "small": (200, 200), "medium": (400, 400), "large": (800, 800)}
+# Output formats of the variants: extension -> (Pillow format, media type)
+VARIANT_FORMATS = {"webp": ("WEBP", "image/webp"), "jpg": ("JPEG", "image/jpeg"), "png": ("PNG", "image/png")}
+# Disk budget for the derived variants, the least recently used ones are removed when it is exceeded
+DERIVED_BUDGET = int(setting("DERIVED_IMAGES_BUDGET", 256 * 1024 * 1024))
+
+# Uploaded images are stored under the SHA-256 of the uploaded bytes, so the same picture is only stored once and the
+# content behind a name never changes
+STORED_NAME = re.compile(r"^[0-9a-f]{64}\.(" + "|".join(ALLOWED_FORMATS.values()) + r")$")
+# Orphaned images are removed every IMAGE_GC_INTERVAL seconds (0 disables it), once they are older than IMAGE_GC_GRACE
+# seconds so an upload is never removed before the row that references it is saved
+IMAGE_GC_INTERVAL = float(setting("IMAGE_GC_INTERVAL", 24 * 60 * 60))
+IMAGE_GC_GRACE = float(setting("IMAGE_GC_GRACE", 60 * 60))
+
+# Decoding, resizing and encoding are CPU bound, they run in worker processes so the event loop keeps serving requests
+image_executor = ProcessPoolExecutor(max_workers=int(setting("IMAGE_WORKERS", 2)))
+
+
+# Copy the upload to a temporary file in chunks, rejecting it as soon as it goes over MAX_UPLOAD_SIZE.
+# Returns the path of the temporary file and the SHA-256 of its content.
+async def save_upload(file: UploadFile, directory: Optional[str] = None) -> Tuple[str, str]:
+    if file.size is not None and file.size > MAX_UPLOAD_SIZE:
+        raise HTTPException(status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE, detail="File too large")
+    # next to the stored images by default, IMAGES_DIR is read on each call and not when the module is imported
+    descriptor, path = tempfile.mkstemp(dir=directory or IMAGES_DIR, suffix=".upload")
+    os.close(descriptor)
+    size = 0
+    digest = hashlib.sha256()
+    try:
+        async with aiofiles.open(path, "wb") as upload:
+            while chunk := await file.read(CHUNK_SIZE):
+                size += len(chunk)
+                if size > MAX_UPLOAD_SIZE:
+                    raise HTTPException(status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE, detail="File too large")
+                digest.update(chunk)
+                await upload.write(chunk)
+    except BaseException:
+        await aiofiles.os.remove(path)
+        raise
+    return path, digest.hexdigest()
+
+
+# Write an image to a temporary file next to `path` and move it in place, readers never see a partial file
+def _save_atomically(image: "Image.Image", path: str, image_format: str):
+    descriptor, temporary = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+    try:
+        with os.fdopen(descriptor, "wb") as output:
+            image.save(output, format=image_format)
+        # mkstemp creates the file readable by its owner only
+        os.chmod(temporary, 0o644)
+        os.replace(temporary, path)
+    except BaseException:
+        os.remove(temporary)
+        raise
+
+
+# Runs in a worker process: check the real image format, fit it in `size` and write the result atomically as
+# `digest`.<extension>. Returns the name of the stored file.
+def resize_image(source: str, directory: str, size: tuple, digest: str) -> str:
+    from PIL import Image
+
+    with Image.open(source) as image:
+        if image.format not in ALLOWED_FORMATS:
+            raise ValueError(f"Unsupported image format {image.format}")
+        image_format = image.format
+        image.thumbnail(size)
+        name = digest + "." + ALLOWED_FORMATS[image_format]
+        _save_atomically(image, os.path.join(directory, name), image_format)
+    return name
+
+
+# Name of the image already stored for `digest`, if any
+def find_stored_image(digest: str) -> Optional[str]:
+    for extension in ALLOWED_FORMATS.values():
+        name = digest + "." + extension
+        try:
+            # refresh the modification time so the garbage collector grace period starts again
+            os.utime(os.path.join(IMAGES_DIR, name))
+            return name
+        except FileNotFoundError:
+            continue
+    return None
+
+
+# Runs in a worker process: derive a variant of `source` fitted in `size` and encoded as `image_format`
+def derive_image(source: str, target: str, size: tuple, image_format: str):
+    from PIL import Image
+
+    with Image.open(source) as image:
+        # draft lets the JPEG decoder downscale while decoding
+        image.draft("RGB", size)
+        image.thumbnail(size)
+        if image_format == "JPEG" and image.mode not in ("RGB", "L"):
+            image = image.convert("RGB")
+        _save_atomically(image, target, image_format)
+
+
+# Store an uploaded image resized to IMAGE_SIZE and return its file name in IMAGES_DIR.
+# Uploading the same bytes again returns the stored image without processing it again.
+async def store_image(file: UploadFile) -> str:
+    from PIL import Image
+
+    upload, digest = await save_upload(file)
+    try:
+        name = find_stored_image(digest)
+        if name:
+            return name
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(image_executor, resize_image, upload, IMAGES_DIR, IMAGE_SIZE, digest)
+    except (ValueError, OSError, Image.DecompressionBombError):
+        # OSError includes PIL.UnidentifiedImageError
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Invalid file format")
+    finally:
+        await aiofiles.os.remove(upload)
+
+
+# Smallest variant at least `width` pixels wide, or the largest one
+def variant_for_width(width: int) -> str:
+    for name, size in VARIANTS.items():
+        if size[0] >= width:
+            return name
+    return name
+
+
+def variant_url(image_name: str, variant: str, image_format: str) -> str:
+    return f"/images/{variant}/{image_name}?format={image_format}"
+
+
+# URL of an image, of one of its variants when `variant` is given
+def image_url(image_name: str, variant: Optional[str] = None, image_format: str = "webp") -> str:
+    if variant:
+        return variant_url(image_name, variant, image_format)
+    return "/static/images/" + image_name
+
+
+def derived_path(image_name: str, variant: str, image_format: str) -> str:
+    return os.path.join(DERIVED_DIR, f"{variant}-{image_name}.{image_format}")
+
+
+# Return the path of a variant, deriving it on the first request and again when the source image changed. None if the
+# source image does not exist.
+async def get_variant(image_name: str, variant: str, image_format: str) -> Optional[str]:
+    # only plain file names from IMAGES_DIR can be derived
+    if os.path.basename(image_name) != image_name or image_name.startswith("."):
+        return None
+    source = os.path.join(IMAGES_DIR, image_name)
+    target = derived_path(image_name, variant, image_format)
+    try:
+        source_mtime = os.stat(source).st_mtime_ns
+    except (FileNotFoundError, NotADirectoryError):
+        return None
+    try:
+        # a variant older than its source was derived from an image that has been replaced since
+        if os.stat(target).st_mtime_ns >= source_mtime:
+            # refresh the modification time, it is what the eviction uses to find the least recently used variants
+            os.utime(target)
+            return target
+    except FileNotFoundError:
+        pass
+    os.makedirs(DERIVED_DIR, exist_ok=True)
+    loop = asyncio.get_running_loop()
+    await loop.run_in_executor(image_executor, derive_image, source, target, VARIANTS[variant],
+                               VARIANT_FORMATS[image_format][0])
+    await asyncio.to_thread(evict_derived, DERIVED_BUDGET)
+    return target
+
+
+# ETag of a variant, from the version of its source: the modification time of the derived file is refreshed on every
+# read for the eviction, it cannot identify the content
+def variant_etag(image_name: str, variant: str, image_format: str) -> str:
+    source = os.stat(os.path.join(IMAGES_DIR, image_name))
+    version = f"{source.st_mtime_ns}-{source.st_size}-{variant}-{image_format}".encode()
+    return '"' + hashlib.blake2b(version, digest_size=16).hexdigest() + '"'
+
+
+# Remove the least recently used derived variants until they fit in `budget` bytes
+def evict_derived(budget: int):
+    entries = [entry for entry in os.scandir(DERIVED_DIR) if entry.is_file() and not entry.name.endswith(".tmp")]
+    total = sum(entry.stat().st_size for entry in entries)
+    for entry in sorted(entries, key=lambda entry: entry.stat().st_mtime):
+        if total <= budget:
+            break
+        try:
+            os.remove(entry.path)
+        except FileNotFoundError:
+            continue
+        total -= entry.stat().st_size
+
+
+# Number of rows referencing each stored image, computed with one GROUP BY so it can never drift from the data.
+# Profile pictures (Business.logo) have to be added here when the businesses are enabled again.
+async def image_reference_counts() -> Dict[str, int]:
+    rows = await Product.annotate(references=Count("id")).group_by("image").values_list("image", "references")
+    return {image: references for image, references in rows}
+
+
+# Remove the stored images (and their derived variants) that no row references anymore, returns how many were removed
+async def collect_orphaned_images(grace: float = IMAGE_GC_GRACE) -> int:
+    references = await image_reference_counts()
+    threshold = time.time() - grace
+    removed = 0
+    for entry in await asyncio.to_thread(lambda: list(os.scandir(IMAGES_DIR))):
+        if not STORED_NAME.match(entry.name) or references.get(entry.name, 0) > 0:
+            continue
+        if entry.stat().st_mtime > threshold:
+            continue
+        await asyncio.to_thread(_remove_image, entry.name)
+        removed += 1
+    return removed
+
+
+def _remove_image(name: str):
+    try:
+        os.remove(os.path.join(IMAGES_DIR, name))
+    except FileNotFoundError:
+        pass
+    for variant in VARIANTS:
+        for image_format in VARIANT_FORMATS:
+            try:
+                os.remove(derived_path(name, variant, image_format))
+            except FileNotFoundError:
+                pass
+
+
+# Background job removing orphaned images every `interval` seconds
+async def image_gc_loop(interval: float = IMAGE_GC_INTERVAL):
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            removed = await collect_orphaned_images()
+            if removed:
+                logger.info("Removed %d orphaned images", removed)
+        except Exception:
+            logger.exception("Orphaned images collection failed")
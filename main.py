@@ -4,10 +4,8 @@
 from fastapi import FastAPI, Request, Depends
 
 # response classes
-from fastapi.responses import HTMLResponse
+from fastapi.responses import HTMLResponse, PlainTextResponse
 
-# templates
-from fastapi.templating import Jinja2Templates
 from starlette.responses import RedirectResponse
 from tortoise import Tortoise  # BaseDBAsyncClient
 from tortoise.contrib.fastapi import register_tortoise
@@ -21,14 +19,43 @@ from fastapi.security import OAuth2PasswordRequestForm, OAuth2PasswordBearer
 from fastapi.staticfiles import StaticFiles
 
 # Auxiliary functions
-# from emails import *
+from emails import send_email, mail_queue
 from models import *
 
 # routers
-from routers import products, categories  # users, uploadfile, businesses
+from routers import products, categories, images  # users, uploadfile, businesses
 
-# environment variables
-from dotenv import dotenv_values
+# catalog cache
+from cache import caches, product_flight
+
+# product search
+from search import prepare_search
+
+# query counting and metrics
+from metrics import QueryMetricsMiddleware, METRICS_CONTENT_TYPE, render_metrics, pool_wait
+
+# negotiated response compression
+from content_encoding import CompressionMiddleware
+
+# admission control and rate limiting
+from admission import AdmissionMiddleware, admission_stats
+
+# static images serving
+from static_files import StaticImages, static_cache
+
+# database settings
+from database import tortoise_config, pool_stats, GENERATE_SCHEMAS, DB_REPLICA_MAX_LAG, DB_REPLICA_CHECK_INTERVAL
+
+# read replicas
+from replicas import replicas, check_replicas, replica_monitor_loop
+
+# images storage
+from images import IMAGE_GC_INTERVAL, image_gc_loop
+
+# settings, read once
+from config import FAST_START
+import functools
+import asyncio
 import os
 
 # for db health check
@@ -38,14 +65,26 @@ import os
 # Instance of fastapi
 app = FastAPI()
 
+# gzip / brotli / zstd negotiated from Accept-Encoding, the cached catalog payloads come already compressed
+app.add_middleware(CompressionMiddleware)
+
+# Rate limits per client and concurrency caps of the auth and catalog routes, excess requests are shed with 429/503
+app.add_middleware(AdmissionMiddleware)
+
+# Queries and timings of every request (Server-Timing header and /metrics)
+app.add_middleware(QueryMetricsMiddleware)
+
 # Routers
 # app.include_router(users.router)
 app.include_router(products.router)
 app.include_router(categories.router)
+app.include_router(images.router)
 # app.include_router(uploadfile.router)
 # app.include_router(businesses.router)
 
-# Static files setup config
+# Static files setup config. The images have their own app (strong ETags, ranges, in-memory cache of the small files),
+# it has to be mounted first so it takes precedence over the generic one.
+app.mount("/static/images", StaticImages(), name="static_images")
 app.mount("/static", StaticFiles(directory="static"), name="static")
 
 # Instance for handling OAuth 2.0 bearer tokens
@@ -66,9 +105,36 @@ oauth2_scheme = OAuth2PasswordBearer(tokenUrl="token")
 # await send_email([instance.email], instance)
 
 
-templates = Jinja2Templates(directory="templates")
+# Templates of the HTML pages, Jinja2 is imported by the first page rendered instead of on startup
+@functools.lru_cache(maxsize=None)
+def templates():
+    from fastapi.templating import Jinja2Templates
+    return Jinja2Templates(directory="templates")
+
+
+# Outbound mail queue lifecycle
+@app.on_event("startup")
+async def start_mail_queue():
+    await mail_queue.start()
+
+
+@app.on_event("shutdown")
+async def stop_mail_queue():
+    await mail_queue.stop()
+
+
+# Orphaned images garbage collector lifecycle. A serverless instance does not live long enough for it (FAST_START),
+# schedule collect_orphaned_images separately there.
+@app.on_event("startup")
+async def start_image_gc():
+    if IMAGE_GC_INTERVAL > 0 and not FAST_START:
+        app.state.image_gc = asyncio.create_task(image_gc_loop(IMAGE_GC_INTERVAL))
+
 
-credentials = dotenv_values(".env")
+@app.on_event("shutdown")
+async def stop_image_gc():
+    if getattr(app.state, "image_gc", None):
+        app.state.image_gc.cancel()
 
 
 @app.get("/")
@@ -91,9 +157,11 @@ async def generate_token(request_form: OAuth2PasswordRequestForm = Depends()):
 async def user_registration(user: user_pydantic_in):
     user_info = user.dict(exclude_unset=True)
     try:
-        user_info["password"] = get_hashed_password(user_info["password"])
+        user_info["password"] = await get_hashed_password(user_info["password"])
         user_obj = await User.create(**user_info)
         new_user = await user_pydantic.from_tortoise_orm(user_obj)
+        # the verification email is delivered in the background
+        await send_email([new_user.email], user_obj)
         return {
             "status": "ok",
             "message": f"Hello {new_user.username}, thanks for choosing our services. Please check your email inbox to "
@@ -106,12 +174,14 @@ async def user_registration(user: user_pydantic_in):
 # Email verification endpoint
 @app.get("/verification", response_class=HTMLResponse, status_code=status.HTTP_200_OK)
 async def email_verification(request: Request, token: str):
-    user = await verify_token(token)
-    if user and not user.is_verified:
+    principal = await verify_token(token)
+    # the cached principal is read-only, the user is loaded to be updated
+    user = await User.get(id=principal.id)
+    if not user.is_verified:
         user.is_verified = True
-        await user.save()
-        return templates.TemplateResponse("verification.html",
-                                          {"request": request, "username": user.username, })
+        await user.save(update_fields=["is_verified"])
+        return templates().TemplateResponse("verification.html",
+                                            {"request": request, "username": user.username, })
     raise HTTPException(
         status_code=status.HTTP_401_UNAUTHORIZED,
         detail="Invalid or expired token",
@@ -142,10 +212,70 @@ async def health_check():
         return {"status": "error", "message": "Database connection error"}
 
 
+# Catalog cache statistics endpoint
+@app.get("/health/cache", response_model=CacheStatsResponse, status_code=status.HTTP_200_OK)
+async def cache_stats():
+    return {"status": "ok", "caches": {**{cache.name: cache.stats() for cache in caches},
+                                       static_cache.name: static_cache.stats()},
+            "coalescing": {product_flight.name: product_flight.stats()}}
+
+
+# Database connection pool statistics endpoint
+@app.get("/health/pool", response_model=PoolStatsResponse, status_code=status.HTTP_200_OK)
+async def pool_health():
+    waits, wait_seconds = pool_wait.totals()
+    return {"status": "ok", "pool": pool_stats(), "waits": waits, "wait_seconds": round(wait_seconds, 3)}
+
+
+# Outbound mail queue statistics endpoint
+@app.get("/health/mail", response_model=MailQueueStatsResponse, status_code=status.HTTP_200_OK)
+async def mail_queue_stats():
+    return {"status": "ok", **mail_queue.stats()}
+
+
+# Admission control statistics endpoint
+@app.get("/health/admission", response_model=AdmissionStatsResponse, status_code=status.HTTP_200_OK)
+async def admission_health():
+    return {"status": "ok", "groups": admission_stats()}
+
+
+# Read replicas statistics endpoint
+@app.get("/health/replicas", response_model=ReplicaStatsResponse, status_code=status.HTTP_200_OK)
+async def replicas_health():
+    return {"status": "ok", "max_lag": DB_REPLICA_MAX_LAG, "replicas": [replica.stats() for replica in replicas]}
+
+
+# Prometheus metrics endpoint
+@app.get("/metrics", response_class=PlainTextResponse, include_in_schema=False)
+async def metrics():
+    return PlainTextResponse(render_metrics(), media_type=METRICS_CONTENT_TYPE)
+
+
 register_tortoise(
     app,
-    db_url=credentials["POSTGRES_URL"],
-    modules={"models": ["models"]},
-    generate_schemas=True,
+    config=tortoise_config(),
+    generate_schemas=GENERATE_SCHEMAS,
     add_exception_handlers=True
 )
+
+
+# Search backend, picked from the indexes the migrations created. Registered after register_tortoise so the database
+# is initialized. With FAST_START the first search picks it instead.
+@app.on_event("startup")
+async def start_search():
+    if not FAST_START:
+        await prepare_search()
+
+
+# Replication lag monitor lifecycle, the replicas take reads once their first check passed
+@app.on_event("startup")
+async def start_replica_monitor():
+    if replicas:
+        await check_replicas()
+        app.state.replica_monitor = asyncio.create_task(replica_monitor_loop(DB_REPLICA_CHECK_INTERVAL))
+
+
+@app.on_event("shutdown")
+async def stop_replica_monitor():
+    if getattr(app.state, "replica_monitor", None):
+        app.state.replica_monitor.cancel()
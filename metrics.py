@@ -0,0 +1,276 @@
+from contextlib import asynccontextmanager
+from contextvars import ContextVar
+from typing import Dict, List, Optional, Sequence, Tuple
+from tortoise import Tortoise
+from tortoise.backends.base.client import BaseDBAsyncClient, PoolConnectionWrapper, TransactionContextPooled
+from database import pool_stats
+from config import setting
+import functools
+import logging
+import time
+
+logger = logging.getLogger(__name__)
+
+# Statements slower than this (in seconds) are logged
+SLOW_QUERY_SECONDS = float(setting("SLOW_QUERY_MS", 100)) / 1000
+# Put the slowest statement of each request in its Server-Timing header. It shows the SQL to the clients, so it is
+# meant for development.
+SERVER_TIMING_SQL = setting("SERVER_TIMING_SQL", "false").lower() == "true"
+
+# Methods of the Tortoise clients that send statements to the database
+QUERY_METHODS = ("execute_query", "execute_query_dict", "execute_insert", "execute_many", "execute_script")
+
+
+# Queries run while serving a request (or inside a query_budget block)
+class QueryStats:
+    def __init__(self):
+        self.queries = 0
+        self.db_time = 0.0
+        self.slowest: Optional[Tuple[float, str]] = None
+        self.statements: List[str] = []
+
+    def record(self, query: str, duration: float):
+        self.queries += 1
+        self.db_time += duration
+        self.statements.append(query)
+        if self.slowest is None or duration > self.slowest[0]:
+            self.slowest = (duration, query)
+
+
+# Collectors the queries of the current task are recorded to, innermost last
+_collectors: ContextVar[Tuple[QueryStats, ...]] = ContextVar("query_collectors", default=())
+# Set while a statement is being timed, so a client method calling another one only counts once
+_in_query: ContextVar[bool] = ContextVar("in_query", default=False)
+_instrumented = False
+
+
+def _timed(method):
+    @functools.wraps(method)
+    async def timed(self, query, *args, **kwargs):
+        if _in_query.get():
+            return await method(self, query, *args, **kwargs)
+        token = _in_query.set(True)
+        start = time.perf_counter()
+        try:
+            return await method(self, query, *args, **kwargs)
+        finally:
+            _in_query.reset(token)
+            duration = time.perf_counter() - start
+            query_duration.observe((), duration)
+            for stats in _collectors.get():
+                stats.record(query, duration)
+            if duration >= SLOW_QUERY_SECONDS:
+                logger.warning("Slow query (%.1f ms): %s", duration * 1000, query)
+
+    timed.instrumented = True
+    return timed
+
+
+# Time the statements of every Tortoise client class (connections and transaction wrappers). The backends are
+# imported by Tortoise.init, so this runs once the ORM is initialized, it does nothing the following times.
+def instrument_database():
+    global _instrumented
+    _instrumented = True
+    pending = list(BaseDBAsyncClient.__subclasses__())
+    while pending:
+        client_class = pending.pop()
+        pending.extend(client_class.__subclasses__())
+        for name in QUERY_METHODS:
+            method = client_class.__dict__.get(name)
+            if method is not None and not getattr(method, "instrumented", False):
+                setattr(client_class, name, _timed(method))
+    # acquiring a pooled connection, for the plain queries and for the transactions (which also includes their BEGIN)
+    for wrapper_class in (PoolConnectionWrapper, TransactionContextPooled):
+        if not getattr(wrapper_class.__aenter__, "instrumented", False):
+            wrapper_class.__aenter__ = _timed_acquire(wrapper_class.__aenter__)
+
+
+def _timed_acquire(method):
+    @functools.wraps(method)
+    async def timed(self):
+        start = time.perf_counter()
+        connection = await method(self)
+        pool_wait.observe((), time.perf_counter() - start)
+        return connection
+
+    timed.instrumented = True
+    return timed
+
+
+# Prometheus histogram, rendered in the text exposition format
+class Histogram:
+    def __init__(self, name: str, documentation: str, buckets: Sequence[float], labels: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.buckets = tuple(buckets)
+        self.labels = tuple(labels)
+        # label values -> [count per bucket (not cumulative, the last one is +Inf), sum]
+        self._series: Dict[tuple, list] = {}
+
+    def observe(self, label_values: tuple, value: float):
+        series = self._series.get(label_values)
+        if series is None:
+            series = self._series[label_values] = [[0] * (len(self.buckets) + 1), 0.0]
+        for position, bound in enumerate(self.buckets):
+            if value <= bound:
+                break
+        else:
+            position = len(self.buckets)
+        series[0][position] += 1
+        series[1] += value
+
+    # Number of observations and their sum
+    def totals(self, label_values: tuple = ()) -> Tuple[int, float]:
+        series = self._series.get(label_values)
+        return (sum(series[0]), series[1]) if series else (0, 0.0)
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} histogram"]
+        for label_values, (counts, total) in sorted(self._series.items()):
+            labels = ",".join(f'{label}="{_escape_label(value)}"' for label, value in zip(self.labels, label_values))
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += count
+                le = "+Inf" if bound == float("inf") else repr(float(bound))
+                lines.append(f'{self.name}_bucket{{{labels}{"," if labels else ""}le="{le}"}} {cumulative}')
+            suffix = f"{{{labels}}}" if labels else ""
+            lines.append(f"{self.name}_sum{suffix} {total}")
+            lines.append(f"{self.name}_count{suffix} {cumulative}")
+        return lines
+
+
+# Prometheus counter (or gauge, for values that go down too), rendered in the text exposition format
+class Counter:
+    def __init__(self, name: str, documentation: str, labels: Sequence[str] = (), kind: str = "counter"):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self.kind = kind
+        self._values: Dict[tuple, float] = {}
+
+    def inc(self, label_values: tuple = (), amount: float = 1):
+        self._values[label_values] = self._values.get(label_values, 0) + amount
+
+    def set(self, label_values: tuple, value: float):
+        self._values[label_values] = value
+
+    def value(self, label_values: tuple = ()) -> float:
+        return self._values.get(label_values, 0)
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        for label_values, value in sorted(self._values.items()):
+            labels = ",".join(f'{label}="{_escape_label(label_value)}"'
+                              for label, label_value in zip(self.labels, label_values))
+            lines.append(f"{self.name}{{{labels}}} {value}" if labels else f"{self.name} {value}")
+        return lines
+
+
+def _escape_label(value: str) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+TIME_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+COUNT_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100)
+
+request_duration = Histogram("http_request_duration_seconds", "Time spent serving the requests",
+                             TIME_BUCKETS, ("method", "route"))
+request_queries = Histogram("http_request_db_queries", "SQL statements issued per request",
+                            COUNT_BUCKETS, ("method", "route"))
+request_db_time = Histogram("http_request_db_seconds", "Time spent in the database per request",
+                            TIME_BUCKETS, ("method", "route"))
+query_duration = Histogram("db_query_duration_seconds", "Duration of the SQL statements", TIME_BUCKETS)
+pool_wait = Histogram("db_pool_wait_seconds", "Time spent waiting for a pooled connection", TIME_BUCKETS)
+
+histograms = [request_duration, request_queries, request_db_time, query_duration, pool_wait]
+# Other metrics rendered by /metrics (counters, gauges), registered by the modules that own them
+registry: List[Counter] = []
+
+METRICS_CONTENT_TYPE = "text/plain; version=0.0.4"
+
+
+def render_metrics() -> str:
+    lines = [line for metric in histograms + registry for line in metric.render()]
+    return "\n".join(lines + pool_gauges()) + "\n"
+
+
+# Connections of the pool, saturation is the share of max_size in use
+def pool_gauges() -> List[str]:
+    stats = pool_stats() if Tortoise._inited else None
+    if stats is None:
+        return []
+    lines = []
+    for name, key, documentation in (("db_pool_connections_in_use", "in_use", "Connections lent out by the pool"),
+                                     ("db_pool_connections_idle", "idle", "Idle connections of the pool"),
+                                     ("db_pool_max_size", "max_size", "Maximum size of the pool"),
+                                     ("db_pool_saturation", "saturation", "Share of the pool in use")):
+        lines += [f"# HELP {name} {documentation}", f"# TYPE {name} gauge", f"{name} {stats[key]}"]
+    return lines
+
+
+# ASGI middleware recording the queries of every request. The totals are sent in a Server-Timing header (the work
+# done while streaming a body comes after the headers, so it is only in the histograms) and observed in the
+# histograms under the route template, e.g. "/products/{product_id}".
+class QueryMetricsMiddleware:
+    def __init__(self, app):
+        self.app = app
+        self._routes: Optional[dict] = None
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        if not _instrumented and Tortoise._inited:
+            instrument_database()
+        stats = QueryStats()
+        token = _collectors.set(_collectors.get() + (stats,))
+        start = time.perf_counter()
+
+        async def send_with_timing(message):
+            if message["type"] == "http.response.start":
+                headers = list(message.get("headers", []))
+                headers.append((b"server-timing", server_timing(stats, time.perf_counter() - start).encode("latin-1")))
+                message = {**message, "headers": headers}
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_timing)
+        finally:
+            _collectors.reset(token)
+            labels = (scope["method"], self._route(scope))
+            request_duration.observe(labels, time.perf_counter() - start)
+            request_queries.observe(labels, stats.queries)
+            request_db_time.observe(labels, stats.db_time)
+
+    # Path template of the route that served the request, the raw paths would make one series per product
+    def _route(self, scope) -> str:
+        if self._routes is None:
+            self._routes = {getattr(route, "endpoint", getattr(route, "app", None)): route.path
+                            for route in scope["app"].routes}
+        return self._routes.get(scope.get("endpoint"), "unmatched")
+
+
+def server_timing(stats: QueryStats, elapsed: float) -> str:
+    metrics = [f'db;dur={stats.db_time * 1000:.1f};desc="{stats.queries} queries"', f"app;dur={elapsed * 1000:.1f}"]
+    if stats.slowest is not None:
+        slowest = f"db-slowest;dur={stats.slowest[0] * 1000:.1f}"
+        if SERVER_TIMING_SQL:
+            statement = " ".join(stats.slowest[1].split())[:200].encode("latin-1", "replace").decode("latin-1")
+            slowest += ';desc="' + statement.replace("\\", "\\\\").replace('"', '\\"') + '"'
+        metrics.append(slowest)
+    return ", ".join(metrics)
+
+
+# Test helper: fail when the block issues more than `budget` statements, listing them.
+#     async with query_budget(2):
+#         await client.get("/products/")
+@asynccontextmanager
+async def query_budget(budget: int):
+    instrument_database()
+    stats = QueryStats()
+    token = _collectors.set(_collectors.get() + (stats,))
+    try:
+        yield stats
+    finally:
+        _collectors.reset(token)
+    if stats.queries > budget:
+        raise AssertionError(f"{stats.queries} queries issued, the budget is {budget}:\n" + "\n".join(stats.statements))
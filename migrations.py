@@ -0,0 +1,108 @@
+# Schema migrations of the existing databases, for the environments where the tables are not generated on startup
+# (GENERATE_SCHEMAS off, e.g. production and serverless). Every migration checks whether it was already applied, so
+# running them again, or on a database created by generate_schemas, does nothing.
+# Usage: python migrations.py (migrates the database of POSTGRES_URL)
+from typing import Awaitable, Callable, List, Tuple
+from tortoise import Tortoise
+from tortoise.backends.base.client import BaseDBAsyncClient
+from database import tortoise_config
+import asyncio
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Same column types as the ones generate_schemas creates. The existing rows get the time of the migration.
+UPDATED_AT_COLUMN = {
+    "postgres": "ALTER TABLE {table} ADD COLUMN IF NOT EXISTS updated_at TIMESTAMPTZ NOT NULL "
+                "DEFAULT CURRENT_TIMESTAMP",
+    "mysql": "ALTER TABLE {table} ADD COLUMN updated_at DATETIME(6) NOT NULL DEFAULT CURRENT_TIMESTAMP(6)",
+    # SQLite only adds columns with a constant default, the existing rows are stamped afterwards
+    "sqlite": "ALTER TABLE {table} ADD COLUMN updated_at TIMESTAMP NOT NULL DEFAULT '1970-01-01 00:00:00'; "
+              "UPDATE {table} SET updated_at = CURRENT_TIMESTAMP",
+}
+
+
+async def column_exists(connection: BaseDBAsyncClient, table: str, column: str) -> bool:
+    dialect = connection.capabilities.dialect
+    if dialect == "sqlite":
+        rows = await connection.execute_query_dict(f"PRAGMA table_info({table})")
+        return any(row["name"] == column for row in rows)
+    if dialect == "postgres":
+        query = ("SELECT 1 FROM information_schema.columns "
+                 "WHERE table_schema = current_schema() AND table_name = $1 AND column_name = $2")
+    else:
+        query = ("SELECT 1 FROM information_schema.columns "
+                 "WHERE table_schema = DATABASE() AND table_name = %s AND column_name = %s")
+    return bool(await connection.execute_query_dict(query, [table, column]))
+
+
+# updated_at of the products and categories (Last-Modified of the catalog responses)
+async def add_catalog_updated_at(connection: BaseDBAsyncClient):
+    for table in ("product", "category"):
+        if not await column_exists(connection, table, "updated_at"):
+            await connection.execute_script(UPDATED_AT_COLUMN[connection.capabilities.dialect].format(table=table))
+
+
+# Full-text and trigram (pg_trgm) indexes of the product search, on Postgres only. CONCURRENTLY builds them without
+# blocking the writes to product, and cannot run in a transaction: every statement runs on its own.
+# The expressions have to match the queries of search.py.
+SEARCH_INDEXES = {
+    "product_name_fts_idx": "CREATE INDEX CONCURRENTLY product_name_fts_idx ON product "
+                            "USING GIN (to_tsvector('simple', name))",
+}
+SEARCH_TRIGRAM_INDEXES = {
+    "product_name_trgm_idx": "CREATE INDEX CONCURRENTLY product_name_trgm_idx ON product USING GIN (name gin_trgm_ops)",
+}
+
+
+async def create_search_indexes(connection: BaseDBAsyncClient):
+    if connection.capabilities.dialect != "postgres":
+        return
+    for name, statement in SEARCH_INDEXES.items():
+        await create_index_concurrently(connection, name, statement)
+    try:
+        await connection.execute_script("CREATE EXTENSION IF NOT EXISTS pg_trgm")
+    except Exception as e:
+        # creating the extension needs the CREATE privilege on the database and the contrib modules installed
+        logger.warning("pg_trgm is not available, the search will not match misspelled words: %s", e)
+        return
+    for name, statement in SEARCH_TRIGRAM_INDEXES.items():
+        await create_index_concurrently(connection, name, statement)
+
+
+# A concurrent build that failed leaves an invalid index behind, it is dropped and built again
+async def create_index_concurrently(connection: BaseDBAsyncClient, name: str, statement: str):
+    rows = await connection.execute_query_dict(
+        "SELECT i.indisvalid AS valid FROM pg_index i JOIN pg_class c ON c.oid = i.indexrelid "
+        "WHERE c.relname = $1 AND pg_table_is_visible(c.oid)", [name])
+    if rows and rows[0]["valid"]:
+        return
+    if rows:
+        await connection.execute_script(f"DROP INDEX CONCURRENTLY {name}")
+    await connection.execute_script(statement)
+
+
+# In the order they have to run
+MIGRATIONS: List[Tuple[str, Callable[[BaseDBAsyncClient], Awaitable[None]]]] = [
+    ("add_catalog_updated_at", add_catalog_updated_at),
+    ("create_search_indexes", create_search_indexes),
+]
+
+
+async def run_migrations(connection: BaseDBAsyncClient):
+    for name, migration in MIGRATIONS:
+        logger.info("Running migration %s", name)
+        await migration(connection)
+
+
+async def main():
+    await Tortoise.init(config=tortoise_config())
+    try:
+        await run_migrations(Tortoise.get_connection("default"))
+    finally:
+        await Tortoise.close_connections()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    asyncio.run(main())
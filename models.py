@@ -1,6 +1,7 @@
 from datetime import datetime
-from typing import List
-from pydantic import BaseModel
+from decimal import Decimal
+from typing import List, Optional, Union
+from pydantic import BaseModel, ConfigDict, Field, field_validator
 from tortoise import Model, fields
 from tortoise.contrib.pydantic import pydantic_model_creator
 
@@ -32,6 +33,7 @@ class Product(Model):
     image = fields.CharField(max_length=200, null=False, default="defaultProduct.png")
     original_price = fields.DecimalField(max_digits=12, decimal_places=2)
     category = fields.ForeignKeyField('models.Category', related_name='products')
+    updated_at = fields.DatetimeField(auto_now=True)
     # new_price = fields.DecimalField(max_digits=12, decimal_places=2)
     # percentage_discount = fields.IntField()
     # offer_expiration_data = fields.DateField(default=datetime.utcnow)
@@ -43,10 +45,23 @@ class Product(Model):
 class Category(Model):
     id = fields.IntField(pk=True, index=True)
     name = fields.CharField(max_length=30, null=False, unique=True)
+    updated_at = fields.DatetimeField(auto_now=True)
     products: fields.ReverseRelation[Product]
 
 
 # Pydantic models
+# User resolved from a token, cached and shared by the requests: a read-only snapshot, the handlers that write load
+# the User again
+class Principal(BaseModel):
+    model_config = ConfigDict(frozen=True)
+
+    id: int
+    username: str
+    email: str
+    is_verified: bool
+    join_date: datetime
+
+
 user_pydantic = pydantic_model_creator(User, name="User", exclude=("is_verified",))
 user_pydantic_in = pydantic_model_creator(User, name="UserIn", exclude_readonly=True, exclude=("is_verified",
                                                                                                "join_date"))
@@ -56,18 +71,45 @@ user_pydantic_out = pydantic_model_creator(User, name="UserOut", exclude=("passw
 # business_pydantic_in = pydantic_model_creator(Business, name="BusinessIn", exclude=("id", "logo",))
 
 product_pydantic = pydantic_model_creator(Product, name="Product")
-product_pydantic_in = pydantic_model_creator(Product, name="ProductIn", exclude_readonly=True)
+product_pydantic_in = pydantic_model_creator(Product, name="ProductIn", exclude_readonly=True, exclude=("updated_at",))
+# Fields of the product responses, used to fetch plain rows with .values()
+PRODUCT_FIELDS = tuple(product_pydantic.model_fields)
 
 category_pydantic = pydantic_model_creator(Category, name="Category")
-category_pydantic_in = pydantic_model_creator(Category, name="CategoryIn", exclude_readonly=True)
+category_pydantic_in = pydantic_model_creator(Category, name="CategoryIn", exclude_readonly=True,
+                                              exclude=("updated_at",))
 
 
 # Response models
 
 # Products
+# Category embedded in the product collections with embed=category, the products only have a "category" then
+class ProductCategory(BaseModel):
+    id: int
+    name: str
+
+
+class ProductWithCategory(product_pydantic):
+    category: ProductCategory
+
+
+class ProductListItem(product_pydantic):
+    image_url: str
+
+
+class ProductListItemWithCategory(ProductListItem):
+    category: ProductCategory
+
+
 class AllProductsResponse(BaseModel):
     status: str
-    products: List[product_pydantic]
+    products: List[Union[ProductListItemWithCategory, ProductListItem]]
+    next_cursor: Optional[int] = None
+
+
+class SearchProductsResponse(BaseModel):
+    status: str
+    products: List[Union[ProductListItemWithCategory, ProductListItem]]
 
 
 class SingleProductResponse(BaseModel):
@@ -75,6 +117,12 @@ class SingleProductResponse(BaseModel):
     data: product_pydantic
 
 
+class BatchProductsResponse(BaseModel):
+    status: str
+    products: List[Union[ProductWithCategory, product_pydantic]]
+    missing: List[int]
+
+
 class AddProductResponse(BaseModel):
     status: str
     message: str
@@ -91,6 +139,43 @@ class UpdateProductResponse(BaseModel):
     data: product_pydantic
 
 
+# Bulk update / delete requests, limited to MAX_BULK_ITEMS products per call
+MAX_BULK_ITEMS = 10000
+
+
+class ProductBulkUpdate(BaseModel):
+    id: Optional[int] = None  # products without id are created when upserting
+    name: Optional[str] = Field(None, max_length=100)
+    image: Optional[str] = Field(None, max_length=200)
+    original_price: Optional[Decimal] = None
+    category_id: Optional[int] = None
+
+    # the fields can be left out but not set to null, the columns are not nullable
+    @field_validator("name", "image", "original_price", "category_id")
+    @classmethod
+    def not_null(cls, value):
+        if value is None:
+            raise ValueError("Field cannot be null")
+        return value
+
+
+class BulkUpdateProductsResponse(BaseModel):
+    status: str
+    updated: int
+    created: int
+    missing: List[int]
+
+
+class ProductBulkDelete(BaseModel):
+    ids: List[int] = Field(..., min_length=1, max_length=MAX_BULK_ITEMS)
+
+
+class BulkDeleteProductsResponse(BaseModel):
+    status: str
+    deleted: int
+    missing: List[int]
+
+
 # Users
 class TokenResponse(BaseModel):
     access_token: str
@@ -137,6 +222,38 @@ class HealthCheckResponse(BaseModel):
     message: str
 
 
+class CacheStatsResponse(BaseModel):
+    status: str
+    caches: dict
+    coalescing: dict
+
+
+class PoolStatsResponse(BaseModel):
+    status: str
+    pool: Optional[dict]
+    waits: int
+    wait_seconds: float
+
+
+class ReplicaStatsResponse(BaseModel):
+    status: str
+    max_lag: float
+    replicas: List[dict]
+
+
+class AdmissionStatsResponse(BaseModel):
+    status: str
+    groups: dict
+
+
+class MailQueueStatsResponse(BaseModel):
+    status: str
+    backlog: int
+    sent: int
+    failed: int
+    dropped: int
+
+
 # Categories
 class AddCategoryResponse(BaseModel):
     status: str
@@ -144,6 +261,10 @@ class AddCategoryResponse(BaseModel):
     category: category_pydantic
 
 
+class CategoryWithCount(category_pydantic):
+    product_count: int
+
+
 class AllCategoriesResponse(BaseModel):
     status: str
-    categories: List[category_pydantic]
+    categories: List[CategoryWithCount]
@@ -0,0 +1,106 @@
+from typing import List, Optional
+from tortoise import Tortoise
+from tortoise.backends.base.client import BaseDBAsyncClient
+from database import DB_REPLICA_URLS, DB_REPLICA_MAX_LAG, DB_REPLICA_CHECK_INTERVAL
+from metrics import Counter, registry
+import asyncio
+import itertools
+import logging
+import time
+
+logger = logging.getLogger(__name__)
+
+# Replication lag of the server behind a connection, in seconds. 0 when it is not a replica or it replayed everything
+# it received (pg_last_xact_replay_timestamp keeps aging while the primary has no writes).
+POSTGRES_LAG = """
+SELECT CASE WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0
+            ELSE COALESCE(EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()), 0) END AS lag
+"""
+MYSQL_LAG = "SHOW REPLICA STATUS"
+
+replica_lag = Counter("db_replica_lag_seconds", "Replication lag of the replicas", ("replica",), kind="gauge")
+replica_healthy = Counter("db_replica_healthy", "Whether the replica takes reads (1) or not (0)", ("replica",),
+                          kind="gauge")
+reads = Counter("db_reads_total", "Catalog reads by connection", ("connection",))
+registry.extend([replica_lag, replica_healthy, reads])
+
+
+# A read replica, taking reads while its last measured lag is under DB_REPLICA_MAX_LAG
+class Replica:
+    def __init__(self, name: str):
+        self.name = name
+        self.lag: Optional[float] = None
+        self.healthy = False
+        self.error: Optional[str] = None
+        self.checked_at: Optional[float] = None
+
+    def stats(self) -> dict:
+        return {"name": self.name, "healthy": self.healthy, "lag": self.lag, "error": self.error,
+                "checked_seconds_ago": round(time.monotonic() - self.checked_at, 1) if self.checked_at else None}
+
+
+replicas: List[Replica] = [Replica(f"replica_{position}") for position in range(1, len(DB_REPLICA_URLS) + 1)]
+_round_robin = itertools.count()
+# monotonic time of the last write of this worker
+_last_write = float("-inf")
+
+
+# Called on every write: the reads of this worker go to the primary for DB_REPLICA_MAX_LAG seconds, the time a
+# healthy replica may need to receive the write
+def record_write():
+    global _last_write
+    _last_write = time.monotonic()
+
+
+# Connection for a read that tolerates up to DB_REPLICA_MAX_LAG of staleness: the healthy replicas in turn, or the
+# primary when there is none or this worker wrote recently. Reads that must see the latest writes use the default
+# connection directly.
+def read_db() -> BaseDBAsyncClient:
+    name = "default"
+    if replicas and time.monotonic() - _last_write >= DB_REPLICA_MAX_LAG:
+        healthy = [replica for replica in replicas if replica.healthy]
+        if healthy:
+            name = healthy[next(_round_robin) % len(healthy)].name
+    reads.inc((name,))
+    return Tortoise.get_connection(name)
+
+
+async def measure_lag(connection: BaseDBAsyncClient) -> Optional[float]:
+    dialect = connection.capabilities.dialect
+    if dialect == "postgres":
+        rows = await connection.execute_query_dict(POSTGRES_LAG)
+        return float(rows[0]["lag"])
+    if dialect == "mysql":
+        rows = await connection.execute_query_dict(MYSQL_LAG)
+        if not rows:
+            return 0.0
+        # NULL while the replication threads are stopped
+        lag = rows[0].get("Seconds_Behind_Source")
+        return None if lag is None else float(lag)
+    # SQLite has no replication, its "replicas" are copies that never lag
+    await connection.execute_query("SELECT 1")
+    return 0.0
+
+
+# Measure the lag of every replica and take the lagging or unreachable ones out of the reads
+async def check_replicas():
+    for replica in replicas:
+        try:
+            replica.lag = await measure_lag(Tortoise.get_connection(replica.name))
+            replica.error = None if replica.lag is not None else "replication stopped"
+        except Exception as e:
+            replica.lag, replica.error = None, f"{type(e).__name__}: {e}"
+        healthy = replica.lag is not None and replica.lag <= DB_REPLICA_MAX_LAG
+        if replica.healthy and not healthy:
+            logger.warning("Replica %s left out of the reads (lag %s, %s)", replica.name, replica.lag, replica.error)
+        replica.healthy = healthy
+        replica.checked_at = time.monotonic()
+        replica_lag.set((replica.name,), replica.lag if replica.lag is not None else float("nan"))
+        replica_healthy.set((replica.name,), int(healthy))
+
+
+# Background job measuring the replication lag every `interval` seconds
+async def replica_monitor_loop(interval: float = DB_REPLICA_CHECK_INTERVAL):
+    while True:
+        await asyncio.sleep(interval)
+        await check_replicas()
@@ -17,7 +17,7 @@ async def update_business(business_id: int, business_info: business_pydantic_in,
     try:
         business = await Business.get(id=business_id)
         owner = await business.owner
-        if owner == user:
+        if owner.id == user.id:
             await business.update_from_dict(business_info)
             await business.save()
             response = await business_pydantic.from_tortoise_orm(business)
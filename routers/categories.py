@@ -1,5 +1,10 @@
-from fastapi import APIRouter, HTTPException, status, Depends
+from fastapi import APIRouter, HTTPException, status, Depends, Request
+from tortoise.functions import Count
+from tortoise.signals import post_save, post_delete
 from models import *
+from serializers import dumps
+from cache import category_list_cache, product_list_cache, CachedResponse, cached_response
+from replicas import read_db, record_write
 
 
 router = APIRouter(prefix="/categories", tags=["Categories"],
@@ -22,11 +27,35 @@ async def add_new_category(category: category_pydantic_in):
         raise HTTPException(status_code=status.HTTP_409_CONFLICT, detail="Invalid data. Category not created!.")
 
 
-# Get all categories endpoint
+# Get all categories endpoint, with the number of products of each one
 @router.get("/", response_model=AllCategoriesResponse, status_code=status.HTTP_200_OK)
-async def get_all_categories():
+async def get_all_categories(request: Request):
+    entry = category_list_cache.get("all")
+    if entry is not None:
+        return cached_response(request, entry)
+    generation = category_list_cache.generation
     try:
-        response = await category_pydantic.from_queryset(Category.all())
-        return {"status": "ok", "categories": response}
+        # the counts of every category come from a single LEFT JOIN ... GROUP BY, on a replica
+        categories = await Category.annotate(product_count=Count("products")).using_db(read_db()).order_by("id").values(
+            *category_pydantic.model_fields, "product_count")
+        body = dumps({"status": "ok", "categories": categories})
+        entry = CachedResponse(body)
+        category_list_cache.set("all", entry, generation=generation)
+        return cached_response(request, entry)
     except IndexError:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="No categories found")
+
+
+# Signals: drop the cached payloads every time a category is written, including the product listings that embed it
+@post_save(Category)
+async def invalidate_categories_on_save(sender, instance, created, using_db, update_fields):
+    record_write()
+    category_list_cache.clear()
+    product_list_cache.clear()
+
+
+@post_delete(Category)
+async def invalidate_categories_on_delete(sender, instance, using_db):
+    record_write()
+    category_list_cache.clear()
+    product_list_cache.clear()
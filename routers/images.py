@@ -0,0 +1,30 @@
+from fastapi import APIRouter, HTTPException, status, Query, Request
+from fastapi.responses import FileResponse, Response
+from images import VARIANTS, VARIANT_FORMATS, STORED_NAME, get_variant, variant_etag
+from static_files import IMMUTABLE_CACHE_CONTROL
+
+router = APIRouter(prefix="/images", tags=["Images"],
+                   responses={status.HTTP_404_NOT_FOUND: {"description": "Image not found"}})
+
+# Variants of the images that are not content-addressed (e.g. the default pictures) can change, clients revalidate
+# them with their ETag after a few minutes
+VARIANT_CACHE_CONTROL = "public, max-age=300"
+
+
+# Endpoints:
+
+# Get a resized variant of an image endpoint
+@router.get("/{variant}/{image_name}", response_class=FileResponse, status_code=status.HTTP_200_OK)
+async def get_image_variant(request: Request, variant: str, image_name: str, format: str = Query("webp")):
+    if variant not in VARIANTS or format not in VARIANT_FORMATS:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Image variant not found")
+    path = await get_variant(image_name, variant, format)
+    if path is None:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Image not found")
+    # the content behind a content-addressed name never changes, so clients can keep its variants forever
+    headers = {"ETag": variant_etag(image_name, variant, format),
+               "Cache-Control": IMMUTABLE_CACHE_CONTROL if STORED_NAME.match(image_name) else VARIANT_CACHE_CONTROL}
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match and headers["ETag"] in [tag.strip().removeprefix("W/") for tag in if_none_match.split(",")]:
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
+    return FileResponse(path, media_type=VARIANT_FORMATS[format][1], headers=headers)
@@ -1,32 +1,229 @@
-from fastapi import APIRouter, HTTPException, status  # , Depends
+from datetime import datetime
+from decimal import Decimal
+from typing import AsyncIterator, Iterable, List, Optional
+from fastapi import APIRouter, Body, HTTPException, status, Query, Request  # , Depends
+from fastapi.responses import StreamingResponse
+from pydantic import ValidationError
+from tortoise.signals import post_save, post_delete
+from tortoise.transactions import in_transaction
+from tortoise import timezone
 from models import *
+from images import VARIANT_FORMATS, variant_for_width, image_url
+from serializers import dumps, format_datetime
+from search import search_index, find_products
+from replicas import read_db, record_write
+from cache import (product_cache, product_list_cache, category_list_cache, product_flight, CachedResponse,
+                   cached_response)
 # from routers.users import get_current_user
+import json
+import csv
+import io
+import codecs
 
 router = APIRouter(prefix="/products", tags=["Products"],
                    responses={status.HTTP_404_NOT_FOUND: {"description": "Product(s) not found"}})
 
+# Page size limits for the products listing
+DEFAULT_PAGE_SIZE = 50
+MAX_PAGE_SIZE = 200
+
+# Rows fetched per query by the catalog export, and the exported columns
+EXPORT_BATCH_SIZE = 1000
+EXPORT_FIELDS = PRODUCT_FIELDS + ("category_id",)
+
+# Related data that can be embedded in the product collections (?embed=category), fetched with a single LEFT JOIN
+EMBED_PATTERN = "^category$"
+EMBED_FIELDS = ("category_id", "category__name")
+
+# Maximum number of ids of a batch get
+MAX_BATCH_IDS = 200
+
+# Rows inserted per bulk_create (and per transaction) by the bulk import
+IMPORT_CHUNK_SIZE = 1000
+IMPORT_FORMATS = {"application/json": "json", "application/x-ndjson": "ndjson", "text/csv": "csv"}
+
 
 # Endpoints:
 
 # Get all products endpoint
 @router.get("/", response_model=AllProductsResponse, status_code=status.HTTP_200_OK)
-async def get_all_products():
+async def get_all_products(request: Request,
+                           cursor: Optional[int] = Query(None, description="Last id of the previous page"),
+                           limit: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+                           category_id: Optional[int] = None,
+                           min_price: Optional[Decimal] = Query(None, ge=0),
+                           max_price: Optional[Decimal] = Query(None, ge=0),
+                           name: Optional[str] = Query(None, min_length=1, description="Product name prefix"),
+                           image_width: Optional[int] = Query(None, ge=1, description="Width the images are shown at"),
+                           image_format: str = Query("webp", pattern="^(" + "|".join(VARIANT_FORMATS) + ")$"),
+                           embed: Optional[str] = Query(None, pattern=EMBED_PATTERN)):
+    cache_key = (cursor, limit, category_id, min_price, max_price, name, image_width, image_format, embed)
+    entry = product_list_cache.get(cache_key)
+    if entry is not None:
+        return cached_response(request, entry)
+    # a write landing while the page is read makes it stale, it is then served but not cached
+    generation = product_list_cache.generation
     try:
-        response = await product_pydantic.from_queryset(Product.all())
-        return {"status": "ok", "products": response}
+        # keyset pagination: seek past the cursor on the primary key instead of using an offset, so every page
+        # costs the same no matter how deep into the catalog it is. Listings can be a bit stale, they read a replica.
+        query = Product.all().using_db(read_db()).order_by("id")
+        if cursor is not None:
+            query = query.filter(id__gt=cursor)
+        if category_id is not None:
+            query = query.filter(category_id=category_id)
+        if min_price is not None:
+            query = query.filter(original_price__gte=min_price)
+        if max_price is not None:
+            query = query.filter(original_price__lte=max_price)
+        if name:
+            query = query.filter(name__istartswith=name)
+        # fetch one extra row to know if there is a next page. Plain rows are encoded straight to JSON, building
+        # model instances and pydantic models for every row is where most of the time of large pages went
+        rows = await query.limit(limit + 1).values(*product_fields(embed))
+        next_cursor = rows[limit - 1]["id"] if len(rows) > limit else None
+        rows = rows[:limit]
+        if embed:
+            embed_categories(rows)
+        # point each product to the smallest image variant that covers the requested width
+        variant = variant_for_width(image_width) if image_width else None
+        for row in rows:
+            row["image_url"] = image_url(row["image"], variant, image_format)
+        body = dumps({"status": "ok", "products": rows, "next_cursor": next_cursor})
+        entry = CachedResponse(body)
+        product_list_cache.set(cache_key, entry, generation=generation)
+        return cached_response(request, entry)
     except IndexError:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="No products found")
 
 
+# Export the catalog endpoint, streamed as NDJSON or CSV
+@router.get("/export", response_class=StreamingResponse, status_code=status.HTTP_200_OK)
+async def export_products(format: str = Query("ndjson", pattern="^(ndjson|csv)$"),
+                          category_id: Optional[int] = None,
+                          updated_since: Optional[datetime] = Query(None, description="Only products updated since")):
+    batches = export_batches(category_id, updated_since)
+    if format == "csv":
+        return StreamingResponse(csv_lines(batches), media_type="text/csv",
+                                 headers={"Content-Disposition": "attachment; filename=products.csv"})
+    return StreamingResponse(ndjson_lines(batches), media_type="application/x-ndjson",
+                             headers={"Content-Disposition": "attachment; filename=products.ndjson"})
+
+
+# Walk the catalog in keyset batches of EXPORT_BATCH_SIZE rows, so memory stays flat whatever the catalog size
+async def export_batches(category_id: Optional[int] = None,
+                         updated_since: Optional[datetime] = None) -> AsyncIterator[list]:
+    # every batch reads the same replica
+    query = Product.all().using_db(read_db()).order_by("id")
+    if category_id is not None:
+        query = query.filter(category_id=category_id)
+    if updated_since is not None:
+        query = query.filter(updated_at__gte=updated_since)
+    last_id = None
+    while True:
+        batch = query if last_id is None else query.filter(id__gt=last_id)
+        rows = await batch.limit(EXPORT_BATCH_SIZE).values(*EXPORT_FIELDS)
+        if not rows:
+            return
+        for row in rows:
+            row["image_url"] = image_url(row["image"])
+        yield rows
+        if len(rows) < EXPORT_BATCH_SIZE:
+            return
+        last_id = rows[-1]["id"]
+
+
+async def ndjson_lines(batches: AsyncIterator[list]) -> AsyncIterator[bytes]:
+    async for rows in batches:
+        yield b"".join(dumps(row) + b"\n" for row in rows)
+
+
+async def csv_lines(batches: AsyncIterator[list]) -> AsyncIterator[str]:
+    buffer = io.StringIO()
+    writer = csv.DictWriter(buffer, fieldnames=EXPORT_FIELDS + ("image_url",))
+    writer.writeheader()
+    yield buffer.getvalue()
+    async for rows in batches:
+        buffer.seek(0)
+        buffer.truncate()
+        for row in rows:
+            row["updated_at"] = format_datetime(row["updated_at"])
+        writer.writerows(rows)
+        yield buffer.getvalue()
+
+
+# Search products by name endpoint, best matches first. Every word of the query has to match a word of the name,
+# either whole or as its beginning.
+@router.get("/search", response_model=SearchProductsResponse, status_code=status.HTTP_200_OK)
+async def search_products(request: Request, q: str = Query(..., min_length=1, max_length=100),
+                          limit: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+                          embed: Optional[str] = Query(None, pattern=EMBED_PATTERN)):
+    cache_key = ("search", q.casefold(), limit, embed)
+    entry = product_list_cache.get(cache_key)
+    if entry is not None:
+        return cached_response(request, entry)
+    generation = product_list_cache.generation
+    rows = await find_products(q, limit, product_fields(embed), read_db())
+    if embed:
+        embed_categories(rows)
+    for row in rows:
+        row["image_url"] = image_url(row["image"])
+    body = dumps({"status": "ok", "products": rows})
+    entry = CachedResponse(body)
+    product_list_cache.set(cache_key, entry, generation=generation)
+    return cached_response(request, entry)
+
+
+# Get many products by id endpoint (e.g. ?ids=3,1,2), in the requested order and with a single query
+@router.get("/batch", response_model=BatchProductsResponse, status_code=status.HTTP_200_OK)
+async def get_batch_products(request: Request, ids: str = Query(..., pattern=r"^\d+(,\d+)*$"),
+                             embed: Optional[str] = Query(None, pattern=EMBED_PATTERN)):
+    # repeated ids are returned once
+    product_ids = tuple(dict.fromkeys(int(product_id) for product_id in ids.split(",")))
+    if len(product_ids) > MAX_BATCH_IDS:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=f"At most {MAX_BATCH_IDS} ids")
+    # identical concurrent batches share a single query, unless a product was written since it started
+    entry = await product_flight.do((product_ids, embed, product_cache.generation),
+                                    lambda: load_batch_products(product_ids, embed))
+    return cached_response(request, entry)
+
+
+async def load_batch_products(product_ids: tuple, embed: Optional[str] = None) -> CachedResponse:
+    rows = await Product.filter(id__in=product_ids).using_db(read_db()).values(*product_fields(embed))
+    if embed:
+        embed_categories(rows)
+    by_id = {row["id"]: row for row in rows}
+    products = [by_id[product_id] for product_id in product_ids if product_id in by_id]
+    missing = [product_id for product_id in product_ids if product_id not in by_id]
+    body = dumps({"status": "ok", "products": products, "missing": missing})
+    return CachedResponse(body)
+
+
+# Columns of the product rows, with the joined category ones when it is embedded
+def product_fields(embed: Optional[str]) -> tuple:
+    return PRODUCT_FIELDS + EMBED_FIELDS if embed else PRODUCT_FIELDS
+
+
+# Nest the joined category columns of each row under "category"
+def embed_categories(rows: List[dict]):
+    for row in rows:
+        row["category"] = {"id": row.pop("category_id"), "name": row.pop("category__name")}
+
+
 # Get a single product endpoint
 @router.get("/{product_id}", response_model=SingleProductResponse, status_code=status.HTTP_200_OK)
-async def get_single_product(product_id: int):
+async def get_single_product(request: Request, product_id: int):
+    entry = product_cache.get(product_id)
+    if entry is not None:
+        return cached_response(request, entry)
     try:
         # product = await Product.get(id=product_id)
         # business = await product.business
         # owner = await business.owner
-        response = await product_pydantic.from_queryset_single(Product.get(id=product_id))
-        return {"status": "ok", "data": response}
+        # concurrent misses on the same product share a single query. The generation is part of the key: requests
+        # arriving after a write start a new load instead of joining one that may have read the old row.
+        generation = product_cache.generation
+        entry = await product_flight.do((product_id, generation), lambda: load_single_product(product_id, generation))
+        return cached_response(request, entry)
         # return {
         # "status": "ok",
         # "data": {
@@ -48,6 +245,14 @@ async def get_single_product(product_id: int):
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Product not found")
 
 
+async def load_single_product(product_id: int, generation: int) -> CachedResponse:
+    response = await product_pydantic.from_queryset_single(Product.all().using_db(read_db()).get(id=product_id))
+    body = SingleProductResponse(status="ok", data=response).model_dump_json()
+    entry = CachedResponse(body.encode(), response.updated_at)
+    product_cache.set(product_id, entry, generation=generation)
+    return entry
+
+
 # Add a single new product endpoint
 @router.post("/", response_model=AddProductResponse, status_code=status.HTTP_200_OK)
 async def add_new_product(product: product_pydantic_in, category_id: int):  # , user: user_pydantic = Depends(
@@ -74,6 +279,228 @@ async def add_new_product(product: product_pydantic_in, category_id: int):  # ,
     # raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Invalid data. Original price must be > 0")
 
 
+# Bulk import products endpoint.
+# The body is a JSON array, NDJSON or CSV (picked from the Content-Type or the format parameter) of products with
+# their category_id, and the response streams one NDJSON result per row followed by a summary line. NDJSON and CSV
+# bodies are parsed as they are received, a JSON array has to be read whole.
+@router.post("/bulk", response_class=StreamingResponse, status_code=status.HTTP_200_OK)
+async def bulk_import_products(request: Request, format: Optional[str] = Query(None, pattern="^(json|ndjson|csv)$")):
+    format = format or IMPORT_FORMATS.get(request.headers.get("content-type", "").split(";")[0].strip())
+    if format is None:
+        raise HTTPException(status_code=status.HTTP_415_UNSUPPORTED_MEDIA_TYPE,
+                            detail="Send a JSON array, NDJSON or CSV body")
+    if format == "json":
+        try:
+            rows = json.loads((await request.body()).decode("utf-8-sig"))
+        except ValueError:
+            raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Invalid JSON body")
+        if not isinstance(rows, list):
+            raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Expected a JSON array")
+        rows = iterate(rows)
+    elif format == "csv":
+        rows = parse_csv_rows(read_lines(request))
+    else:
+        rows = parse_ndjson_rows(read_lines(request))
+    return ImportResponse(import_products(rows), media_type="application/x-ndjson")
+
+
+# The request body is read while the response streams: StreamingResponse would read the body messages in its
+# disconnect listener, a disconnect is noticed by the body reads instead (ClientDisconnect)
+class ImportResponse(StreamingResponse):
+    async def __call__(self, scope, receive, send):
+        await self.stream_response(send)
+
+
+async def iterate(rows: Iterable) -> AsyncIterator:
+    for row in rows:
+        yield row
+
+
+# Lines of the request body, decoded as they are received
+async def read_lines(request: Request) -> AsyncIterator[str]:
+    decoder = codecs.getincrementaldecoder("utf-8-sig")(errors="replace")
+    pending = ""
+    async for chunk in request.stream():
+        *lines, pending = (pending + decoder.decode(chunk)).split("\n")
+        for line in lines:
+            yield line.removesuffix("\r")
+    pending += decoder.decode(b"", final=True)
+    if pending:
+        yield pending.removesuffix("\r")
+
+
+async def parse_ndjson_rows(lines: AsyncIterator[str]) -> AsyncIterator:
+    async for line in lines:
+        if line.strip():
+            yield _parse_ndjson_line(line)
+
+
+def _parse_ndjson_line(line: str):
+    try:
+        return json.loads(line)
+    except ValueError as e:
+        # reported as the error of that row
+        return ValueError(f"Invalid JSON: {e}")
+
+
+# Rows of a CSV body keyed by the header, like csv.DictReader. A quoted field can hold line breaks, the lines are
+# joined until the quotes are balanced (an escaped quote is doubled, so a complete record has an even number of them).
+async def parse_csv_rows(lines: AsyncIterator[str]) -> AsyncIterator[dict]:
+    header, record = None, []
+    async for line in lines:
+        record.append(line)
+        if sum(part.count('"') for part in record) % 2:
+            continue
+        values = next(csv.reader(["\n".join(record)]), [])
+        record = []
+        if not values:
+            continue
+        if header is None:
+            header = values
+        else:
+            yield dict(zip(header, values))
+    if record and header is not None:
+        yield dict(zip(header, next(csv.reader(["\n".join(record)]), [])))
+
+
+# Validate every row and insert the valid ones in chunks of IMPORT_CHUNK_SIZE, one transaction per chunk
+async def import_products(rows: AsyncIterator) -> AsyncIterator[bytes]:
+    created = failed = number = 0
+    # category ids already looked up, and the ones of them that exist
+    checked, category_ids = set(), set()
+    async for chunk in chunks(rows, IMPORT_CHUNK_SIZE):
+        # the categories the chunk references are resolved with a single query
+        referenced = {category_id for category_id in map(import_category_id, chunk) if category_id is not None}
+        if referenced - checked:
+            category_ids.update(await Category.filter(id__in=referenced - checked).values_list("id", flat=True))
+            checked |= referenced
+        products, results = [], []
+        for row in chunk:
+            number += 1
+            product, errors = validate_import_row(row, category_ids)
+            if errors:
+                results.append({"row": number, "status": "error", "errors": errors})
+            else:
+                products.append(product)
+                results.append({"row": number, "status": "created"})
+        if products:
+            try:
+                # named: with read replicas there are several connections
+                async with in_transaction("default"):
+                    await Product.bulk_create(products)
+            except Exception as e:
+                # the whole chunk is rolled back
+                for result in results:
+                    if result["status"] == "created":
+                        result.update(status="error", errors=[f"Insert failed: {e}"])
+            invalidate_products()
+            search_index.reset()
+        created += sum(result["status"] == "created" for result in results)
+        failed += sum(result["status"] == "error" for result in results)
+        yield b"".join(dumps(result) + b"\n" for result in results)
+    yield dumps({"status": "ok", "created": created, "failed": failed}) + b"\n"
+
+
+async def chunks(rows: AsyncIterator, size: int) -> AsyncIterator[list]:
+    chunk = []
+    async for row in rows:
+        chunk.append(row)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def import_category_id(row) -> Optional[int]:
+    try:
+        return int(row.get("category_id"))
+    except (AttributeError, TypeError, ValueError):
+        return None
+
+
+def validate_import_row(row, category_ids: set):
+    if isinstance(row, ValueError):
+        return None, [str(row)]
+    if not isinstance(row, dict):
+        return None, ["Row is not an object"]
+    errors = []
+    try:
+        # other columns (e.g. id or image_url in a file from the export) are ignored
+        product_info = product_pydantic_in.model_validate(
+            {key: row[key] for key in product_pydantic_in.model_fields if row.get(key) not in (None, "")}
+        ).model_dump(exclude_unset=True)
+    except ValidationError as e:
+        product_info = None
+        errors += [f"{'.'.join(map(str, error['loc']))}: {error['msg']}" for error in e.errors()]
+    category_id = import_category_id(row)
+    if category_id is None:
+        errors.append("category_id: A valid category id is required")
+    elif category_id not in category_ids:
+        errors.append("category_id: Category not found")
+    if errors:
+        return None, errors
+    return Product(**product_info, category_id=category_id), []
+
+
+# Bulk update products endpoint.
+# Every product is updated with the fields it sends, in a single transaction and with set-based queries. With upsert,
+# the products without id are created. Unknown ids are reported back in "missing".
+@router.put("/bulk", response_model=BulkUpdateProductsResponse, status_code=status.HTTP_200_OK)
+async def bulk_update_products(updates: List[ProductBulkUpdate] = Body(..., max_length=MAX_BULK_ITEMS),
+                               upsert: bool = False):
+    changes = {update.id: update.model_dump(exclude_unset=True, exclude={"id"}) for update in updates
+               if update.id is not None}
+    new_products = [update.model_dump(exclude_unset=True, exclude={"id"}) for update in updates if update.id is None]
+    if new_products and not upsert:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Every product needs an id without upsert")
+    for product_info in new_products:
+        if not {"name", "original_price", "category_id"} <= product_info.keys():
+            raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST,
+                                detail="New products need a name, an original_price and a category_id")
+    category_ids = {info["category_id"] for info in [*changes.values(), *new_products] if "category_id" in info}
+    if category_ids:
+        unknown = category_ids - set(await Category.filter(id__in=category_ids).values_list("id", flat=True))
+        if unknown:
+            raise HTTPException(status_code=status.HTTP_409_CONFLICT, detail=f"Categories not found: {sorted(unknown)}")
+
+    async with in_transaction("default"):
+        products = await Product.filter(id__in=list(changes)).select_for_update() if changes else []
+        now = timezone.now()
+        fields = {"updated_at"}
+        for product in products:
+            product.update_from_dict(changes[product.id])
+            # bulk_update does not apply auto_now
+            product.updated_at = now
+            fields.update(changes[product.id])
+        if products:
+            await Product.bulk_update(products, fields=sorted(fields), batch_size=500)
+        if new_products:
+            await Product.bulk_create([Product(**product_info) for product_info in new_products], batch_size=500)
+    found = {product.id for product in products}
+    invalidate_products(found)
+    if new_products:
+        # bulk_create does not return the new ids
+        search_index.reset()
+    else:
+        search_index.refresh(found)
+    return {"status": "ok", "updated": len(found), "created": len(new_products),
+            "missing": sorted(set(changes) - found)}
+
+
+# Bulk delete products endpoint, unknown ids are reported back in "missing"
+@router.delete("/bulk", response_model=BulkDeleteProductsResponse, status_code=status.HTTP_200_OK)
+async def bulk_delete_products(request: ProductBulkDelete):
+    ids = set(request.ids)
+    async with in_transaction("default"):
+        found = set(await Product.filter(id__in=ids).select_for_update().values_list("id", flat=True))
+        if found:
+            await Product.filter(id__in=found).delete()
+    invalidate_products(found)
+    search_index.refresh(found)
+    return {"status": "ok", "deleted": len(found), "missing": sorted(ids - found)}
+
+
 # Delete a single product endpoint
 @router.delete("/{product_id}", response_model=DeleteProductResponse, status_code=status.HTTP_200_OK)
 async def delete_single_product(product_id: int):  # , user: user_pydantic = Depends(get_current_user)
@@ -124,3 +551,31 @@ async def update_single_product(product_id: int, update_info: product_pydantic_i
         # )
     except IndexError:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Product not found")
+
+
+# Drop the cached payloads of the given products (all of them when ids is None) and of the listings, and keep the
+# reads on the primary until the replicas have the write. Bulk operations do not send signals, so they call it
+# themselves.
+def invalidate_products(ids: Optional[Iterable[int]] = None):
+    record_write()
+    if ids is None:
+        product_cache.clear()
+    else:
+        for product_id in ids:
+            product_cache.delete(product_id)
+    product_list_cache.clear()
+    # the product counts of the categories
+    category_list_cache.clear()
+
+
+# Signals: drop the cached payloads every time a product is written, and update its search index entry
+@post_save(Product)
+async def invalidate_product_on_save(sender, instance, created, using_db, update_fields):
+    invalidate_products([instance.id])
+    search_index.add(instance.id, instance.name)
+
+
+@post_delete(Product)
+async def invalidate_product_on_delete(sender, instance, using_db):
+    invalidate_products([instance.id])
+    search_index.remove(instance.id)
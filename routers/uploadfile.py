@@ -1,17 +1,9 @@
 from fastapi import APIRouter, HTTPException, status, Depends, UploadFile, File
 from models import *
 # from dotenv import dotenv_values
-from PIL import Image
+from images import IMAGES_DIR, store_image
 from routers.users import get_current_user
-import secrets
-import os
-
-credentials = {
-    "EMAIL": os.getenv("EMAIL"),
-    "PASSWORD": os.getenv("PASSWORD"),
-    "SECRET": os.getenv("SECRET"),
-    "SERVER_URL": os.getenv("SERVER_URL"),
-}
+from config import credentials
 
 router = APIRouter(prefix="/uploadfile", tags=["Upload files"],
                    responses={status.HTTP_400_BAD_REQUEST: {"description": "Invalid file format"}})
@@ -25,31 +17,14 @@ router = APIRouter(prefix="/uploadfile", tags=["Upload files"],
 # Upload user profile picture endpoint
 @router.post("/profile", response_model=UploadProfilePicResponse, status_code=status.HTTP_200_OK)
 async def upload_profile_picture(file: UploadFile = File(...), user: user_pydantic = Depends(get_current_user)):
-    filepath = "./static/images/"
-    filename = file.filename
-    extension = filename.split(".")[1]
-
-    if extension not in ["png", "jpg", "jpeg"]:
-        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Invalid file format")
-
-    token_name = secrets.token_hex(10) + "." + extension
-    generated_name = filepath + token_name
+    # stream the upload to disk, check its real format and resize it in the image worker processes
+    token_name = await store_image(file)
+    generated_name = IMAGES_DIR + token_name
 
     try:
-        file_content = await file.read()
-
-        with open(generated_name, "wb") as file:
-            file.write(file_content)
-
-        # resize image *PILLOW*
-        image = Image.open(generated_name)
-        image = image.resize((200, 200))
-        image.save(generated_name)
-        file.close()
-
-        business = await Business.get(owner=user)
+        business = await Business.get(owner_id=user.id)
         owner = await business.owner
-        if owner == user:
+        if owner.id == user.id:
             business.logo = token_name
             await business.save()
         else:
@@ -69,33 +44,16 @@ async def upload_profile_picture(file: UploadFile = File(...), user: user_pydant
 @router.post("/product/{product_id}", response_model=UploadProductPicResponse, status_code=status.HTTP_200_OK)
 async def upload_product_picture(file: UploadFile = File(...), product_id: int = None,
                                  user: user_pydantic = Depends(get_current_user)):
-    filepath = "./static/images/"
-    filename = file.filename
-    extension = filename.split(".")[1]
-
-    if extension not in ["png", "jpg", "jpeg"]:
-        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Invalid file format")
-
-    token_name = secrets.token_hex(10) + "." + extension
-    generated_name = filepath + token_name
+    # stream the upload to disk, check its real format and resize it in the image worker processes
+    token_name = await store_image(file)
+    generated_name = IMAGES_DIR + token_name
 
     try:
-        file_content = await file.read()
-
-        with open(generated_name, "wb") as file:
-            file.write(file_content)
-
-        # resize image *PILLOW*
-        image = Image.open(generated_name)
-        image = image.resize((200, 200))
-        image.save(generated_name)
-        file.close()
-
         product = await Product.get(id=product_id)
         business = await product.business
         owner = await business.owner
 
-        if owner == user:
+        if owner.id == user.id:
             product.image = token_name
             await product.save()
         else:
@@ -1,25 +1,13 @@
 from fastapi import APIRouter, HTTPException, status, Depends
 from models import *
 from fastapi.security import OAuth2PasswordBearer
-import jwt
-from dotenv import dotenv_values
-
-import os
-
-credentials = {
-    "EMAIL": os.getenv("EMAIL"),
-    "PASSWORD": os.getenv("PASSWORD"),
-    "SECRET": os.getenv("SECRET"),
-    "SERVER_URL": os.getenv("SERVER_URL"),
-}
+from authentication import get_user_from_token
+from config import credentials
 
 router = APIRouter(prefix="/users", tags=["Users"], responses={status.HTTP_404_NOT_FOUND: {"description": "User(s) "
                                                                                                           "not "
                                                                                                           "found"}})
 
-# instance to access the environment variables
-credentials = dotenv_values(".env")
-
 # create an instance for handling OAuth 2.0 bearer tokens
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="token")
 
@@ -27,15 +15,14 @@ oauth2_scheme = OAuth2PasswordBearer(tokenUrl="token")
 # Auxiliary function to validate and get the information of a user
 async def get_current_user(token: str = Depends(oauth2_scheme)):
     try:
-        payload = jwt.decode(token, credentials["SECRET"], algorithms=["HS256"])
-        user = await User.get(id=payload.get("id"))
+        user = await get_user_from_token(token)
     except NotImplementedError:
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
             detail="Invalid token",
             headers={"WWW-Authenticate": "Bearer"}
         )
-    return await user
+    return user
 
 
 # Endpoints:
@@ -58,7 +45,7 @@ async def get_all_users():
 @router.post("/me", response_model=SingleUserResponse, status_code=status.HTTP_200_OK)
 async def user_login(user: user_pydantic_in = Depends(get_current_user)):
     try:
-        business = await Business.get(owner=user)
+        business = await Business.get(owner_id=user.id)
         logo = business.logo
         logo_path = credentials["SERVER_URL"] + "/static/images/" + logo
         return {
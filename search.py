@@ -0,0 +1,264 @@
+from collections import Counter
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+from tortoise import Tortoise
+from tortoise.backends.base.client import BaseDBAsyncClient
+from models import Product, PRODUCT_FIELDS
+import asyncio
+import bisect
+import heapq
+import logging
+import math
+import re
+
+logger = logging.getLogger(__name__)
+
+# Words of product names and queries: runs of letters and digits, compared case-insensitively
+WORD = re.compile(r"[^\W_]+")
+MAX_QUERY_TERMS = 8
+
+# On Postgres the search runs in the database, on a full-text index of the names and a trigram one (pg_trgm) that
+# also matches misspelled words. The indexes are created by the migrations (migrations.SEARCH_INDEXES), their
+# expressions must stay the same as the ones of the queries below to be used.
+# Which of them exist, to pick the backend
+POSTGRES_SEARCH_SUPPORT = (
+    "SELECT EXISTS (SELECT 1 FROM pg_indexes WHERE schemaname = current_schema() "
+    "AND indexname = 'product_name_fts_idx') AS fts, "
+    "EXISTS (SELECT 1 FROM pg_indexes WHERE schemaname = current_schema() "
+    "AND indexname = 'product_name_trgm_idx') AS trigram, "
+    "EXISTS (SELECT 1 FROM pg_extension WHERE extname = 'pg_trgm') AS pg_trgm"
+)
+# $1: plain query, $2: prefix tsquery, $3: limit
+POSTGRES_SEARCH = (
+    "SELECT id, ts_rank(to_tsvector('simple', name), query) AS rank "
+    "FROM product, to_tsquery('simple', $2) AS query "
+    "WHERE to_tsvector('simple', name) @@ query "
+    "ORDER BY rank DESC, length(name), id LIMIT $3"
+)
+POSTGRES_TRIGRAM_SEARCH = (
+    "SELECT id, ts_rank(to_tsvector('simple', name), query) + similarity(name, $1) AS rank "
+    "FROM product, to_tsquery('simple', $2) AS query "
+    "WHERE to_tsvector('simple', name) @@ query OR name % $1 "
+    "ORDER BY rank DESC, length(name), id LIMIT $3"
+)
+
+
+def tokenize(text: str) -> List[str]:
+    return WORD.findall(text.casefold())
+
+
+# In-process inverted index of the product names, used when the database has no full-text search (SQLite, tests).
+# It is loaded with one query on the first search and then kept up to date one product at a time by the product
+# signals. Each worker keeps its own copy, so writes made through another worker are not seen until the index is
+# reset: it is meant for development and tests, production runs on Postgres.
+class SearchIndex:
+    def __init__(self):
+        # word -> ids of the products whose name contains it
+        self._postings: Dict[str, Set[int]] = {}
+        # sorted vocabulary, the words starting with a prefix are a contiguous slice of it
+        self._words: List[str] = []
+        # id -> words of its name
+        self._documents: Dict[int, Tuple[str, ...]] = {}
+        self._loaded = False
+        self._generation = 0
+        # products written since the index was loaded that have to be read again before the next search
+        self._stale: Set[int] = set()
+        self._lock = asyncio.Lock()
+
+    def add(self, product_id: int, name: str):
+        if not self._loaded:
+            self._stale.add(product_id)
+            return
+        self._remove(product_id)
+        self._add(product_id, name)
+
+    def remove(self, product_id: int):
+        if not self._loaded:
+            self._stale.add(product_id)
+            return
+        self._remove(product_id)
+
+    # Read the given products again before the next search (bulk writes do not send signals)
+    def refresh(self, ids: Iterable[int]):
+        self._stale.update(ids)
+
+    # Load the whole index again before the next search
+    def reset(self):
+        self._loaded = False
+        self._generation += 1
+
+    def stats(self) -> dict:
+        return {"loaded": self._loaded, "documents": len(self._documents), "words": len(self._words),
+                "stale": len(self._stale)}
+
+    # Ids of the best `limit` products matching every word of the query. Each query word matches the same word
+    # (full weight) and the words it is a prefix of (weighted by how much of the word it covers), weighted by how
+    # rare the word is. Ties go to the names with the fewest words.
+    async def search(self, query: str, limit: int) -> List[int]:
+        terms = list(dict.fromkeys(tokenize(query)[:MAX_QUERY_TERMS]))
+        if not terms:
+            return []
+        await self._sync()
+        scores = self._term_scores(terms[0], limit) if len(terms) == 1 else self._scores(terms)
+        return heapq.nlargest(limit, _best(scores, limit), key=lambda product_id: (
+            scores[product_id], -len(self._documents[product_id]), -product_id))
+
+    # Scores of a single word query: a product takes the weight of its best matching word
+    def _term_scores(self, term: str, limit: int) -> Dict[int, float]:
+        total = len(self._documents)
+        weighted = sorted(((self._weight(term, word, total), word) for word in self._prefixed(term)), reverse=True)
+        scores: Dict[int, float] = {}
+        # the heaviest words go last and overwrite the others
+        for weight, word in reversed(self._heaviest(weighted, limit)):
+            scores.update(dict.fromkeys(self._postings[word], weight))
+        return scores
+
+    # Scores of a query of several words: each word adds the weight of the best word of the name it matches. The
+    # longest words match the fewest products, so they go first and the others only look at their candidates.
+    def _scores(self, terms: List[str]) -> Dict[int, float]:
+        total = len(self._documents)
+        term_scores = []
+        candidates: Optional[Set[int]] = None
+        for term in sorted(terms, key=len, reverse=True):
+            scores: Dict[int, float] = {}
+            # the heaviest words go last and overwrite the others
+            for weight, word in sorted((self._weight(term, word, total), word) for word in self._prefixed(term)):
+                postings = self._postings[word]
+                scores.update(dict.fromkeys(postings if candidates is None else postings & candidates, weight))
+            candidates = set(scores) if candidates is None else candidates & scores.keys()
+            if not candidates:
+                return {}
+            term_scores.append(scores)
+        return {product_id: sum(scores[product_id] for scores in term_scores) for product_id in candidates}
+
+    # Words of the vocabulary starting with `prefix`
+    def _prefixed(self, prefix: str) -> List[str]:
+        start = bisect.bisect_left(self._words, prefix)
+        end = start
+        while end < len(self._words) and self._words[end].startswith(prefix):
+            end += 1
+        return self._words[start:end]
+
+    # Leading part of `weighted` (heaviest first) whose words cover at least `limit` products, with the ties of the
+    # last one: the products only matching lighter words cannot make it into the results
+    def _heaviest(self, weighted: List[Tuple[float, str]], limit: int) -> List[Tuple[float, str]]:
+        covered: Set[int] = set()
+        for position, (weight, word) in enumerate(weighted):
+            if len(covered) >= limit and weight < weighted[position - 1][0]:
+                return weighted[:position]
+            covered |= self._postings[word]
+        return weighted
+
+    def _weight(self, term: str, word: str, total: int) -> float:
+        return math.log(1 + total / len(self._postings[word])) * len(term) / len(word)
+
+    async def _sync(self):
+        if self._loaded and not self._stale:
+            return
+        async with self._lock:
+            while not self._loaded:
+                generation = self._generation
+                # the full load reads them anyway, the ones written while it runs are marked stale again
+                self._stale.clear()
+                rows = await Product.all().values_list("id", "name")
+                self._postings, self._words, self._documents = {}, [], {}
+                for product_id, name in rows:
+                    self._add(product_id, name, sort=False)
+                self._words.sort()
+                self._loaded = generation == self._generation
+            if self._stale:
+                ids, self._stale = self._stale, set()
+                names = dict(await Product.filter(id__in=ids).values_list("id", "name"))
+                for product_id in ids:
+                    self._remove(product_id)
+                    if product_id in names:
+                        self._add(product_id, names[product_id])
+
+    def _add(self, product_id: int, name: str, sort: bool = True):
+        words = tuple(dict.fromkeys(tokenize(name)))
+        self._documents[product_id] = words
+        for word in words:
+            postings = self._postings.get(word)
+            if postings is None:
+                postings = self._postings[word] = set()
+                if sort:
+                    bisect.insort(self._words, word)
+                else:
+                    self._words.append(word)
+            postings.add(product_id)
+
+    def _remove(self, product_id: int):
+        for word in self._documents.pop(product_id, ()):
+            postings = self._postings[word]
+            postings.discard(product_id)
+            if not postings:
+                del self._postings[word]
+                del self._words[bisect.bisect_left(self._words, word)]
+
+
+# Ids of the products scoring at least as much as the `limit`-th best one. There are only a few distinct scores, so
+# counting them is much cheaper than ranking every match when a short prefix matches most of the catalog.
+def _best(scores: Dict[int, float], limit: int) -> Iterable[int]:
+    if len(scores) <= limit:
+        return scores
+    counts = Counter(scores.values())
+    kept = 0
+    for threshold in sorted(counts, reverse=True):
+        kept += counts[threshold]
+        if kept >= limit:
+            break
+    return [product_id for product_id, score in scores.items() if score >= threshold]
+
+
+search_index = SearchIndex()
+
+# Search backend of the default connection, set by prepare_search: "postgres", "postgres_trigram" or "memory"
+_backend: Optional[str] = None
+
+
+# Pick the search backend from the indexes the migrations created, without any DDL. Called on startup, and by the
+# first search when the database was initialized without the app (scripts, benchmarks, FAST_START).
+async def prepare_search() -> str:
+    global _backend
+    if _backend is not None:
+        return _backend
+    connection = Tortoise.get_connection("default")
+    if connection.capabilities.dialect != "postgres":
+        _backend = "memory"
+        return _backend
+    try:
+        support = (await connection.execute_query_dict(POSTGRES_SEARCH_SUPPORT))[0]
+    except Exception as e:
+        logger.warning("Could not check the search indexes, using the full-text search: %s", e)
+        support = {"fts": True, "trigram": False, "pg_trgm": False}
+    if not support["fts"]:
+        # the full-text search still works, on a scan of the whole table
+        logger.warning("The product search indexes are missing, run python migrations.py")
+    if support["trigram"] and support["pg_trgm"]:
+        _backend = "postgres_trigram"
+    else:
+        logger.info("No trigram index, the search will not match misspelled words")
+        _backend = "postgres"
+    return _backend
+
+
+# Products matching the query, best first, as plain rows with `fields`, read from `connection` (the default one when
+# it is None)
+async def find_products(query: str, limit: int, fields: Iterable[str] = PRODUCT_FIELDS,
+                        connection: Optional[BaseDBAsyncClient] = None) -> List[dict]:
+    connection = connection or Tortoise.get_connection("default")
+    terms = tokenize(query)[:MAX_QUERY_TERMS]
+    if not terms:
+        return []
+    backend = await prepare_search()
+    if backend == "memory":
+        ids = await search_index.search(query, limit)
+    else:
+        sql = POSTGRES_TRIGRAM_SEARCH if backend == "postgres_trigram" else POSTGRES_SEARCH
+        # every word also matches as a prefix, the words only contain letters and digits so they are safe in a tsquery
+        prefix_query = " & ".join(term + ":*" for term in terms)
+        ranked = await connection.execute_query_dict(sql, [" ".join(terms), prefix_query, limit])
+        ids = [row["id"] for row in ranked]
+    # the rows are read by primary key, with the same query (and joins) whatever the backend
+    rows = {row["id"]: row for row in await Product.filter(id__in=ids).using_db(connection).values(*fields)}
+    # products deleted since the index was updated are skipped
+    return [rows[product_id] for product_id in ids if product_id in rows]
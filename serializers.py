@@ -0,0 +1,20 @@
+from decimal import Decimal
+import orjson
+
+
+# orjson does not handle Decimal, write it as a string like pydantic does
+def _default(value):
+    if isinstance(value, Decimal):
+        return str(value)
+    raise TypeError(f"Type is not JSON serializable: {type(value).__name__}")
+
+
+# Encode plain rows (dicts/lists from .values()) straight to JSON bytes.
+# The output matches pydantic's model_dump_json for the same data, so responses keep their schema.
+def dumps(content) -> bytes:
+    return orjson.dumps(content, default=_default, option=orjson.OPT_UTC_Z)
+
+
+# A datetime written the way dumps writes it ("Z" for UTC), for the bodies that are not JSON (CSV)
+def format_datetime(value) -> str:
+    return orjson.dumps(value, option=orjson.OPT_UTC_Z)[1:-1].decode()
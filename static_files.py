@@ -0,0 +1,239 @@
+from collections import OrderedDict
+from email.utils import format_datetime, parsedate_to_datetime
+from datetime import datetime, timezone
+from typing import Optional, Tuple
+from images import IMAGES_DIR, STORED_NAME, CHUNK_SIZE
+from config import setting
+import aiofiles
+import hashlib
+import mimetypes
+import stat
+import os
+
+# Files up to STATIC_CACHE_MAX_FILE bytes are kept in memory, the least recently used ones are dropped when all of
+# them go over STATIC_CACHE_BUDGET bytes
+STATIC_CACHE_BUDGET = int(setting("STATIC_CACHE_BUDGET", 32 * 1024 * 1024))
+STATIC_CACHE_MAX_FILE = int(setting("STATIC_CACHE_MAX_FILE", 256 * 1024))
+
+# Content-addressed names (uploads stored under their SHA-256) never change, the other files are revalidated
+IMMUTABLE_CACHE_CONTROL = "public, max-age=31536000, immutable"
+REVALIDATE_CACHE_CONTROL = "public, no-cache"
+
+
+# What the responses of a file need, computed once per version (mtime and size) of the file
+class FileInfo:
+    def __init__(self, path: str, stat_result: os.stat_result, etag: str, body: Optional[bytes] = None):
+        self.path = path
+        self.version = (stat_result.st_mtime_ns, stat_result.st_size)
+        self.size = stat_result.st_size
+        self.etag = etag
+        self.last_modified = format_datetime(datetime.fromtimestamp(int(stat_result.st_mtime), timezone.utc),
+                                             usegmt=True)
+        self.media_type = mimetypes.guess_type(path)[0] or "application/octet-stream"
+        self.cache_control = IMMUTABLE_CACHE_CONTROL if STORED_NAME.match(os.path.basename(path)) \
+            else REVALIDATE_CACHE_CONTROL
+        # content of the small files, None for the ones read from disk on every request
+        self.body = body
+
+
+# Files by path with an LRU eviction on the total bytes of the cached bodies (and on the number of entries). Every
+# entry keeps its strong ETag, so the large files are only hashed once per version too.
+class FileCache:
+    def __init__(self, name: str, budget: int = STATIC_CACHE_BUDGET, max_file_size: int = STATIC_CACHE_MAX_FILE,
+                 max_entries: int = 4096):
+        self.name = name
+        self.budget = budget
+        self.max_file_size = max_file_size
+        self.max_entries = max_entries
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        # path -> FileInfo, ordered from least to most recently used
+        self._entries = OrderedDict()
+
+    async def get(self, path: str, stat_result: os.stat_result) -> FileInfo:
+        info = self._entries.get(path)
+        if info is not None and info.version == (stat_result.st_mtime_ns, stat_result.st_size):
+            self._entries.move_to_end(path)
+            self.hits += 1
+            return info
+        self.misses += 1
+        info = await self._load(path, stat_result)
+        self._put(path, info)
+        return info
+
+    async def _load(self, path: str, stat_result: os.stat_result) -> FileInfo:
+        digest = hashlib.blake2b(digest_size=16)
+        keep = stat_result.st_size <= self.max_file_size
+        chunks = []
+        async with aiofiles.open(path, "rb") as file:
+            while chunk := await file.read(CHUNK_SIZE):
+                digest.update(chunk)
+                if keep:
+                    chunks.append(chunk)
+        body = b"".join(chunks) if keep else None
+        # the file changed while it was read, its size does not match the stat any more
+        if body is not None and len(body) != stat_result.st_size:
+            body = None
+        return FileInfo(path, stat_result, '"' + digest.hexdigest() + '"', body)
+
+    def _put(self, path: str, info: FileInfo):
+        previous = self._entries.pop(path, None)
+        if previous is not None and previous.body is not None:
+            self.bytes -= len(previous.body)
+        self._entries[path] = info
+        if info.body is not None:
+            self.bytes += len(info.body)
+        while self.bytes > self.budget or len(self._entries) > self.max_entries:
+            _, evicted = self._entries.popitem(last=False)
+            if evicted.body is not None:
+                self.bytes -= len(evicted.body)
+            self.evictions += 1
+
+    def clear(self):
+        self._entries.clear()
+        self.bytes = 0
+
+    def stats(self) -> dict:
+        return {
+            "size": len(self._entries),
+            "bytes": self.bytes,
+            "budget": self.budget,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+        }
+
+
+static_cache = FileCache("static")
+
+
+# Byte range (start, end inclusive) asked by a Range header, None to send the whole file. Only single ranges are
+# served, a multipart answer to several ranges is not worth it for images, so those get the whole file (RFC 9110
+# allows ignoring Range), as do the invalid ranges (e.g. bytes=5-1), which RFC 9110 says to ignore. Raises ValueError
+# when a valid range cannot be satisfied: it starts past the end of the file, or is an empty suffix.
+def parse_range(header: str, size: int) -> Optional[Tuple[int, int]]:
+    unit, _, ranges = header.partition("=")
+    if unit.strip().lower() != "bytes" or "," in ranges:
+        return None
+    first, separator, last = ranges.strip().partition("-")
+    if not separator or not (first or last) or not (first or "0").isdigit() or not (last or "0").isdigit():
+        return None
+    if not first:
+        # suffix range: the last `last` bytes
+        if int(last) == 0:
+            raise ValueError("empty suffix range")
+        return max(0, size - int(last)), size - 1
+    start = int(first)
+    if last and int(last) < start:
+        return None
+    if start >= size:
+        raise ValueError("range out of the file")
+    return start, min(int(last), size - 1) if last else size - 1
+
+
+# ASGI app serving the files of `directory`: strong ETags, Last-Modified, conditional requests, single byte ranges,
+# small files from memory and the others with zero-copy sends when the server offers the
+# http.response.zerocopysend or http.response.pathsend extensions, in chunks otherwise
+class StaticImages:
+    def __init__(self, directory: str = IMAGES_DIR, cache: FileCache = static_cache):
+        self.directory = os.path.realpath(directory)
+        self.cache = cache
+
+    async def __call__(self, scope, receive, send):
+        assert scope["type"] == "http"
+        if scope["method"] not in ("GET", "HEAD"):
+            return await self._send_empty(send, 405, [(b"allow", b"GET, HEAD")])
+        # the mount leaves the path relative to the mount point
+        path = self._resolve(scope["path"])
+        try:
+            stat_result = os.stat(path) if path else None
+        except (FileNotFoundError, NotADirectoryError):
+            stat_result = None
+        if stat_result is None or not stat.S_ISREG(stat_result.st_mode):
+            return await self._send_empty(send, 404)
+        info = await self.cache.get(path, stat_result)
+        request_headers = {name.decode("latin-1").lower(): value.decode("latin-1") for name, value in scope["headers"]}
+        headers = [(b"etag", info.etag.encode()), (b"last-modified", info.last_modified.encode()),
+                   (b"cache-control", info.cache_control.encode()), (b"accept-ranges", b"bytes")]
+        if self._not_modified(request_headers, info):
+            return await self._send_empty(send, 304, headers)
+
+        start, end, status = 0, info.size - 1, 200
+        range_header = request_headers.get("range")
+        if range_header and self._range_applies(request_headers.get("if-range"), info):
+            try:
+                byte_range = parse_range(range_header, info.size)
+            except ValueError:
+                content_range = (b"content-range", f"bytes */{info.size}".encode())
+                return await self._send_empty(send, 416, headers + [content_range])
+            if byte_range is not None:
+                (start, end), status = byte_range, 206
+                headers.append((b"content-range", f"bytes {start}-{end}/{info.size}".encode()))
+        count = end - start + 1 if info.size else 0
+        headers += [(b"content-type", info.media_type.encode()), (b"content-length", str(count).encode())]
+        await send({"type": "http.response.start", "status": status, "headers": headers})
+        if scope["method"] == "HEAD" or count == 0:
+            return await send({"type": "http.response.body", "body": b""})
+        if info.body is not None:
+            return await send({"type": "http.response.body", "body": info.body[start:end + 1]})
+        await self._send_file(scope, send, path, start, count, status == 200)
+
+    # Absolute path of a request path inside the directory, None when it would leave it
+    def _resolve(self, request_path: str) -> Optional[str]:
+        path = os.path.realpath(os.path.join(self.directory, request_path.lstrip("/")))
+        if os.path.commonpath([path, self.directory]) != self.directory:
+            return None
+        return path
+
+    # If-None-Match takes precedence over If-Modified-Since, as in cache.is_not_modified
+    @staticmethod
+    def _not_modified(request_headers: dict, info: FileInfo) -> bool:
+        if_none_match = request_headers.get("if-none-match")
+        if if_none_match is not None:
+            tags = [tag.strip().removeprefix("W/") for tag in if_none_match.split(",")]
+            return "*" in tags or info.etag in tags
+        if_modified_since = request_headers.get("if-modified-since")
+        if if_modified_since:
+            try:
+                return parsedate_to_datetime(info.last_modified) <= parsedate_to_datetime(if_modified_since)
+            except (TypeError, ValueError):
+                return False
+        return False
+
+    # The range is only served when the client still has the current version (If-Range, strong comparison)
+    @staticmethod
+    def _range_applies(if_range: Optional[str], info: FileInfo) -> bool:
+        if if_range is None:
+            return True
+        if if_range.startswith('"'):
+            return if_range == info.etag
+        return if_range == info.last_modified
+
+    @staticmethod
+    async def _send_file(scope, send, path: str, start: int, count: int, whole: bool):
+        extensions = scope.get("extensions") or {}
+        if whole and "http.response.pathsend" in extensions:
+            return await send({"type": "http.response.pathsend", "path": path})
+        if "http.response.zerocopysend" in extensions:
+            with open(path, "rb") as file:
+                return await send({"type": "http.response.zerocopysend", "file": file, "offset": start,
+                                   "count": count})
+        async with aiofiles.open(path, "rb") as file:
+            await file.seek(start)
+            while count > 0:
+                chunk = await file.read(min(CHUNK_SIZE, count))
+                if not chunk:
+                    break
+                count -= len(chunk)
+                await send({"type": "http.response.body", "body": chunk, "more_body": count > 0})
+            if count > 0:
+                # the file was truncated while it was sent
+                await send({"type": "http.response.body", "body": b""})
+
+    @staticmethod
+    async def _send_empty(send, status: int, headers: list = ()):
+        headers = list(headers) if status == 304 else list(headers) + [(b"content-length", b"0")]
+        await send({"type": "http.response.start", "status": status, "headers": headers})
+        await send({"type": "http.response.body", "body": b""})
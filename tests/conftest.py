@@ -0,0 +1,45 @@
+# The app runs in process on an in-memory SQLite database, a fresh one for every test.
+# Run the tests from the repository root, with the packages of requirements-dev.txt installed: python -m pytest
+import os
+
+os.environ.update({"POSTGRES_URL": "sqlite://:memory:", "SECRET": "test-secret", "GENERATE_SCHEMAS": "true",
+                   "FAST_START": "false", "ADMISSION_ENABLED": "false", "IMAGE_GC_INTERVAL": "0"})
+
+import httpx
+import pytest
+
+
+@pytest.fixture
+def anyio_backend():
+    return "asyncio"
+
+
+@pytest.fixture
+async def app():
+    from main import app
+    from cache import caches
+    from search import search_index
+
+    for cache in caches:
+        cache.clear()
+    # the in-memory search index would still have the products of the previous database
+    search_index.reset()
+    await app.router.startup()
+    try:
+        yield app
+    finally:
+        await app.router.shutdown()
+
+
+@pytest.fixture
+async def client(app):
+    async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://test") as client:
+        yield client
+
+
+@pytest.fixture
+async def catalog(app):
+    from models import Category, Product
+
+    category = await Category.create(name="books")
+    return [await Product.create(name=f"product-{i}", original_price=i + 0.99, category=category) for i in range(5)]
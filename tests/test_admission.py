@@ -0,0 +1,142 @@
+import asyncio
+import math
+import httpx
+import pytest
+import admission
+from admission import (AdmissionMiddleware, ConcurrencyLimiter, MemoryStore, RouteGroup, SQLiteStore, _refill,
+                       create_store)
+
+pytestmark = pytest.mark.anyio
+
+
+async def ok(scope, receive, send):
+    await send({"type": "http.response.start", "status": 200, "headers": []})
+    await send({"type": "http.response.body", "body": b"ok"})
+
+
+def client_for(app, *groups: RouteGroup, store=None) -> httpx.AsyncClient:
+    middleware = AdmissionMiddleware(app, groups, store or MemoryStore())
+    middleware.enabled = True
+    return httpx.AsyncClient(transport=httpx.ASGITransport(app=middleware), base_url="http://test")
+
+
+def test_refill():
+    assert _refill(2, 0, 0, rate=1, burst=2) == (1, 0)
+    # half a second at 1 token per second
+    assert _refill(0, 10, 10.5, rate=1, burst=2) == (0.5, 0.5)
+    # never more than the burst
+    assert _refill(1, 0, 100, rate=1, burst=2) == (1, 0)
+    assert _refill(0, 0, 100, rate=0, burst=2) == (0, math.inf)
+
+
+async def test_memory_store_drops_the_least_recently_used_buckets():
+    store = MemoryStore(max_keys=2)
+    for key in ("a", "b", "a", "c"):
+        await store.take(key, rate=1, burst=5)
+    assert list(store._buckets) == ["a", "c"]
+
+
+async def test_rate_limit_per_client(monkeypatch):
+    monkeypatch.setattr(admission, "TRUST_FORWARDED_FOR", True)
+    async with client_for(ok, RouteGroup("catalog", ("/products",), rate=0.5, burst=2, concurrency=10)) as client:
+        for _ in range(2):
+            assert (await client.get("/products/")).status_code == 200
+        response = await client.get("/products/")
+        assert response.status_code == 429
+        assert response.json() == {"detail": "Too many requests"}
+        # a token every 2 seconds
+        assert response.headers["retry-after"] == "2"
+        assert (await client.get("/products/", headers={"X-Forwarded-For": "10.0.0.2, 10.0.0.1"})).status_code == 200
+
+
+async def test_only_the_matching_group_applies():
+    group = RouteGroup("catalog", ("/products", "/categories"), rate=0.001, burst=1, concurrency=10)
+    assert group.matches("/products") and group.matches("/products/1") and group.matches("/categories/")
+    assert not group.matches("/productsx") and not group.matches("/users/products")
+    async with client_for(ok, group) as client:
+        assert (await client.get("/products/1")).status_code == 200
+        assert (await client.get("/categories/")).status_code == 429
+        for _ in range(3):
+            assert (await client.get("/users/me")).status_code == 200
+
+
+async def test_disabled_middleware_lets_everything_through():
+    group = RouteGroup("catalog", ("/products",), rate=0.001, burst=1, concurrency=10)
+    middleware = AdmissionMiddleware(ok, (group,), MemoryStore())
+    middleware.enabled = False
+    async with httpx.AsyncClient(transport=httpx.ASGITransport(app=middleware), base_url="http://test") as client:
+        for _ in range(3):
+            assert (await client.get("/products/")).status_code == 200
+
+
+# An app holding every request until `release` is set
+def blocking_app():
+    started, release = asyncio.Event(), asyncio.Event()
+
+    async def app(scope, receive, send):
+        started.set()
+        await release.wait()
+        await ok(scope, receive, send)
+
+    return app, started, release
+
+
+async def test_queued_requests_get_the_freed_slots():
+    app, started, release = blocking_app()
+    group = RouteGroup("catalog", ("/products",), rate=100, burst=100, concurrency=1)
+    group.limiter = ConcurrencyLimiter("test", limit=1, queue_size=1, timeout=5)
+    async with client_for(app, group) as client:
+        first = asyncio.create_task(client.get("/products/"))
+        await started.wait()
+        second = asyncio.create_task(client.get("/products/"))
+        while not group.limiter.queued:
+            await asyncio.sleep(0)
+        # the queue is full
+        response = await client.get("/products/")
+        assert response.status_code == 503 and response.headers["retry-after"] == "5"
+        release.set()
+        assert (await first).status_code == 200 and (await second).status_code == 200
+    assert group.limiter.in_flight == 0 and group.limiter.queued == 0
+
+
+async def test_queued_requests_are_shed_after_the_timeout():
+    app, started, release = blocking_app()
+    group = RouteGroup("catalog", ("/products",), rate=100, burst=100, concurrency=1)
+    group.limiter = ConcurrencyLimiter("test", limit=1, queue_size=5, timeout=0.05)
+    async with client_for(app, group) as client:
+        first = asyncio.create_task(client.get("/products/"))
+        await started.wait()
+        response = await client.get("/products/")
+        assert response.status_code == 503
+        assert response.json() == {"detail": "Server overloaded, retry later"}
+        assert response.headers["retry-after"] == "1"
+        release.set()
+        assert (await first).status_code == 200
+    assert group.limiter.in_flight == 0
+
+
+async def test_slot_is_released_when_the_app_fails():
+    async def failing(scope, receive, send):
+        raise RuntimeError("boom")
+
+    group = RouteGroup("catalog", ("/products",), rate=100, burst=100, concurrency=1)
+    async with client_for(failing, group) as client:
+        with pytest.raises(RuntimeError):
+            await client.get("/products/")
+    assert group.limiter.in_flight == 0
+
+
+async def test_sqlite_store_is_shared_by_the_workers(tmp_path):
+    path = tmp_path / "buckets.db"
+    first, second = SQLiteStore(str(path)), create_store(f"sqlite:///{path}")
+    assert isinstance(second, SQLiteStore)
+    assert await first.take("auth:10.0.0.1", rate=1, burst=2) == 0
+    assert await second.take("auth:10.0.0.1", rate=1, burst=2) == 0
+    assert 0 < await first.take("auth:10.0.0.1", rate=1, burst=2) <= 1
+    assert await second.take("auth:10.0.0.2", rate=1, burst=2) == 0
+
+
+def test_create_store():
+    assert isinstance(create_store("memory"), MemoryStore)
+    with pytest.raises(ValueError):
+        create_store("redis://localhost")
@@ -0,0 +1,30 @@
+import jwt
+import pytest
+from pydantic import ValidationError
+from authentication import get_user_from_token
+from cache import user_cache
+from models import Principal, User
+
+pytestmark = pytest.mark.anyio
+
+
+async def test_cached_user_is_an_immutable_principal(app):
+    user = await User.create(username="ada", email="ada@example.com", password="x")
+    token = jwt.encode({"id": user.id}, "test-secret", algorithm="HS256")
+    principal = await get_user_from_token(token)
+    assert isinstance(principal, Principal) and user_cache.get(user.id) is principal
+    with pytest.raises(ValidationError):
+        principal.is_verified = True
+
+
+async def test_verification_updates_the_user_and_drops_the_cached_principal(client):
+    user = await User.create(username="ada", email="ada@example.com", password="x")
+    token = jwt.encode({"id": user.id}, "test-secret", algorithm="HS256")
+    assert not (await get_user_from_token(token)).is_verified
+
+    response = await client.get("/verification", params={"token": token})
+    assert response.status_code == 200
+    assert (await User.get(id=user.id)).is_verified
+    assert (await get_user_from_token(token)).is_verified
+    # the link only works once
+    assert (await client.get("/verification", params={"token": token})).status_code == 401
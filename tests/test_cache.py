@@ -0,0 +1,98 @@
+import asyncio
+import pytest
+from cache import SingleFlight, TTLCache, product_cache
+
+pytestmark = pytest.mark.anyio
+
+
+def test_set_after_invalidation_is_dropped():
+    cache = TTLCache("test")
+    generation = cache.generation
+    cache.delete("key")
+    cache.set("key", "stale", generation=generation)
+    assert cache.get("key") is None
+    cache.set("key", "fresh", generation=cache.generation)
+    assert cache.get("key") == "fresh"
+
+
+# A product updated while a read of it is in flight must not stay cached with its old name
+async def test_write_during_read_does_not_cache_stale_product(client, catalog, monkeypatch):
+    from models import product_pydantic
+
+    product = catalog[0]
+    loaded, release = asyncio.Event(), asyncio.Event()
+    from_queryset_single = product_pydantic.from_queryset_single
+
+    # the row is read before the update and the entry built after it
+    async def slow_read(queryset):
+        row = await from_queryset_single(queryset)
+        loaded.set()
+        await release.wait()
+        return row
+
+    monkeypatch.setattr(product_pydantic, "from_queryset_single", slow_read)
+    read = asyncio.create_task(client.get(f"/products/{product.id}"))
+    await loaded.wait()
+    response = await client.put(f"/products/{product.id}",
+                                json={"name": "renamed", "original_price": "1.99", "image": product.image})
+    assert response.status_code == 200
+    release.set()
+    assert (await read).status_code == 200
+    monkeypatch.undo()
+
+    assert product_cache.get(product.id) is None
+    response = await client.get(f"/products/{product.id}")
+    assert response.json()["data"]["name"] == "renamed"
+
+
+# A load that waits for `release`, counting its calls
+def gated_load(release: asyncio.Event, result="loaded"):
+    calls = []
+
+    async def load():
+        calls.append(1)
+        await release.wait()
+        if isinstance(result, Exception):
+            raise result
+        return result
+
+    return load, calls
+
+
+async def test_concurrent_calls_share_one_load():
+    flight, release = SingleFlight("test"), asyncio.Event()
+    load, calls = gated_load(release)
+    waiters = [asyncio.create_task(flight.do("key", load)) for _ in range(3)]
+    other = asyncio.create_task(flight.do("other", load))
+    await asyncio.sleep(0)
+    assert flight.stats() == {"calls": 4, "coalesced": 2, "in_flight": 2}
+    release.set()
+    assert await asyncio.gather(*waiters, other) == ["loaded"] * 4
+    assert len(calls) == 2 and flight.stats()["in_flight"] == 0
+    # the next call loads again
+    assert await flight.do("key", load) == "loaded" and len(calls) == 3
+
+
+async def test_failed_load_reaches_every_waiter():
+    flight, release = SingleFlight("test"), asyncio.Event()
+    load, calls = gated_load(release, ValueError("database down"))
+    waiters = [asyncio.create_task(flight.do("key", load)) for _ in range(3)]
+    await asyncio.sleep(0)
+    release.set()
+    results = await asyncio.gather(*waiters, return_exceptions=True)
+    assert len(calls) == 1
+    assert all(isinstance(result, ValueError) for result in results)
+    assert flight.stats()["in_flight"] == 0
+
+
+async def test_cancelled_caller_does_not_cancel_the_load():
+    flight, release = SingleFlight("test"), asyncio.Event()
+    load, calls = gated_load(release)
+    first = asyncio.create_task(flight.do("key", load))
+    second = asyncio.create_task(flight.do("key", load))
+    await asyncio.sleep(0)
+    first.cancel()
+    release.set()
+    assert await second == "loaded" and len(calls) == 1
+    with pytest.raises(asyncio.CancelledError):
+        await first
@@ -0,0 +1,50 @@
+import pytest
+from models import Category, Product
+
+pytestmark = pytest.mark.anyio
+
+FUTURE = "Fri, 01 Jan 2100 00:00:00 GMT"
+
+
+async def revalidate(client, path: str, response):
+    return await client.get(path, headers={"If-None-Match": response.headers["etag"], "If-Modified-Since": FUTURE})
+
+
+async def test_category_counts_are_revalidated_by_etag_only(client, catalog):
+    response = await client.get("/categories/")
+    assert "last-modified" not in response.headers
+    await Product.create(name="another", original_price="1.00", category_id=catalog[0].category_id)
+    assert (await client.get("/categories/", headers={"If-Modified-Since": FUTURE})).status_code == 200
+    response = await revalidate(client, "/categories/", response)
+    assert response.status_code == 200 and response.json()["categories"][0]["product_count"] == 6
+
+
+@pytest.mark.parametrize("path", ["/products/?embed=category", "/products/search?q=product&embed=category",
+                                  "/products/batch?ids=1,2&embed=category"])
+async def test_embedded_categories_are_revalidated_by_etag_only(client, catalog, path):
+    response = await client.get(path)
+    assert "last-modified" not in response.headers
+    assert (await revalidate(client, path, response)).status_code == 304
+    category = await Category.get(id=catalog[0].category_id)
+    category.name = "novels"
+    await category.save()
+    assert (await client.get(path, headers={"If-Modified-Since": FUTURE})).status_code == 200
+    response = await revalidate(client, path, response)
+    assert response.status_code == 200 and response.json()["products"][0]["category"]["name"] == "novels"
+
+
+@pytest.mark.parametrize("path", ["/products/", "/products/search?q=product", "/products/batch?ids=1,2"])
+async def test_collections_are_revalidated_after_a_delete(client, catalog, path):
+    response = await client.get(path)
+    assert "last-modified" not in response.headers
+    await (await Product.get(id=2)).delete()
+    assert (await client.get(path, headers={"If-Modified-Since": FUTURE})).status_code == 200
+    response = await revalidate(client, path, response)
+    assert response.status_code == 200 and 2 not in [product["id"] for product in response.json()["products"]]
+
+
+async def test_single_product_keeps_last_modified(client, catalog):
+    response = await client.get(f"/products/{catalog[0].id}")
+    assert "last-modified" in response.headers
+    response = await client.get(f"/products/{catalog[0].id}", headers={"If-Modified-Since": FUTURE})
+    assert response.status_code == 304
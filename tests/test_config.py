@@ -0,0 +1,18 @@
+import os
+import subprocess
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+# Every module reads its settings through config.setting: from the environment first, then from .env
+def test_settings_are_read_from_dotenv(tmp_path):
+    (tmp_path / ".env").write_text('CATALOG_CACHE_TTL="7"\nMAIL_WORKERS="5"\nGZIP_LEVEL="9"\n')
+    env = {key: value for key, value in os.environ.items()
+           if key not in ("CATALOG_CACHE_TTL", "MAIL_WORKERS", "GZIP_LEVEL")}
+    env.update(PYTHONPATH=ROOT, GZIP_LEVEL="1")
+    script = ("import cache, emails, content_encoding; "
+              "print(cache.product_cache.ttl, emails.mail_queue.workers, content_encoding.GZIP_LEVEL)")
+    output = subprocess.run([sys.executable, "-c", script], cwd=tmp_path, env=env, capture_output=True, text=True,
+                            check=True).stdout
+    assert output.split() == ["7.0", "5", "1"]
@@ -0,0 +1,134 @@
+import gzip
+import zlib
+import pytest
+import content_encoding
+from content_encoding import CompressionMiddleware, negotiate
+from models import Product
+
+pytestmark = pytest.mark.anyio
+
+BODY = b'{"name": "product"}' * 100
+
+
+@pytest.mark.parametrize("accept_encoding, expected", [
+    (None, None),
+    ("", None),
+    ("identity", None),
+    ("gzip", "gzip"),
+    ("GZIP;q=0.5, deflate", "gzip"),
+    ("gzip;q=0.5, br;q=0.8", "br"),
+    ("gzip, br;q=0.8", "gzip"),
+    ("gzip, br;q=0", "gzip"),
+    ("gzip;q=0", None),
+    ("gzip;q=oops", None),
+    ("*", "br"),
+    ("*;q=0.5, gzip", "gzip"),
+    ("br, zstd, gzip", "br"),
+    ("gzip, zstd", "zstd"),
+])
+def test_negotiate(accept_encoding, expected):
+    assert negotiate(accept_encoding) == expected
+
+
+def test_negotiate_only_offers_the_installed_codings(monkeypatch):
+    monkeypatch.setattr(content_encoding, "compressors", {"gzip": content_encoding.compressors["gzip"]})
+    assert negotiate("br, gzip;q=0.1") == "gzip"
+    assert negotiate("br") is None
+
+
+# Run `messages` through the middleware, returning what it sends
+async def call(messages, accept_encoding="gzip", minimum_size=1024):
+    async def app(scope, receive, send):
+        for message in messages:
+            await send(message)
+
+    sent = []
+
+    async def send(message):
+        sent.append(message)
+
+    scope = {"type": "http", "headers": [(b"accept-encoding", accept_encoding.encode())] if accept_encoding else []}
+    await CompressionMiddleware(app, minimum_size)(scope, None, send)
+    return sent
+
+
+def start(content_type=b"application/json", *headers):
+    return {"type": "http.response.start", "status": 200,
+            "headers": [(b"content-type", content_type), (b"content-length", b"1900"), *headers]}
+
+
+def body(chunk: bytes, more_body=False):
+    return {"type": "http.response.body", "body": chunk, "more_body": more_body}
+
+
+async def test_compresses_a_whole_body():
+    sent = await call([start(), body(BODY)])
+    headers = dict(sent[0]["headers"])
+    assert headers[b"content-encoding"] == b"gzip" and headers[b"vary"] == b"Accept-Encoding"
+    assert int(headers[b"content-length"]) == len(sent[1]["body"])
+    assert gzip.decompress(sent[1]["body"]) == BODY
+
+
+@pytest.mark.parametrize("messages, accept_encoding", [
+    ([start(), body(b"{}")], "gzip"),
+    ([start(b"image/png"), body(BODY)], "gzip"),
+    ([start(b"application/json", (b"content-encoding", b"br")), body(BODY)], "gzip"),
+    ([start(), body(BODY)], "identity"),
+    ([start(), body(BODY)], None),
+])
+async def test_responses_sent_as_they_are(messages, accept_encoding):
+    assert await call(messages, accept_encoding) == messages
+
+
+async def test_streamed_chunks_are_flushed_one_by_one():
+    chunks = [b'{"row": %d}\n' % i for i in range(5)]
+    sent = await call([start(b"application/x-ndjson")] + [body(chunk, True) for chunk in chunks] + [body(b"")],
+                      minimum_size=1)
+    headers = dict(sent[0]["headers"])
+    assert headers[b"content-encoding"] == b"gzip" and b"content-length" not in headers
+    decompressor = zlib.decompressobj(31)
+    # every chunk can be decoded as soon as it is received
+    for chunk, message in zip(chunks, sent[1:]):
+        assert message["more_body"]
+        assert decompressor.decompress(message["body"]) == chunk
+    assert not sent[-1]["more_body"]
+    assert decompressor.decompress(sent[-1]["body"]) == b"" and decompressor.eof
+
+
+async def test_files_sent_by_the_server_are_not_compressed():
+    messages = [start(), {"type": "http.response.pathsend", "path": "/tmp/file"}]
+    assert await call(messages) == messages
+
+
+@pytest.fixture
+async def large_catalog(catalog):
+    for i in range(20):
+        await Product.create(name=f"large-product-{i}", original_price="1.00", category_id=catalog[0].category_id)
+
+
+@pytest.mark.parametrize("encoding", ["gzip", "br", "zstd"])
+async def test_cached_payloads_have_an_etag_per_coding(client, large_catalog, encoding):
+    plain = await client.get("/products/", headers={"Accept-Encoding": "identity"})
+    assert "content-encoding" not in plain.headers
+    digest = plain.headers["etag"].strip('"')
+    encoded = await client.get("/products/", headers={"Accept-Encoding": encoding})
+    assert encoded.headers["content-encoding"] == encoding
+    assert encoded.headers["etag"] == f'"{digest}-{encoding}"'
+    assert encoded.headers["vary"] == "Accept-Encoding"
+    assert encoded.json() == plain.json()
+
+
+async def test_if_none_match_matches_every_coding(client, large_catalog):
+    gzipped = await client.get("/products/", headers={"Accept-Encoding": "gzip"})
+    for accept_encoding in ("identity", "gzip", "br"):
+        response = await client.get("/products/", headers={"Accept-Encoding": accept_encoding,
+                                                           "If-None-Match": gzipped.headers["etag"]})
+        assert response.status_code == 304
+        assert "content-encoding" not in response.headers
+    response = await client.get("/products/", headers={"Accept-Encoding": "gzip", "If-None-Match": '"other-gzip"'})
+    assert response.status_code == 200
+
+
+async def test_small_cached_payloads_are_not_compressed(client, catalog):
+    response = await client.get(f"/products/{catalog[0].id}", headers={"Accept-Encoding": "gzip"})
+    assert "content-encoding" not in response.headers and "-" not in response.headers["etag"]
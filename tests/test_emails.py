@@ -0,0 +1,76 @@
+from email.mime.text import MIMEText
+import asyncio
+import socket
+import pytest
+from aiosmtpd.controller import Controller
+from emails import MailQueue
+
+pytestmark = pytest.mark.anyio
+
+
+# Accepts every message except the ones to refused@example.com, and records the session of each message
+class Handler:
+    def __init__(self):
+        self.messages = []
+        self.refused = 0
+
+    async def handle_RCPT(self, server, session, envelope, address, rcpt_options):
+        if address == "refused@example.com":
+            self.refused += 1
+            return "550 No such user"
+        envelope.rcpt_tos.append(address)
+        return "250 OK"
+
+    async def handle_DATA(self, server, session, envelope):
+        self.messages.append((id(session), envelope.rcpt_tos))
+        return "250 Message accepted"
+
+
+@pytest.fixture
+def smtp_server():
+    with socket.socket() as probe:
+        probe.bind(("127.0.0.1", 0))
+        port = probe.getsockname()[1]
+    handler = Handler()
+    controller = Controller(handler, hostname="127.0.0.1", port=port)
+    controller.start()
+    try:
+        yield controller
+    finally:
+        controller.stop()
+
+
+@pytest.fixture
+async def mail_queue(smtp_server):
+    queue = MailQueue(hostname=smtp_server.hostname, port=smtp_server.port, sender="shop@example.com", use_tls=False,
+                      workers=1, retry_delay=0.01)
+    yield queue
+    await queue.stop(timeout=1)
+
+
+def message(to: str = None) -> MIMEText:
+    message = MIMEText("hello")
+    if to:
+        message["To"] = to
+    return message
+
+
+async def test_messages_share_the_smtp_session(smtp_server, mail_queue):
+    for i in range(5):
+        await mail_queue.enqueue(message(f"user{i}@example.com"))
+    await asyncio.wait_for(mail_queue._queue.join(), 5)
+    assert mail_queue.stats()["sent"] == 5
+    assert len(smtp_server.handler.messages) == 5
+    assert len({session for session, _ in smtp_server.handler.messages}) == 1
+
+
+# A message the client rejects (no recipient) or the server refuses for good fails once, and the worker keeps going
+async def test_failed_messages_do_not_stop_the_worker(smtp_server, mail_queue):
+    await mail_queue.enqueue(message())
+    await mail_queue.enqueue(message("refused@example.com"))
+    await mail_queue.enqueue(message("user@example.com"))
+    await asyncio.wait_for(mail_queue._queue.join(), 5)
+    assert mail_queue.stats() == {"backlog": 0, "sent": 1, "failed": 2, "dropped": 0}
+    # 5xx replies are not retried
+    assert smtp_server.handler.refused == 1
+    assert smtp_server.handler.messages[0][1] == ["user@example.com"]
@@ -0,0 +1,59 @@
+import csv
+import io
+import json
+from datetime import timedelta
+import pytest
+import routers.products
+from models import Category, Product
+from metrics import query_budget
+
+pytestmark = pytest.mark.anyio
+
+
+async def export(client, **params) -> list:
+    response = await client.get("/products/export", params=params)
+    assert response.status_code == 200
+    if params.get("format") == "csv":
+        assert response.headers["content-type"].startswith("text/csv")
+        return list(csv.DictReader(io.StringIO(response.text)))
+    assert response.headers["content-type"] == "application/x-ndjson"
+    return [json.loads(line) for line in response.text.splitlines()]
+
+
+async def test_ndjson_and_csv_hold_the_same_values(client, catalog):
+    ndjson, rows = await export(client), await export(client, format="csv")
+    assert [row["name"] for row in ndjson] == [f"product-{i}" for i in range(5)]
+    assert len(rows) == 5
+    for line, row in zip(ndjson, rows):
+        assert row.keys() == line.keys()
+        assert row["updated_at"] == line["updated_at"] and row["updated_at"].endswith("Z")
+        assert row["original_price"] == line["original_price"]
+        assert int(row["id"]) == line["id"] and int(row["category_id"]) == line["category_id"]
+
+
+@pytest.mark.parametrize("format", ["ndjson", "csv"])
+async def test_export_walks_the_catalog_in_batches(client, catalog, monkeypatch, format):
+    monkeypatch.setattr(routers.products, "EXPORT_BATCH_SIZE", 2)
+    # 3 batches, the last one is short so no 4th query
+    async with query_budget(3):
+        rows = await export(client, format=format)
+    assert [int(row["id"]) for row in rows] == [product.id for product in catalog]
+
+
+async def test_export_of_an_exact_number_of_batches(client, catalog, monkeypatch):
+    monkeypatch.setattr(routers.products, "EXPORT_BATCH_SIZE", 5)
+    assert len(await export(client)) == 5
+
+
+async def test_export_filters(client, catalog, monkeypatch):
+    monkeypatch.setattr(routers.products, "EXPORT_BATCH_SIZE", 2)
+    films = await Category.create(name="films")
+    film = await Product.create(name="film", original_price=1, category=films)
+    assert [row["name"] for row in await export(client, category_id=films.id)] == ["film"]
+    assert len(await export(client, category_id=catalog[0].category_id)) == 5
+
+    await Product.filter(id__in=[catalog[1].id, catalog[3].id]).update(updated_at=film.updated_at + timedelta(hours=1))
+    since = (film.updated_at + timedelta(minutes=1)).isoformat()
+    assert [row["name"] for row in await export(client, updated_since=since)] == ["product-1", "product-3"]
+    assert [row["name"] for row in await export(client, format="csv", updated_since=since,
+                                                 category_id=films.id)] == []
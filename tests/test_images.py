@@ -0,0 +1,151 @@
+import hashlib
+import io
+import os
+import time
+import pytest
+from fastapi import HTTPException, UploadFile
+from PIL import Image
+import images
+
+pytestmark = pytest.mark.anyio
+
+
+@pytest.fixture
+def images_dir(tmp_path, monkeypatch):
+    monkeypatch.setattr(images, "IMAGES_DIR", str(tmp_path))
+    monkeypatch.setattr(images, "DERIVED_DIR", str(tmp_path / "derived"))
+    return tmp_path
+
+
+def save_image(path, color: str, mtime: float = None):
+    Image.new("RGB", (300, 300), color).save(path, "PNG")
+    if mtime is not None:
+        os.utime(path, (mtime, mtime))
+
+
+async def test_variant_of_a_replaceable_image_is_revalidated_and_derived_again(client, images_dir):
+    save_image(images_dir / "default.png", "red", mtime=1_000_000)
+    response = await client.get("/images/thumb/default.png")
+    assert response.status_code == 200
+    assert response.headers["cache-control"] == "public, max-age=300"
+    etag = response.headers["etag"]
+    with Image.open(images_dir / "derived" / "thumb-default.png.webp") as variant:
+        assert variant.convert("RGB").getpixel((0, 0))[0] > 200
+
+    response = await client.get("/images/thumb/default.png", headers={"If-None-Match": etag})
+    assert response.status_code == 304
+
+    # replaced by a newer file: a new ETag and a new variant
+    save_image(images_dir / "default.png", "blue")
+    response = await client.get("/images/thumb/default.png", headers={"If-None-Match": etag})
+    assert response.status_code == 200 and response.headers["etag"] != etag
+    with Image.open(images_dir / "derived" / "thumb-default.png.webp") as variant:
+        assert variant.convert("RGB").getpixel((0, 0))[2] > 200
+
+
+async def test_variant_of_a_content_addressed_image_is_immutable(client, images_dir):
+    name = "a" * 64 + ".png"
+    save_image(images_dir / name, "red")
+    response = await client.get(f"/images/small/{name}", params={"format": "jpg"})
+    assert response.status_code == 200
+    assert response.headers["cache-control"] == "public, max-age=31536000, immutable"
+
+
+def image_bytes(color: str, image_format: str = "PNG") -> bytes:
+    buffer = io.BytesIO()
+    Image.new("RGB", (20, 20), color).save(buffer, image_format)
+    return buffer.getvalue()
+
+
+def upload(content: bytes, filename: str = "picture.png", size: int = None) -> UploadFile:
+    return UploadFile(io.BytesIO(content), size=size, filename=filename)
+
+
+class NoExecutor:
+    def submit(self, *args, **kwargs):
+        raise AssertionError("the image was processed again")
+
+
+async def test_images_are_stored_under_their_content_hash(images_dir):
+    for image_format, extension in (("PNG", "png"), ("JPEG", "jpg")):
+        content = image_bytes("red", image_format)
+        name = await images.store_image(upload(content))
+        assert name == hashlib.sha256(content).hexdigest() + "." + extension
+        assert images.STORED_NAME.match(name)
+        with Image.open(images_dir / name) as image:
+            assert image.format == image_format
+
+
+async def test_same_upload_is_not_decoded_again(images_dir, monkeypatch):
+    content = image_bytes("red")
+    name = await images.store_image(upload(content))
+    os.utime(images_dir / name, (1_000_000, 1_000_000))
+    monkeypatch.setattr(images, "image_executor", NoExecutor())
+    assert await images.store_image(upload(content, "another-name.png")) == name
+    # the garbage collector grace period starts again
+    assert os.stat(images_dir / name).st_mtime > 1_000_000
+    assert [path.name for path in images_dir.iterdir()] == [name]
+
+
+async def test_image_reference_counts(app, catalog):
+    for product, image in zip(catalog, ["a.png", "a.png", "b.png"]):
+        product.image = image
+        await product.save()
+    assert await images.image_reference_counts() == {"a.png": 2, "b.png": 1, "defaultProduct.png": 2}
+
+
+async def test_orphaned_images_are_collected_after_the_grace_period(app, catalog, images_dir):
+    now = time.time()
+    referenced, old, recent = ("%064x.png" % i for i in range(3))
+    for name, mtime in ((referenced, now - 7200), (old, now - 7200), (recent, now - 60), ("default.png", now - 7200)):
+        save_image(images_dir / name, "red", mtime)
+    catalog[0].image = referenced
+    await catalog[0].save()
+    (images_dir / "derived").mkdir()
+    for name in (referenced, old):
+        for variant, image_format in (("thumb", "webp"), ("large", "jpg")):
+            (images_dir / "derived" / f"{variant}-{name}.{image_format}").write_bytes(b"variant")
+
+    assert await images.collect_orphaned_images(grace=3600) == 1
+    assert sorted(path.name for path in images_dir.glob("*.png")) == sorted([referenced, recent, "default.png"])
+    assert sorted(path.name for path in (images_dir / "derived").iterdir()) == [
+        f"large-{referenced}.jpg", f"thumb-{referenced}.webp"]
+    assert await images.collect_orphaned_images(grace=0) == 1
+    assert not (images_dir / recent).exists()
+
+
+@pytest.mark.parametrize("size", [None, 200])
+async def test_uploads_over_the_size_limit_are_rejected(images_dir, monkeypatch, size):
+    monkeypatch.setattr(images, "MAX_UPLOAD_SIZE", 100)
+    with pytest.raises(HTTPException) as error:
+        await images.store_image(upload(b"x" * 200, size=size))
+    assert error.value.status_code == 413
+    assert list(images_dir.iterdir()) == []
+
+
+@pytest.mark.parametrize("content", [b"not an image", image_bytes("red", "GIF"), image_bytes("red")[:50]])
+async def test_files_that_are_not_an_accepted_image_are_rejected(images_dir, content):
+    # the name and the declared type are not trusted, Pillow checks the content
+    with pytest.raises(HTTPException) as error:
+        await images.store_image(upload(content, "picture.png"))
+    assert error.value.status_code == 400
+    assert list(images_dir.iterdir()) == []
+
+
+async def test_image_is_stored_with_the_extension_of_its_real_format(images_dir):
+    content = image_bytes("red", "JPEG")
+    name = await images.store_image(upload(content, "picture.png"))
+    assert name.endswith(".jpg")
+    assert [path.name for path in images_dir.iterdir()] == [name]
+
+
+async def test_temporary_file_is_removed_when_the_processing_fails(images_dir, monkeypatch):
+    class FailingExecutor:
+        def submit(self, *args, **kwargs):
+            assert len(list(images_dir.glob("*.upload"))) == 1
+            raise OSError("disk full")
+
+    monkeypatch.setattr(images, "image_executor", FailingExecutor())
+    with pytest.raises(HTTPException):
+        await images.store_image(upload(image_bytes("red")))
+    assert list(images_dir.iterdir()) == []
@@ -0,0 +1,113 @@
+import json
+import pytest
+import routers.products
+from models import Category, Product
+
+pytestmark = pytest.mark.anyio
+
+
+async def post(client, body, content_type: str, **params):
+    response = await client.post("/products/bulk", content=body, headers={"Content-Type": content_type},
+                                 params=params)
+    assert response.status_code == 200, response.text
+    return [json.loads(line) for line in response.text.splitlines()]
+
+
+async def names():
+    return await Product.all().order_by("id").values_list("name", flat=True)
+
+
+@pytest.fixture
+async def category(app):
+    return await Category.create(name="books")
+
+
+@pytest.mark.parametrize("content_type, body", [
+    ("application/json", '[{"name": "a", "original_price": "1.50", "category_id": 1}, '
+                         '{"name": "b", "original_price": 2, "category_id": "1"}]'),
+    ("application/x-ndjson", '{"name": "a", "original_price": "1.50", "category_id": 1}\r\n\n'
+                             '{"name": "b", "original_price": 2, "category_id": 1}'),
+    ("text/csv", "﻿name,original_price,category_id\r\na,1.50,1\r\n\r\nb,2,1\r\n"),
+])
+async def test_formats(client, category, content_type, body):
+    results = await post(client, body.encode(), content_type)
+    assert results == [{"row": 1, "status": "created"}, {"row": 2, "status": "created"},
+                       {"status": "ok", "created": 2, "failed": 0}]
+    assert await names() == ["a", "b"]
+
+
+async def test_format_parameter_overrides_the_content_type(client, category):
+    results = await post(client, b"name,original_price,category_id\na,1,1\n", "text/plain", format="csv")
+    assert results[-1] == {"status": "ok", "created": 1, "failed": 0}
+
+
+async def test_csv_fields_can_hold_quotes_and_line_breaks(client, category):
+    body = 'name,original_price,category_id\n"the ""big""\nbook",1,1\nsmall,2,1\n'.encode()
+    results = await post(client, body, "text/csv")
+    assert results[-1] == {"status": "ok", "created": 2, "failed": 0}
+    assert await names() == ['the "big"\nbook', "small"]
+
+
+async def test_body_is_parsed_as_it_is_received(client, category):
+    body = "".join(f'{{"name": "é{i}", "original_price": 1, "category_id": 1}}\n' for i in range(3)).encode()
+
+    async def chunked():
+        # split in the middle of the lines and of the two bytes of "é"
+        for start in range(0, len(body), 7):
+            yield body[start:start + 7]
+
+    results = await post(client, chunked(), "application/x-ndjson")
+    assert results[-1] == {"status": "ok", "created": 3, "failed": 0}
+    assert await names() == ["é0", "é1", "é2"]
+
+
+async def test_rows_are_validated_one_by_one(client, category):
+    body = "\n".join([
+        '{"name": "ok", "original_price": 1, "category_id": 1}',
+        '{"name": "broken"',
+        '["not", "an", "object"]',
+        '{"original_price": "free", "category_id": 1}',
+        '{"name": "no category", "original_price": 1}',
+        '{"name": "unknown category", "original_price": 1, "category_id": 99}',
+    ]).encode()
+    results = await post(client, body, "application/x-ndjson")
+    assert results[0] == {"row": 1, "status": "created"}
+    assert results[1]["errors"][0].startswith("Invalid JSON")
+    assert results[2]["errors"] == ["Row is not an object"]
+    assert {error.split(":")[0] for error in results[3]["errors"]} == {"name", "original_price"}
+    assert results[4]["errors"] == ["category_id: A valid category id is required"]
+    assert results[5]["errors"] == ["category_id: Category not found"]
+    assert all(result["status"] == "error" for result in results[1:6])
+    assert results[6] == {"status": "ok", "created": 1, "failed": 5}
+    assert await names() == ["ok"]
+
+
+async def test_chunks_resolve_their_own_categories(client, category, monkeypatch):
+    monkeypatch.setattr(routers.products, "IMPORT_CHUNK_SIZE", 2)
+    other = await Category.create(name="films")
+    rows = [{"name": f"p{i}", "original_price": 1, "category_id": 1} for i in range(3)]
+    rows += [{"name": "p3", "original_price": 1, "category_id": other.id}, {"name": "p4", "original_price": 1,
+                                                                            "category_id": 99}]
+    results = await post(client, json.dumps(rows).encode(), "application/json")
+    assert [result["row"] for result in results[:-1]] == [1, 2, 3, 4, 5]
+    assert results[-1] == {"status": "ok", "created": 4, "failed": 1}
+    assert await names() == ["p0", "p1", "p2", "p3"]
+
+
+async def test_import_drops_the_cached_listings(client, category):
+    await Product.create(name="old", original_price=1, category=category)
+    assert len((await client.get("/products/")).json()["products"]) == 1
+    assert (await client.get("/categories/")).json()["categories"][0]["product_count"] == 1
+    await post(client, b'{"name": "new", "original_price": 1, "category_id": 1}\n', "application/x-ndjson")
+    assert [product["name"] for product in (await client.get("/products/")).json()["products"]] == ["old", "new"]
+    assert (await client.get("/categories/")).json()["categories"][0]["product_count"] == 2
+
+
+@pytest.mark.parametrize("content_type, body, status_code", [
+    ("application/json", b"[{", 400),
+    ("application/json", b'{"name": "a"}', 400),
+    ("application/xml", b"<products/>", 415),
+])
+async def test_rejected_bodies(client, category, content_type, body, status_code):
+    response = await client.post("/products/bulk", content=body, headers={"Content-Type": content_type})
+    assert response.status_code == status_code
@@ -0,0 +1,36 @@
+import pytest
+from tortoise import Tortoise
+from migrations import run_migrations
+
+pytestmark = pytest.mark.anyio
+
+# The catalog tables as they were before updated_at
+OLD_SCHEMA = """
+CREATE TABLE category (id INTEGER PRIMARY KEY AUTOINCREMENT, name VARCHAR(30) NOT NULL UNIQUE);
+CREATE TABLE product (id INTEGER PRIMARY KEY AUTOINCREMENT, name VARCHAR(100) NOT NULL,
+    image VARCHAR(200) NOT NULL DEFAULT 'defaultProduct.png', original_price VARCHAR(40) NOT NULL,
+    category_id INT NOT NULL REFERENCES category (id) ON DELETE CASCADE);
+INSERT INTO category (name) VALUES ('books');
+INSERT INTO product (name, original_price, category_id) VALUES ('product', '1.99', 1);
+"""
+
+
+async def test_migrations_add_updated_at_to_existing_tables():
+    from models import Category, Product
+
+    await Tortoise.init(db_url="sqlite://:memory:", modules={"models": ["models"]})
+    try:
+        connection = Tortoise.get_connection("default")
+        await connection.execute_script(OLD_SCHEMA)
+        await run_migrations(connection)
+        # a second run does nothing
+        await run_migrations(connection)
+        product = await Product.get(name="product")
+        assert product.updated_at is not None
+        assert (await Category.get(name="books")).updated_at is not None
+    finally:
+        await Tortoise.close_connections()
+
+
+async def test_migrations_on_generated_schema(app):
+    await run_migrations(Tortoise.get_connection("default"))
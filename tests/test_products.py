@@ -0,0 +1,77 @@
+import asyncio
+import pytest
+import routers.products
+from cache import product_flight
+
+pytestmark = pytest.mark.anyio
+
+
+@pytest.mark.parametrize("upsert, item", [(False, {"id": 1, "name": None}), (True, {"name": None, "category_id": 1,
+                                                                                    "original_price": "1.50"})])
+async def test_bulk_update_rejects_null_fields(client, catalog, upsert, item):
+    response = await client.put("/products/bulk", params={"upsert": upsert}, json=[item])
+    assert response.status_code == 422
+
+
+async def test_bulk_update_and_upsert(client, catalog):
+    response = await client.put("/products/bulk", params={"upsert": True}, json=[
+        {"id": catalog[0].id, "name": "renamed"}, {"id": 999, "name": "missing"},
+        {"name": "new", "original_price": "2.50", "category_id": catalog[0].category_id}])
+    assert response.json() == {"status": "ok", "updated": 1, "created": 1, "missing": [999]}
+    response = await client.get(f"/products/{catalog[0].id}")
+    assert response.json()["data"]["name"] == "renamed"
+
+
+async def test_listing_only_has_the_category_when_embedded(client, catalog):
+    products = (await client.get("/products/")).json()["products"]
+    assert "category" not in products[0]
+    products = (await client.get("/products/", params={"embed": "category"})).json()["products"]
+    assert products[0]["category"] == {"id": catalog[0].category_id, "name": "books"}
+
+
+async def test_openapi_schema(client):
+    assert (await client.get("/openapi.json")).status_code == 200
+
+
+async def test_batch_keeps_the_order_and_reports_the_missing_ids(client, catalog):
+    ids = [catalog[2].id, catalog[0].id, catalog[2].id, 999]
+    response = await client.get("/products/batch", params={"ids": ",".join(map(str, ids))})
+    assert [product["id"] for product in response.json()["products"]] == [catalog[2].id, catalog[0].id]
+    assert response.json()["missing"] == [999]
+
+
+@pytest.mark.parametrize("ids, status_code", [
+    (",".join(map(str, range(1, 201))), 200),
+    (",".join(map(str, range(1, 202))), 400),
+    # repeated ids only count once
+    (",".join(["1"] * 300), 200),
+    ("1,,2", 422),
+    ("1,a", 422),
+])
+async def test_batch_size_limit(client, catalog, ids, status_code):
+    response = await client.get("/products/batch", params={"ids": ids})
+    assert response.status_code == status_code
+    assert routers.products.MAX_BATCH_IDS == 200
+
+
+async def test_concurrent_identical_batches_share_one_query(client, catalog, monkeypatch):
+    release, calls = asyncio.Event(), []
+    load_batch_products = routers.products.load_batch_products
+
+    async def gated(product_ids, embed=None):
+        calls.append(product_ids)
+        await release.wait()
+        return await load_batch_products(product_ids, embed)
+
+    monkeypatch.setattr(routers.products, "load_batch_products", gated)
+    started = product_flight.calls
+    requests = [asyncio.create_task(client.get("/products/batch", params={"ids": ids}))
+                for ids in ("1,2", "1,2", "1,1,2", "2,1")]
+    while product_flight.calls - started < 4:
+        await asyncio.sleep(0)
+    release.set()
+    responses = await asyncio.gather(*requests)
+    # "2,1" asks for another order
+    assert calls == [(1, 2), (2, 1)]
+    assert responses[0].json() == responses[1].json() == responses[2].json()
+    assert [product["id"] for product in responses[3].json()["products"]] == [2, 1]
@@ -0,0 +1,24 @@
+import pytest
+from metrics import query_budget
+
+pytestmark = pytest.mark.anyio
+
+
+@pytest.mark.parametrize("path", ["/products/", "/products/?embed=category", "/products/?limit=2&cursor=1",
+                                  "/products/batch?ids=1,2,3", "/categories/"])
+async def test_listings_stay_within_two_statements(client, catalog, path):
+    async with query_budget(2):
+        assert (await client.get(path)).status_code == 200
+
+
+async def test_single_product_is_one_statement_then_cached(client, catalog):
+    async with query_budget(1):
+        assert (await client.get(f"/products/{catalog[0].id}")).status_code == 200
+    async with query_budget(0):
+        assert (await client.get(f"/products/{catalog[0].id}")).status_code == 200
+
+
+async def test_budget_overrun_lists_the_statements(client, catalog):
+    with pytest.raises(AssertionError, match="queries issued, the budget is 0"):
+        async with query_budget(0):
+            await client.get("/products/")
@@ -0,0 +1,76 @@
+import httpx
+import pytest
+from tortoise import Tortoise, connections
+import replicas
+from database import tortoise_config
+
+pytestmark = pytest.mark.anyio
+
+
+async def create_database(db_url: str, product_name: str):
+    from models import Category, Product
+
+    await Tortoise.init(db_url=db_url, modules={"models": ["models"]})
+    await Tortoise.generate_schemas()
+    category = await Category.create(name="books")
+    await Product.create(name=product_name, original_price="1.99", category=category)
+    await Tortoise.close_connections()
+
+
+# The primary and its replica are two SQLite files holding a different name for the same product, so every response
+# tells which one it was read from
+@pytest.fixture
+async def replicated(tmp_path, monkeypatch):
+    from cache import caches
+    from main import app
+
+    primary, replica = f"sqlite://{tmp_path / 'primary.db'}", f"sqlite://{tmp_path / 'replica.db'}"
+    await create_database(primary, "on primary")
+    await create_database(replica, "on replica")
+    await Tortoise.init(config=tortoise_config(primary, [replica]))
+    monkeypatch.setattr(replicas, "replicas", [replicas.Replica("replica_1")])
+    monkeypatch.setattr(replicas, "_last_write", float("-inf"))
+    await replicas.check_replicas()
+    for cache in caches:
+        cache.clear()
+    try:
+        async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://test") as client:
+            yield client
+    finally:
+        await Tortoise.close_connections()
+        # Tortoise.init merges the connections into the ones of the first init, the app's: put them back
+        connections.db_config.clear()
+        connections.db_config.update(tortoise_config()["connections"])
+
+
+async def test_reads_go_to_the_replica_and_writes_to_the_primary(replicated, monkeypatch):
+    from models import Product
+
+    assert replicas.replicas[0].healthy
+    assert (await replicated.get("/products/")).json()["products"][0]["name"] == "on replica"
+
+    response = await replicated.put("/products/1", json={"name": "updated", "original_price": "2.99"})
+    assert response.status_code == 200
+    primary, replica = Tortoise.get_connection("default"), Tortoise.get_connection("replica_1")
+    assert (await Product.get(id=1).using_db(primary)).name == "updated"
+    assert (await Product.get(id=1).using_db(replica)).name == "on replica"
+
+    # the worker reads its own writes from the primary until the replicas can have them
+    assert (await replicated.get("/products/1")).json()["data"]["name"] == "updated"
+    monkeypatch.setattr(replicas, "_last_write", float("-inf"))
+    assert (await replicated.get("/products/?limit=1")).json()["products"][0]["name"] == "on replica"
+
+
+async def test_reads_stay_on_the_primary_without_a_healthy_replica(replicated):
+    replicas.replicas[0].healthy = False
+    assert (await replicated.get("/products/")).json()["products"][0]["name"] == "on primary"
+
+
+async def test_bulk_writes_run_on_the_primary(replicated):
+    from models import Product
+
+    response = await replicated.put("/products/bulk", json=[{"id": 1, "name": "bulk"}])
+    assert response.json()["updated"] == 1
+    assert (await Product.get(id=1).using_db(Tortoise.get_connection("default"))).name == "bulk"
+    response = await replicated.request("DELETE", "/products/bulk", json={"ids": [1]})
+    assert response.json()["deleted"] == 1
@@ -0,0 +1,72 @@
+import pytest
+from models import Category, Product
+from search import search_index
+
+pytestmark = pytest.mark.anyio
+
+
+@pytest.fixture
+async def category(app):
+    return await Category.create(name="food")
+
+
+async def create(category, *names):
+    return [await Product.create(name=name, original_price="1.00", category=category) for name in names]
+
+
+async def names(client, query: str):
+    response = await client.get("/products/search", params={"q": query})
+    return [product["name"] for product in response.json()["products"]]
+
+
+async def test_every_word_has_to_match(client, category):
+    await create(category, "red apple", "green apple", "red pepper")
+    assert await names(client, "red apple") == ["red apple"]
+    assert await names(client, "Apple RED") == ["red apple"]
+    assert await names(client, "red banana") == []
+
+
+async def test_words_match_as_prefixes(client, category):
+    await create(category, "apple juice", "applesauce", "pineapple")
+    assert sorted(await names(client, "app")) == ["apple juice", "applesauce"]
+    assert await names(client, "appl jui") == ["apple juice"]
+
+
+async def test_ranking(category):
+    cat, catalog, cat_food = await create(category, "cat", "catalog", "cat food")
+    # whole words before the words they are a prefix of, then the shortest names
+    assert await search_index.search("cat", 10) == [cat.id, cat_food.id, catalog.id]
+    assert await search_index.search("cat", 1) == [cat.id]
+    assert await search_index.search("cat foo", 10) == [cat_food.id]
+
+
+async def test_index_follows_the_product_signals(client, category):
+    product, = await create(category, "orange")
+    assert await names(client, "orange") == ["orange"]
+    assert search_index.stats()["loaded"]
+    product.name = "lemon"
+    await product.save()
+    assert await names(client, "orange") == []
+    assert await names(client, "lemon") == ["lemon"]
+    await create(category, "lime")
+    assert await names(client, "lime") == ["lime"]
+    await product.delete()
+    assert await names(client, "lemon") == []
+
+
+async def test_index_follows_the_bulk_operations(client, category):
+    await create(category, "kiwi")
+    assert await names(client, "kiwi") == ["kiwi"]
+    body = b'{"name": "mango", "original_price": "2.00", "category_id": %d}\n' % category.id
+    response = await client.post("/products/bulk", content=body, headers={"Content-Type": "application/x-ndjson"})
+    assert response.status_code == 200
+    assert await names(client, "mango") == ["mango"]
+    mango = await Product.get(name="mango")
+    response = await client.put("/products/bulk", json=[{"id": mango.id, "name": "papaya"}])
+    assert response.json()["updated"] == 1
+    assert await names(client, "mango") == []
+    assert await names(client, "papaya") == ["papaya"]
+    response = await client.request("DELETE", "/products/bulk", json={"ids": [mango.id]})
+    assert response.json()["deleted"] == 1
+    assert await names(client, "papaya") == []
+    assert await names(client, "kiwi") == ["kiwi"]
@@ -0,0 +1,172 @@
+import hashlib
+import os
+import pytest
+import static_files
+from static_files import FileCache, IMMUTABLE_CACHE_CONTROL, REVALIDATE_CACHE_CONTROL, StaticImages, parse_range
+
+
+@pytest.mark.parametrize("header, expected", [
+    ("bytes=0-9", (0, 9)), ("bytes=5-", (5, 99)), ("bytes=-10", (90, 99)), ("bytes=90-200", (90, 99)),
+    ("bytes=-200", (0, 99)),
+    # invalid or unsupported ranges are ignored, the whole file is sent
+    ("bytes=5-1", None), ("bytes=a-b", None), ("bytes=-", None), ("items=0-1", None), ("bytes=0-1,5-6", None),
+])
+def test_parse_range(header, expected):
+    assert parse_range(header, 100) == expected
+
+
+@pytest.mark.parametrize("header", ["bytes=100-", "bytes=150-200", "bytes=-0"])
+def test_unsatisfiable_range(header):
+    with pytest.raises(ValueError):
+        parse_range(header, 100)
+
+
+# Serve a request with `app`, returning the status, the response headers, the body and the messages sent
+async def call(app, path: str, headers: dict = None, method: str = "GET", extensions: dict = None):
+    scope = {"type": "http", "method": method, "path": path, "extensions": extensions or {},
+             "headers": [(name.lower().encode(), value.encode()) for name, value in (headers or {}).items()]}
+    messages = []
+
+    async def send(message):
+        messages.append(message)
+
+    await app(scope, None, send)
+    response_headers = {name.decode(): value.decode() for name, value in messages[0]["headers"]}
+    body = b"".join(message.get("body", b"") for message in messages[1:])
+    return messages[0]["status"], response_headers, body, messages[1:]
+
+
+CONTENT = bytes(range(100))
+STORED = "ab" * 32 + ".png"
+
+
+@pytest.fixture
+def directory(tmp_path):
+    directory = tmp_path / "images"
+    directory.mkdir()
+    (directory / "plain.png").write_bytes(CONTENT)
+    (directory / STORED).write_bytes(CONTENT)
+    (tmp_path / "secret.txt").write_text("secret")
+    return directory
+
+
+@pytest.fixture
+def static(directory):
+    return StaticImages(str(directory), FileCache("test"))
+
+
+@pytest.mark.anyio
+async def test_strong_etag_of_the_content(directory, static):
+    status, headers, body, _ = await call(static, "/plain.png")
+    assert status == 200 and body == CONTENT
+    assert headers["etag"] == '"' + hashlib.blake2b(CONTENT, digest_size=16).hexdigest() + '"'
+    assert headers["content-type"] == "image/png" and headers["content-length"] == "100"
+    assert headers["accept-ranges"] == "bytes"
+    # another worker computes the same ETag
+    other = StaticImages(str(directory), FileCache("other"))
+    assert (await call(other, "/plain.png"))[1]["etag"] == headers["etag"]
+    assert (await call(static, "/" + STORED))[1]["etag"] == headers["etag"]
+
+
+@pytest.mark.anyio
+async def test_cache_control(static):
+    assert (await call(static, "/" + STORED))[1]["cache-control"] == IMMUTABLE_CACHE_CONTROL
+    assert (await call(static, "/plain.png"))[1]["cache-control"] == REVALIDATE_CACHE_CONTROL
+
+
+@pytest.mark.anyio
+async def test_conditional_requests(static):
+    _, headers, _, _ = await call(static, "/plain.png")
+    etag, last_modified = headers["etag"], headers["last-modified"]
+    for if_none_match in (etag, f'"other", W/{etag}', "*"):
+        status, headers, body, _ = await call(static, "/plain.png", {"If-None-Match": if_none_match})
+        assert status == 304 and body == b"" and headers["etag"] == etag
+    assert (await call(static, "/plain.png", {"If-Modified-Since": last_modified}))[0] == 304
+    assert (await call(static, "/plain.png", {"If-Modified-Since": "Thu, 01 Jan 1998 00:00:00 GMT"}))[0] == 200
+    assert (await call(static, "/plain.png", {"If-Modified-Since": "yesterday"}))[0] == 200
+    # If-None-Match takes precedence
+    assert (await call(static, "/plain.png", {"If-None-Match": '"other"', "If-Modified-Since": last_modified}))[0] \
+        == 200
+
+
+@pytest.mark.anyio
+async def test_ranges(static):
+    _, headers, _, _ = await call(static, "/plain.png")
+    etag, last_modified = headers["etag"], headers["last-modified"]
+    status, headers, body, _ = await call(static, "/plain.png", {"Range": "bytes=10-19"})
+    assert status == 206 and body == CONTENT[10:20]
+    assert headers["content-range"] == "bytes 10-19/100" and headers["content-length"] == "10"
+    for if_range in (etag, last_modified):
+        status, _, body, _ = await call(static, "/plain.png", {"Range": "bytes=-5", "If-Range": if_range})
+        assert status == 206 and body == CONTENT[-5:]
+    # the client has another version, it gets the whole file
+    status, _, body, _ = await call(static, "/plain.png", {"Range": "bytes=-5", "If-Range": '"other"'})
+    assert status == 200 and body == CONTENT
+    status, headers, _, _ = await call(static, "/plain.png", {"Range": "bytes=100-"})
+    assert status == 416 and headers["content-range"] == "bytes */100"
+    assert (await call(static, "/plain.png", {"Range": "bytes=5-1"}))[0] == 200
+
+
+@pytest.mark.anyio
+async def test_head_and_methods(static):
+    status, headers, body, _ = await call(static, "/plain.png", method="HEAD")
+    assert status == 200 and body == b"" and headers["content-length"] == "100"
+    status, headers, _, _ = await call(static, "/plain.png", method="POST")
+    assert status == 405 and headers["allow"] == "GET, HEAD"
+
+
+@pytest.mark.anyio
+@pytest.mark.parametrize("path", ["/../secret.txt", "/../images/../secret.txt", "/", "/missing.png", "/link.txt",
+                                  "/plain.png/x"])
+async def test_only_the_files_of_the_directory_are_served(directory, static, path):
+    (directory / "link.txt").symlink_to(directory.parent / "secret.txt")
+    assert (await call(static, path))[0] == 404
+
+
+@pytest.mark.anyio
+async def test_lru_budget(directory):
+    cache = FileCache("test", budget=250, max_file_size=100)
+    static = StaticImages(str(directory), cache)
+    for name in "abc":
+        (directory / f"{name}.png").write_bytes(CONTENT)
+    (directory / "large.png").write_bytes(CONTENT * 2)
+    for name in ("a", "b", "a", "c"):
+        await call(static, f"/{name}.png")
+    # b was the least recently used one
+    assert list(cache._entries) == [str(directory / "a.png"), str(directory / "c.png")]
+    assert cache.stats()["bytes"] == 200 and cache.stats()["evictions"] == 1
+    assert cache.stats()["hits"] == 1 and cache.stats()["misses"] == 3
+    # the large files keep their ETag but not their body
+    _, headers, body, _ = await call(static, "/large.png")
+    assert body == CONTENT * 2 and cache._entries[str(directory / "large.png")].body is None
+    assert cache.stats()["bytes"] == 200
+    # a new version of a file is read again
+    (directory / "a.png").write_bytes(CONTENT[:50])
+    os.utime(directory / "a.png", ns=(1, 1))
+    assert (await call(static, "/a.png"))[2] == CONTENT[:50]
+    assert cache.stats()["bytes"] == 150
+
+
+@pytest.mark.anyio
+async def test_large_files_are_sent_by_the_server_when_it_can(directory, monkeypatch):
+    monkeypatch.setattr(static_files, "CHUNK_SIZE", 16)
+    static = StaticImages(str(directory), FileCache("test", max_file_size=10))
+    path = str(directory / "plain.png")
+
+    _, _, _, messages = await call(static, "/plain.png", extensions={"http.response.pathsend": {}})
+    assert messages == [{"type": "http.response.pathsend", "path": path}]
+
+    # pathsend only sends whole files
+    _, _, _, messages = await call(static, "/plain.png", {"Range": "bytes=10-"},
+                                   extensions={"http.response.pathsend": {}})
+    assert [message["type"] for message in messages] == ["http.response.body"] * 6
+    _, _, _, messages = await call(static, "/plain.png", {"Range": "bytes=10-"},
+                                   extensions={"http.response.zerocopysend": {}})
+    assert len(messages) == 1 and messages[0]["type"] == "http.response.zerocopysend"
+    assert messages[0]["offset"] == 10 and messages[0]["count"] == 90 and messages[0]["file"].name == path
+
+    # chunked without the extensions
+    status, _, body, messages = await call(static, "/plain.png", {"Range": "bytes=10-"})
+    assert status == 206 and body == CONTENT[10:]
+    assert [len(message["body"]) for message in messages] == [16] * 5 + [10]
+    assert [message["more_body"] for message in messages] == [True] * 5 + [False]